@@ -12,6 +12,9 @@ setup(
       'pylazybam',
       'docopt',
     ],
+    extras_require = {
+      'fast': ['isal'],
+    },
     packages=['xenomapper2',
               'xenomapper2.tests',
               ],
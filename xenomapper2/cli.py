@@ -36,11 +36,80 @@ Usage:
               [ --primary-specific=<file> --primary-multi=<file>
 .              --secondary-specific=<file> --secondary-multi=<file>
 .              --unassigned=<file> --unresolved=<file>
-              | --basename=<str> ]
+              | --basename=<str> [ --tagged ] ]
+              [ --fastq=<categories> [ --interleaved ] ]
+              [ --sort [ --sort-memory=<int> ] ]
+              [ --read-groups [ --max-open-read-groups=<int> ] ]
               [ --min-score=<int> ]
               [ --zs | --cigar]
               [ --max ]
               [ --conservative ]
+              [ --max-secondary=<int> ] [ --spill-records=<int> ]
+              [ --cell-barcode=<tag> [ --umi=<tag> ]
+.              [ --barcode-matrix=<file> ] ]
+              [ --scores=<file> ]
+              [ --name-index [ --index-every=<int> ] ]
+              [ --contig-stats=<file> ]
+              [ --score-histograms=<file> ]
+              [ --manifest=<file> --shard=<int> ]
+              [ --auto-tune ] [ --threads=<int> ] [ --codec=<name> ]
+              [ --preflight ] [ --follow [ --follow-timeout=<seconds> ] ]
+  xenomapper2 --from-scores=<file>
+              [ --primary=<file>  --secondary=<file>
+.              [ --primary-specific=<file> --primary-multi=<file>
+.              --secondary-specific=<file> --secondary-multi=<file>
+.              --unassigned=<file> --unresolved=<file>
+.              | --basename=<str> [ --tagged ] ]
+.              [ --sort [ --sort-memory=<int> ] ] ]
+              [ --min-score=<int> ]
+              [ --max ]
+              [ --conservative ]
+  xenomapper2 --primary-scores=<file> --secondary-scores=<file>
+              [ --primary=<file>  --secondary=<file>
+.              [ --primary-specific=<file> --primary-multi=<file>
+.              --secondary-specific=<file> --secondary-multi=<file>
+.              --unassigned=<file> --unresolved=<file>
+.              | --basename=<str> [ --tagged ] ]
+.              [ --sort [ --sort-memory=<int> ] ] ]
+              [ --min-score=<int> ]
+              [ --zs | --cigar]
+              [ --max ]
+              [ --conservative ]
+  xenomapper2 --primary-command=<cmd> --secondary-command=<cmd>
+              [ --reads=<files> ]
+              [ --primary-specific=<file> --primary-multi=<file>
+.              --secondary-specific=<file> --secondary-multi=<file>
+.              --unassigned=<file> --unresolved=<file>
+              | --basename=<str> [ --tagged ] ]
+              [ --fastq=<categories> [ --interleaved ] ]
+              [ --sort [ --sort-memory=<int> ] ]
+              [ --min-score=<int> ]
+              [ --zs | --cigar]
+              [ --max ]
+              [ --conservative ]
+              [ --max-secondary=<int> ] [ --spill-records=<int> ]
+  xenomapper2 --primary=<file>  --secondary=<file> --estimate
+              [ --margin=<float> ] [ --confidence=<float> ]
+              [ --max-samples=<int> ] [ --seed=<int> ]
+              [ --min-score=<int> ]
+              [ --zs | --cigar]
+              [ --max ]
+              [ --conservative ]
+  xenomapper2 shard --primary=<file>  --secondary=<file> --n-shards=<int>
+              ( --manifest=<file> )
+  xenomapper2 merge --basename=<str> <shard_basename>...
+  xenomapper2 extract-scores <bam> <genome_scores>
+  xenomapper2 preflight --primary=<file>  --secondary=<file>
+              [ --zs | --cigar]
+  xenomapper2 explain <readname> --primary=<file>  --secondary=<file>
+              [ --min-score=<int> ]
+              [ --zs | --cigar]
+              [ --max ]
+              [ --conservative ]
+  xenomapper2 codecs --primary=<file>
+  xenomapper2 threads --primary=<file>  --secondary=<file> [ --threads=<int> ]
+  xenomapper2 serve --socket=<file> [ --workers=<int> ]
+  xenomapper2 submit --socket=<file> [--] <job>...
   xenomapper2 --version
   xenomapper2 [ -h | --help ]
 
@@ -51,6 +120,28 @@ Options:
   Input files
   --primary=<file>           A BAM format file of primary species alignments
   --secondary=<file>         A BAM format file of secondary species alignments
+                             Several files (eg one per lane) can be given to
+                             both options as comma separated lists in the
+                             same order. Headers must have the same references
+  --follow                   start reading BAM files that are still being
+                             written (eg by aligners) and wait for new data
+                             until each file is closed with a BGZF EOF block.
+                             Each lane of several files is opened when the
+                             previous lane is read, and only @RG lines of the
+                             first lane are in the output headers
+  --follow-timeout=<seconds>
+                             seconds to wait for data to be written to a
+                             followed file before stopping with an error
+                             [ Default : 600 ]
+
+  Aligner options
+  --primary-command=<cmd>    run these aligner commands and classify their
+  --secondary-command=<cmd>  output (SAM or BAM on standard output) as it is
+                             written, without intermediate files. {R1}, {R2}
+                             and {reads} in the commands are replaced by the
+                             reads files. The aligners are read in step so
+                             neither runs far ahead of the other
+  --reads=<files>            comma separated reads files for the commands
 
   Output options
   --primary-specific=<file>  filename for primary specific unique alignments
@@ -61,6 +152,32 @@ Options:
   --unresolved=<file>        filename for unresolved alignments
   --basename=<str>           prefix for creating all other output files
                              only valid if no other output options provided
+  --tagged                   write <basename>_primary.bam and
+                             <basename>_secondary.bam with the category of each
+                             alignment in an XC:Z tag instead of a file for
+                             each category
+  --fastq=<categories>       comma separated list of categories to write as
+                             gzipped FASTQ (R1 and R2 files) instead of BAM
+                             eg primary_specific,unresolved or all
+  --interleaved              write FASTQ output as a single interleaved file
+  --sort                     write coordinate sorted BAM files and .bai indexes
+  --sort-memory=<int>        megabytes of alignments to hold in memory for each
+                             sorted file before using temporary files. Each
+                             category has its own buffer, so up to six times
+                             this may be used in total [ Default : 256 ]
+  --read-groups              write the categories of each read group (RG tag
+                             of the primary BAM records) to
+                             <basename>_<read group>_<category> files and
+                             the counts and filename of each read group to
+                             <basename>_read_groups.tsv
+  --max-open-read-groups=<int>
+                             read groups to hold open files for before
+                             closing the least recently used [ Default : 16 ]
+  --contig-stats=<file>      filename for a table of category counts for each
+                             reference sequence in both genomes
+  --score-histograms=<file>  filename for histograms of scores and score
+                             margins by category (JSON if ending in .json,
+                             otherwise tab separated)
 
   Processing options
   --min-score=<int>          minimum AS score required. Lower scores unassigned.
@@ -71,6 +188,97 @@ Options:
                              [ Default : Use score of primary alignment ]
   --conservative             require both ends of paired reads to support the
                              assignment
+  --max-secondary=<int>      retain at most this many secondary alignments per
+                             template for scoring and output
+                             [ Default : None (retain all) ]
+  --spill-records=<int>      hold templates with more than this many alignments
+                             in temporary files instead of memory
+                             [ Default : None (never spill) ]
+  --auto-tune                time the first seconds of the run and choose the
+                             highest BAM output compression level estimated
+                             to add at most a quarter to the run time.
+                             Only the compression level is tuned, not the
+                             thread count or chunk sizes, and FASTQ outputs
+                             are unchanged
+  --threads=<int>            classify templates on this many threads. Only
+                             used by free-threaded (no GIL) Python builds and
+                             not with --scores [ Default : 1 ]. xenomapper2
+                             threads times classification of the start of a
+                             pair of BAM files with up to this many threads
+  --codec=<name>             deflate implementation for reading and writing
+                             BGZF: auto, isal, zlib-ng or zlib. auto uses the
+                             first installed in that order. Outputs are
+                             standard BGZF with any codec. xenomapper2 codecs
+                             compares the installed codecs on the start of a
+                             BAM file [ Default : auto ]
+  --preflight                check templates sampled through both files
+                             correspond and are in the same order, and the
+                             header sort orders and score tags, before reading
+                             the whole files. Stops with a report of any
+                             problems. xenomapper2 preflight prints the report
+
+  Single cell options
+  --cell-barcode=<tag>       count categories per cell using this barcode tag
+                             (eg CB)
+  --umi=<tag>                count each UMI tag (eg UB) once per barcode and
+                             category. Templates without a UMI are not
+                             counted
+  --barcode-matrix=<file>    filename for the barcode by category matrix
+                             [ Default : <basename>_barcodes.tsv ]
+
+  Score table options
+  --scores=<file>            save a table of template scores for reclassifying
+                             with --from-scores
+  --from-scores=<file>       reclassify using a saved table of scores with new
+                             min-score, max or conservative options. The
+                             original BAM files are only read if output files
+                             are requested.
+
+  Genome scores options
+  --primary-scores=<file>    classify using genome scores files written by
+  --secondary-scores=<file>  xenomapper2 extract-scores from each BAM file.
+                             Each genome is extracted once and can be paired
+                             with any other with new min-score, zs, cigar,
+                             max or conservative options. The BAM files are
+                             only read if output files are requested.
+
+  Name index options
+  --name-index               write read name indexes (<file>.xni) of the input
+                             BAM files and unsorted BAM outputs. xenomapper2
+                             explain uses the input indexes to show the scores,
+                             states and category of one template
+  --index-every=<int>        index the name of every nth template. A lookup
+                             reads at most this many templates
+                             [ Default : 1024 ]
+
+  Server options
+  --socket=<file>            Unix domain socket of a xenomapper2 serve process.
+                             serve keeps worker processes ready to run jobs
+                             sent with submit. Each <job> is a quoted string
+                             of options for a xenomapper2 classification run
+                             or merge and a JSON summary of each job is
+                             printed as it finishes
+  --workers=<int>            number of jobs to run at once [ Default : 2 ]
+
+  Estimate options
+  --estimate                 estimate category proportions from randomly
+                             sampled templates without reading whole files
+  --margin=<float>           sample until all confidence intervals are within
+                             this margin of the estimate [ Default : 0.01 ]
+  --confidence=<float>       confidence level of the intervals
+                             [ Default : 0.95 ]
+  --max-samples=<int>        maximum number of templates to sample
+                             [ Default : 100000 ]
+  --seed=<int>               seed for the random sampling of templates
+
+  Multiple node options
+  --n-shards=<int>           number of template aligned shards to divide the
+                             input files into with xenomapper2 shard
+  --manifest=<file>          shard manifest written by xenomapper2 shard
+  --shard=<int>              process only this shard (numbered from 0) of the
+                             manifest. Requires --basename and can not be
+                             used with --sort. Shard outputs are combined
+                             with xenomapper2 merge
 
 Note that unlike prior xenomapper versions there is no --pair option as forward
 and reverse reads are automatically extracted based on their flag. Files of
@@ -88,12 +296,14 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 
 """
 
-import sys, gzip, time
+import sys, contextlib, gzip, json, shlex, time
 from docopt import docopt
 from typing import Counter, Tuple
 
 from pylazybam import bam
+from pylazybam.bgzf import BgzfReader
 from xenomapper2.xenomapper2 import *
+from xenomapper2.server import XenomapperServer, submit_jobs
 
 __author__ = "Matthew Wakefield"
 __copyright__ = ("Copyright 2018-2020 Matthew Wakefield"
@@ -125,7 +335,14 @@ def main(arguments: str = None,
     Counter
         a counter of read states
     """
+    # aligner processes are stopped if the run fails at any point after
+    # they are started
+    with contextlib.ExitStack() as aligners:
+        return _main(arguments, output, aligners)
+
 
+def _main(arguments: str, output,
+          aligners: contextlib.ExitStack) -> Tuple[Counter, Counter]:
     start_time = time.time()
 
     if not arguments:#pragma: no cover
@@ -142,6 +359,114 @@ def main(arguments: str = None,
         sys.exit()
 
 
+    if args["serve"]:
+        with XenomapperServer(args["--socket"],
+                              workers=int(args["--workers"] or 2)) as server:
+            print(f"xenomapper2 v{__version__} serving on {args['--socket']} "
+                  f"with {server.workers} workers", file=output)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt: #pragma: no cover
+                pass
+        return None
+
+    if args["submit"]:
+        summaries = []
+        for summary in submit_jobs(args["--socket"],
+                                   [shlex.split(job) for job in args["<job>"]]):
+            print(json.dumps(summary), file=output)
+            summaries.append(summary)
+        if arguments:
+            return summaries
+        if any(summary['status'] != 'ok' for summary in summaries):
+            sys.exit(1) #pragma: no cover
+        return None
+
+    if args["codecs"]:
+        with gzip.open(args["--primary"]) as sample_file:
+            sample = sample_file.read(2**22)
+        results = benchmark_codecs(sample)
+        row = '|  {0:10s}|{1:>16s}|{2:>10s}|{3:>18s}|{4:>10s}|{5:>8s}  |'
+        print(row.format('Codec', 'Compress MB/s', 'Speedup',
+                         'Decompress MB/s', 'Speedup', 'Ratio'), file=output)
+        for name, result in results.items():
+            print(row.format(name,
+                             f"{result['compress'] / 2**20:.1f}",
+                             f"{result['compress_speedup']:.2f}x",
+                             f"{result['decompress'] / 2**20:.1f}",
+                             f"{result['decompress_speedup']:.2f}x",
+                             f"{result['ratio']:.2f}"), file=output)
+        return results if arguments else None
+
+    if args["threads"]:
+        with AlignbatchFileReader(gzip.open(args["--primary"])) as primary, \
+             AlignbatchFileReader(gzip.open(args["--secondary"])) as secondary:
+            batches = list(islice(zip(primary, secondary), 100000))
+        max_threads = int(args["--threads"] or 4)
+        thread_counts = [2**i for i in range(max_threads.bit_length())
+                         if 2**i < max_threads] + [max_threads]
+        results = benchmark_threads(batches, thread_counts)
+        print(f"{len(batches)} templates classified with the GIL "
+              f"{'enabled' if gil_enabled() else 'disabled'}", file=output)
+        row = '|  {0:10s}|{1:>16s}|{2:>10s}  |'
+        print(row.format('Threads', 'Templates/s', 'Speedup'), file=output)
+        for threads, result in results.items():
+            print(row.format(str(threads) if threads else 'serial',
+                             f"{result['templates_per_second']:.0f}",
+                             f"{result['speedup']:.2f}x"), file=output)
+        return results if arguments else None
+
+    if args["shard"]:
+        shards = write_shard_manifest(args["--primary"],
+                                      args["--secondary"],
+                                      int(args["--n-shards"]),
+                                      args["--manifest"])
+        print(f"{len(shards)} shards written to {args['--manifest']}",
+              file=output)
+        return shards if arguments else None
+
+    if args["merge"]:
+        pair_counts, counts = merge_shards(args["<shard_basename>"],
+                                           args["--basename"])
+        output_summary(category_counts=pair_counts,
+                       title='Read Category Summary',
+                       outfile=output)
+        output_summary(category_counts=counts,
+                       title='Read Pair Category Summary',
+                       outfile=output)
+        return (pair_counts, counts) if arguments else None
+
+    if args["extract-scores"]:
+        reader = AlignbatchFileReader(BgzfReader(args["<bam>"], 'rb'),
+                                      track_offsets=True)
+        templates = extract_genome_scores(reader, args["<genome_scores>"])
+        reader.close()
+        print(f"Scores of {templates} templates written to "
+              f"{args['<genome_scores>']}", file=output)
+        return templates if arguments else None
+
+    if args["--cigar"]:
+        score_type = 'cigar'
+    elif args["--zs"]:
+        score_type = 'ZS'
+    else:
+        score_type = 'XS'
+
+    if args["preflight"]:
+        report = preflight_check(args["--primary"], args["--secondary"],
+                                 score_type=score_type)
+        report.write(output)
+        if arguments:
+            return report
+        sys.exit(0 if report.ok else 1) #pragma: no cover
+
+    if args["--shard"] and not args["--basename"]:
+        raise ValueError("--shard requires --basename")
+
+    if args["--shard"] and args["--sort"]:
+        # coordinate sorted shard outputs can not be merged by concatenation
+        raise ValueError("--shard can not be used with --sort")
+
     if args["--cigar"]:
         AS_function = get_cigar_based_score
         XS_function = always_very_negative
@@ -163,34 +488,279 @@ def main(arguments: str = None,
     else:
         min_score = MIN32INT
 
-    primary_bam = AlignbatchFileReader(gzip.open(args["--primary"]))
-    primary_header = primary_bam.raw_header
-    primary_refs = primary_bam.raw_refs
+    if args["explain"]:
+        template = explain_template(args["--primary"],
+                                    args["--secondary"],
+                                    args["<readname>"],
+                                    score_function=score_function,
+                                    AS_function=AS_function,
+                                    XS_function=XS_function,
+                                    min_score=min_score,
+                                    conservative=args["--conservative"])
+        if template is None:
+            print(f"{args['<readname>']} is not in both BAM files",
+                  file=output)
+            return template if arguments else None
+        print(args["<readname>"], file=output)
+        row = '|  {0:10s}|{1:>14s}|{2:>14s}|{3:>14s}|{4:>14s}|  {5:20s}|'
+        print(row.format('Segment', 'Primary AS', 'Primary XS',
+                         'Secondary AS', 'Secondary XS', 'State'),
+              file=output)
+        for segment, scores, state in (
+                ('forward', template.forward_scores, template.forward_state),
+                ('reverse', template.reverse_scores, template.reverse_state)):
+            if scores is None:
+                continue
+            print(row.format(segment,
+                             *[str(score) if score != MIN32INT else '-'
+                               for score in scores],
+                             state),
+                  file=output)
+        print(f"Category : {template.category}", file=output)
+        return template if arguments else None
+
+    codec = get_codec(args["--codec"] or 'auto')
+
+    if (args["--scores"] or args["--from-scores"] or args["--shard"]
+            or args["--name-index"] or args["--primary-scores"]):
+        # BGZF virtual offsets are needed to seek to templates
+        open_bam = lambda filename: BgzfReader(filename, 'rb')
+        track_offsets = True
+    else:
+        open_bam = codec.open
+        track_offsets = False
+
+    if args["--follow"]:
+        if track_offsets or args["--preflight"]:
+            raise ValueError("--follow can not be used with --scores, "
+                             "--from-scores, --shard, --name-index or "
+                             "--preflight")
+        timeout = float(args["--follow-timeout"] or 600)
+        open_bam = lambda filename: BgzfFollower(filename, timeout=timeout,
+                                                 codec=codec)
+
+    batch_limits = {
+        'max_secondary': (int(args["--max-secondary"])
+                          if args["--max-secondary"] else None),
+        'spill_records': (int(args["--spill-records"])
+                          if args["--spill-records"] else None),
+        }
+
+    several_files = any(',' in (args[option] or '')
+                        for option in ("--primary", "--secondary"))
+    if several_files and (track_offsets or args["--estimate"]
+                          or args["--preflight"]):
+        raise ValueError("Several files for --primary or --secondary can not "
+                         "be used with --scores, --from-scores, "
+                         "--primary-scores, --shard, --name-index, "
+                         "--preflight or --estimate")
+
+    if args["--preflight"]:
+        report = preflight_check(args["--primary"], args["--secondary"],
+                                 score_type=score_type)
+        report.write(output)
+        if not report.ok:
+            raise ValueError(f"Preflight check failed: {report.problems[0]}")
+
+    def open_alignbatches(files):
+        if several_files:
+            return AlignbatchFileChain(files.split(','),
+                                       open_file=open_bam,
+                                       lazy=args["--follow"],
+                                       **batch_limits)
+        return AlignbatchFileReader(open_bam(files),
+                                    track_offsets=track_offsets,
+                                    **batch_limits)
+
+    if args["--read-groups"]:
+        if not args["--basename"]:
+            raise ValueError("--read-groups requires --basename")
+        if args["--tagged"] or args["--sort"]:
+            raise ValueError("--read-groups can not be used with --tagged "
+                             "or --sort")
+
+    if args["--fastq"] == 'all':
+        fastq = CATEGORIES
+    elif args["--fastq"]:
+        fastq = args["--fastq"].split(',')
+    else:
+        fastq = ()
+    if fastq and args["--tagged"]:
+        raise ValueError("--fastq can not be used with --tagged")
+
+    if args["--primary-command"]:
+        reads = args["--reads"].split(',') if args["--reads"] else []
+        primary_bam, secondary_bam = [
+            AlignbatchFileReader(aligners.enter_context(AlignerProcess(
+                                     format_aligner_command(args[option],
+                                                            reads))).stream,
+                                 **batch_limits)
+            for option in ("--primary-command", "--secondary-command")]
+    elif args["--primary"] and not args["--estimate"]:
+        primary_bam = open_alignbatches(args["--primary"])
+        secondary_bam = open_alignbatches(args["--secondary"])
+
+        if args["--shard"]:
+            shard = read_shard_manifest(args["--manifest"],
+                                        int(args["--shard"]))
+            primary_bam.set_range(shard['primary_start'],
+                                  shard['primary_end'])
+            secondary_bam.set_range(shard['secondary_start'],
+                                    shard['secondary_end'])
+    else:
+        primary_bam = secondary_bam = None
+
+    if primary_bam is not None:
+        primary_header = primary_bam.raw_header
+        primary_refs = primary_bam.raw_refs
+        secondary_header = secondary_bam.raw_header
+        secondary_refs = secondary_bam.raw_refs
 
-    secondary_bam = AlignbatchFileReader(gzip.open(args["--secondary"]))
-    secondary_header = secondary_bam.raw_header
-    secondary_refs = secondary_bam.raw_refs
+    if args["--sort-memory"]:
+        sort_memory = int(args["--sort-memory"]) * 2**20
+    else:
+        sort_memory = 2**28
 
     cmdline = " ".join([ f"{x}={args[x]}" for x in args.keys() \
-                         if x not in  [".","--help"]])
+                         if x not in  [".","--help","shard","merge","explain",
+                                       "extract-scores","preflight","threads",
+                                       "<shard_basename>",
+                                       "<readname>","<bam>","<genome_scores>"]])
 
     print(f"\nxenomapper2 v{__version__} {cmdline}\n", file=output)
 
-    xow = XenomapperOutputWriter(primary_header,
+    if primary_bam is None:
+        xow = None
+    elif args["--read-groups"]:
+        xow = ReadGroupOutputWriter(primary_header,
+                                    primary_refs,
+                                    secondary_header,
+                                    secondary_refs,
+                                    basename=args["--basename"],
+                                    cmdline=cmdline,
+                                    fastq=fastq,
+                                    interleaved=args["--interleaved"],
+                                    max_open=int(args["--max-open-read-groups"]
+                                                 or 16),
+                                    codec=codec,
+                                    )
+    elif args["--tagged"]:
+        xow = TaggedOutputWriter(primary_header,
                                  primary_refs,
                                  secondary_header,
                                  secondary_refs,
-                                 primary_specific=args["--primary-specific"],
-                                 secondary_specific=args["--secondary-specific"],
-                                 primary_multi=args["--primary-multi"],
-                                 secondary_multi=args["--secondary-multi"],
-                                 unassigned=args["--unassigned"],
-                                 unresolved=args["--unresolved"],
                                  basename=args["--basename"],
-                                 cmdline=cmdline
+                                 cmdline=cmdline,
+                                 sort=args["--sort"],
+                                 sort_memory=sort_memory,
+                                 codec=codec,
                                  )
+    else:
+        xow = XenomapperOutputWriter(primary_header,
+                                     primary_refs,
+                                     secondary_header,
+                                     secondary_refs,
+                                     primary_specific=args["--primary-specific"],
+                                     secondary_specific=args["--secondary-specific"],
+                                     primary_multi=args["--primary-multi"],
+                                     secondary_multi=args["--secondary-multi"],
+                                     unassigned=args["--unassigned"],
+                                     unresolved=args["--unresolved"],
+                                     basename=args["--basename"],
+                                     cmdline=cmdline,
+                                     fastq=fastq,
+                                     interleaved=args["--interleaved"],
+                                     sort=args["--sort"],
+                                     sort_memory=sort_memory,
+                                     codec=codec,
+                                     )
+
+    if args["--cell-barcode"]:
+        barcode_counter = BarcodeCategoryCounter(
+            barcode_tag=args["--cell-barcode"].encode(),
+            umi_tag=args["--umi"].encode() if args["--umi"] else None,
+            )
+    else:
+        barcode_counter = None
+
+    if args["--contig-stats"]:
+        contig_counter = ContigCategoryCounter(primary_bam.refs,
+                                               secondary_bam.refs)
+    else:
+        contig_counter = None
+
+    if args["--score-histograms"]:
+        score_histogram = ScoreHistogram()
+    else:
+        score_histogram = None
 
-    pair_counts, counts, writer = xenomap(primary_bam,
+    if args["--scores"]:
+        score_table = ScoreTableWriter(args["--scores"],
+                                       AS_function=AS_function,
+                                       XS_function=XS_function)
+    else:
+        score_table = None
+
+    if args["--name-index"]:
+        name_index = NameIndexSink(primary_bam,
+                                   secondary_bam,
+                                   args["--primary"],
+                                   args["--secondary"],
+                                   output_writer=xow,
+                                   every=int(args["--index-every"] or 1024))
+    else:
+        name_index = None
+
+    threads = int(args["--threads"]) if args["--threads"] else 1
+    if threads > 1 and gil_enabled():
+        print("The GIL is enabled in this Python so --threads is ignored "
+              "and templates are classified serially", file=output)
+
+    if args["--auto-tune"]:
+        tuner = AdaptiveTuner(codec=codec)
+    else:
+        tuner = None
+
+    intervals = None
+    if args["--estimate"]:
+        pair_counts, counts, intervals = xenomap_estimate(
+                                args["--primary"],
+                                args["--secondary"],
+                                score_function=score_function,
+                                AS_function=AS_function,
+                                XS_function=XS_function,
+                                min_score=min_score,
+                                conservative=args["--conservative"],
+                                confidence=float(args["--confidence"] or 0.95),
+                                margin=float(args["--margin"] or 0.01),
+                                max_samples=int(args["--max-samples"] or 100000),
+                                seed=int(args["--seed"]) if args["--seed"] else None,
+                                )
+        writer = None
+    elif args["--from-scores"]:
+        pair_counts, counts, writer = xenomap_from_scores(
+                                          args["--from-scores"],
+                                          output_writer=xow,
+                                          primary_bam=primary_bam,
+                                          secondary_bam=secondary_bam,
+                                          use_max=args["--max"],
+                                          min_score=min_score,
+                                          conservative=args["--conservative"],
+                                          )
+    elif args["--primary-scores"]:
+        pair_counts, counts, writer = xenomap_from_genome_scores(
+                                          args["--primary-scores"],
+                                          args["--secondary-scores"],
+                                          output_writer=xow,
+                                          primary_bam=primary_bam,
+                                          secondary_bam=secondary_bam,
+                                          use_max=args["--max"],
+                                          score_type=score_type,
+                                          min_score=min_score,
+                                          conservative=args["--conservative"],
+                                          )
+    else:
+        pair_counts, counts, writer = xenomap(primary_bam,
                                           secondary_bam,
                                           output_writer=xow,
                                           score_function=score_function,
@@ -198,19 +768,91 @@ def main(arguments: str = None,
                                           XS_function=XS_function,
                                           min_score=min_score,
                                           conservative=args["--conservative"],
+                                          score_table=score_table,
+                                          sinks=[sink for sink in
+                                                 (score_histogram,
+                                                  barcode_counter,
+                                                  contig_counter,
+                                                  name_index)
+                                                 if sink is not None],
+                                          tuner=tuner,
+                                          threads=threads,
                                           )
 
-    writer.close()
+    # wait for the aligners and raise any errors before the summary
+    aligners.close()
+
+    if writer is not None:
+        writer.close()
+
+    if score_table is not None:
+        score_table.close()
+
+    if name_index is not None:
+        name_index.write()
+        print(f"Read name indexes written for {len(name_index.filenames)} "
+              f"BAM files", file=output)
+
+    if barcode_counter is not None:
+        matrix_name = (args["--barcode-matrix"]
+                       or f"{args['--basename'] or 'xenomapper'}_barcodes.tsv")
+        with open(matrix_name, 'w') as matrix_file:
+            barcode_counter.write_matrix(matrix_file)
+        missing_umi = (f", {barcode_counter.missing_umi} without a UMI"
+                       if barcode_counter.umi_tag else "")
+        print(f"{len(barcode_counter)} cell barcodes written to {matrix_name}"
+              f" ({barcode_counter.missing} templates without a barcode"
+              f"{missing_umi})", file=output)
+
+    if args["--read-groups"] and xow is not None:
+        table_name = f"{args['--basename']}_read_groups.tsv"
+        with open(table_name, 'w') as table_file:
+            xow.write_table(table_file)
+        print(f"{len(xow.counts)} read groups written to {table_name}",
+              file=output)
+
+    if args["--shard"]:
+        write_counts(pair_counts, counts, f"{args['--basename']}_counts.json")
+
+    if contig_counter is not None:
+        with open(args["--contig-stats"], 'w') as contig_file:
+            contig_counter.write_table(contig_file)
+        print(f"Reference sequence category counts written to "
+              f"{args['--contig-stats']}", file=output)
+
+    if score_histogram is not None:
+        with open(args["--score-histograms"], 'w') as histogram_file:
+            if args["--score-histograms"].endswith('.json'):
+                score_histogram.write_json(histogram_file)
+            else:
+                score_histogram.write_tsv(histogram_file)
+        print(f"Score histograms written to {args['--score-histograms']}",
+              file=output)
+
+    if tuner is not None:
+        print(tuner.summary(), file=output)
+
+    if batch_limits['max_secondary'] is not None:
+        print(f"{primary_bam.discarded_secondary} primary and "
+              f"{secondary_bam.discarded_secondary} secondary genome "
+              "secondary alignments discarded by --max-secondary",
+              file=output)
 
     output_summary(category_counts=pair_counts,
                    title='Read Category Summary',
                    outfile=output)
     output_summary(category_counts=counts,
                    title='Read Pair Category Summary',
-                   outfile=output)
+                   outfile=output,
+                   intervals=intervals)
 
     end_time = time.time()
 
+    if intervals is not None:
+        print(f'Estimated from a random sample of templates with '
+              f'{float(args["--confidence"] or 0.95):.0%} '
+              f'Wilson score intervals', file=output)
+
     print(f'\n\nTotal templates assigned : {sum(pair_counts.values())} '
           f'in {end_time-start_time:.2f}s\n',
           file=output)
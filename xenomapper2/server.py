@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+server.py
+
+A persistent xenomapper2 server for running many small jobs. The server keeps
+a pool of worker processes with xenomapper2 already imported and accepts jobs
+(the command line options of a xenomapper2 run) from clients over a local
+Unix domain socket. Jobs from different client connections are dispatched
+round robin so a client submitting many jobs does not hold up others.
+
+The protocol is one JSON request line per connection:
+
+    {"cwd": "/path/for/relative/filenames",
+     "jobs": [["--primary=a.bam", "--secondary=b.bam", "--basename=c"], ...]}
+
+answered by one JSON summary line per job as the jobs finish (see run_job).
+
+Created by Matthew Wakefield.
+Copyright (c) 2011-2020  Matthew Wakefield
+The Walter and Eliza Hall Institute and The University of Melbourne.
+All rights reserved.
+
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+
+"""
+
+import io, json, os, queue, socket, socketserver, stat, threading, time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count
+from typing import List, Iterable, Generator
+
+__author__ = "Matthew Wakefield"
+__copyright__ = ("Copyright 2018-2020 Matthew Wakefield"
+                 "The Walter and Eliza Hall Institute and "
+                 "The University of Melbourne")
+__credits__ = ["Matthew Wakefield",]
+__license__ = "BSD-3-Clause"
+__version__ = "2.0rc1"
+__maintainer__ = "Matthew Wakefield"
+__email__ = "wakefield@wehi.edu.au"
+__status__ = "Development/Beta"
+
+# the subcommands that can be run as jobs. Others do not return category
+# counts, and serve and submit would block a worker
+JOB_COMMANDS = ('merge',)
+
+
+def run_job(arguments: List[str], cwd: str = None) -> dict:
+    """Run one xenomapper2 job and summarise the result
+
+    Parameters
+    ----------
+    arguments : List[str]
+        the command line options of a classification run or of a
+        subcommand in JOB_COMMANDS (as for cli.main). Other subcommands
+        are reported as errors without being run
+    cwd : str, optional
+        directory that relative filenames are relative to. The working
+        directory is restored after the job as workers are reused
+
+    Returns
+    -------
+    dict
+        'arguments', 'status' ('ok' or 'error'), 'seconds' and 'log' (the
+        progress and summary text of the run), with 'pair_counts' and
+        'counts' for successful runs or 'error' describing the failure.
+        pair_counts are keyed by the forward and reverse states joined by
+        ' & ' as in the run summary.
+    """
+    from docopt import docopt
+    from xenomapper2 import cli
+    start_time = time.time()
+    log = io.StringIO()
+    summary = {'arguments': list(arguments)}
+    previous_cwd = os.getcwd()
+    try:
+        args = docopt(cli.__doc__, argv=list(arguments))
+        commands = [key for key, value in args.items()
+                    if value is True and key[0] not in '-<.']
+        if commands and commands[0] not in JOB_COMMANDS:
+            raise ValueError(f"xenomapper2 {commands[0]} can not be run as a "
+                             f"server job, only classification runs and "
+                             f"{', '.join(JOB_COMMANDS)}")
+        if cwd is not None:
+            os.chdir(cwd)
+        pair_counts, counts = cli.main(list(arguments), output=log)
+    except SystemExit:
+        # docopt exits with the usage message for invalid options
+        summary.update({'status': 'error',
+                        'error': "Invalid xenomapper2 options"})
+    except Exception as error:
+        summary.update({'status': 'error',
+                        'error': str(error) or type(error).__name__})
+    else:
+        summary.update({'status': 'ok',
+                        'pair_counts': {' & '.join(map(str, states)): n
+                                        for states, n in pair_counts.items()},
+                        'counts': dict(counts),
+                        })
+    finally:
+        os.chdir(previous_cwd)
+    summary['seconds'] = time.time() - start_time
+    summary['log'] = log.getvalue()
+    return summary
+
+
+def _remove_stale_socket(socket_path: str):
+    # remove a socket file left by a server that is no longer running
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError(f"{socket_path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+            return
+    raise ValueError(f"A server is already listening on {socket_path}")
+
+
+def _warm_up():
+    from xenomapper2 import cli
+    return os.getpid()
+
+
+class FairScheduler():
+    """Queue jobs from several clients and release them round robin
+
+    Each get() returns the next job of the client after the one last served,
+    so every client with queued jobs has one running in turn.
+    """
+
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, client, job):
+        """Queue a job for a client (any hashable identifier)"""
+        with self._condition:
+            self._queues.setdefault(client, deque()).append(job)
+            self._condition.notify()
+
+    def get(self):
+        """Remove and return the next job, waiting until one is queued
+
+        Returns
+        -------
+        the job or None once the scheduler is closed
+        """
+        with self._condition:
+            while not self._queues and not self._closed:
+                self._condition.wait()
+            if not self._queues:
+                return None
+            client, jobs = next(iter(self._queues.items()))
+            job = jobs.popleft()
+            if jobs:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            return job
+
+    def cancel(self, client):
+        """Remove all queued jobs of a client"""
+        with self._condition:
+            self._queues.pop(client, None)
+
+    def close(self):
+        """Release waiting get() calls with None"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __len__(self):
+        with self._condition:
+            return sum(len(jobs) for jobs in self._queues.values())
+
+
+class _JobRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            jobs = request['jobs']
+            cwd = request.get('cwd')
+            if isinstance(jobs, (str, bytes)) or not all(
+                    isinstance(job, list) for job in jobs):
+                raise ValueError("jobs must be a list of argument lists")
+        except (ValueError, KeyError, TypeError) as error:
+            self._send({'status': 'error', 'error': f"Bad request: {error}"})
+            return
+        client = next(self.server.client_ids)
+        results = queue.Queue()
+        for number, arguments in enumerate(jobs):
+            self.server.scheduler.put(client, (number, arguments, cwd,
+                                               results))
+        try:
+            for _ in jobs:
+                self._send(results.get())
+        except OSError:
+            # the client has gone so drop its queued jobs
+            self.server.scheduler.cancel(client)
+
+    def _send(self, summary: dict):
+        self.wfile.write(json.dumps(summary).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class XenomapperServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """A Unix domain socket server running xenomapper2 jobs on warm workers
+
+    Parameters
+    ----------
+    socket_path : str
+        filename for the socket, which is created readable and writable only
+        by its owner. A socket file left by a server that is no longer
+        running is replaced
+    workers : int
+        number of worker processes and so of concurrent jobs [ Default : 2 ]
+
+    Raises
+    ------
+    ValueError
+        if socket_path is a file that is not a socket, or a server is
+        listening on it
+
+    Examples
+    --------
+    >>> with XenomapperServer('/tmp/xenomapper2.sock', workers=4) as server:
+    >>>     server.serve_forever()
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, workers: int = 2):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        _remove_stale_socket(socket_path)
+        super().__init__(socket_path, _JobRequestHandler)
+        self.socket_path = socket_path
+        self.workers = workers
+        self.scheduler = FairScheduler()
+        self.client_ids = count()
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        # start the workers and import xenomapper2 before the first job
+        for future in [self.pool.submit(_warm_up) for _ in range(workers)]:
+            future.result()
+        self._slots = threading.Semaphore(workers)
+        self._dispatcher = threading.Thread(target=self._dispatch,
+                                            daemon=True)
+        self._dispatcher.start()
+
+    def server_bind(self):
+        # create the socket file with mode 0600
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def _dispatch(self):
+        while True:
+            self._slots.acquire()
+            job = self.scheduler.get()
+            if job is None:
+                self._slots.release()
+                return
+            number, arguments, cwd, results = job
+            future = self.pool.submit(run_job, arguments, cwd)
+            future.add_done_callback(
+                lambda future, number=number, results=results:
+                    self._finish(future, number, results))
+
+    def _finish(self, future, number: int, results: queue.Queue):
+        self._slots.release()
+        try:
+            summary = future.result()
+        except Exception as error:
+            summary = {'status': 'error', 'error': str(error)}
+        summary['job'] = number
+        results.put(summary)
+
+    def server_close(self):
+        super().server_close()
+        self.scheduler.close()
+        self.pool.shutdown()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def submit_jobs(socket_path: str,
+                jobs: Iterable[List[str]],
+                cwd: str = None,
+                ) -> Generator[dict, None, None]:
+    """Submit jobs to a XenomapperServer and yield their summaries
+
+    Parameters
+    ----------
+    socket_path : str
+        the socket of a running server
+    jobs : Iterable[List[str]]
+        the command line options of each job
+    cwd : str, optional
+        directory for relative filenames [ Default : the current directory ]
+
+    Yields
+    ------
+    dict
+        the summary of each job from run_job as it finishes, with 'job' the
+        position of the job in jobs
+    """
+    jobs = [list(job) for job in jobs]
+    request = {'cwd': os.getcwd() if cwd is None else cwd, 'jobs': jobs}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with connection.makefile('rb') as responses:
+            for line in responses:
+                yield json.loads(line.decode('utf-8'))
@@ -9,8 +9,19 @@ Copyright (c) 2011-2020 Matthew Wakefield and The Walter and Eliza Hall Institut
 
 import gzip
 import io
+import json
+import os
+import shlex
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import types
 import unittest
 import warnings
+import zlib
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 from hashlib import sha256
 from itertools import combinations, permutations
@@ -20,7 +31,9 @@ import docopt
 
 
 from xenomapper2.xenomapper2 import *
+from xenomapper2.xenomapper2 import _SortedUint64Runs
 from xenomapper2 import cli
+from xenomapper2.server import *
 
 
 __author__ = "Matthew Wakefield"
@@ -90,6 +103,119 @@ class test_main(unittest.TestCase):
         self.assertEqual(get_max_AS_XS(BAMPAIR1), (198, 126))
         self.assertEqual(get_max_AS_XS([]), (-2147483648, -2147483648))
 
+    def test_AlignBatch(self):
+        batch = AlignBatch(BAMPAIR1)
+        self.assertEqual(batch, BAMPAIR1)
+        self.assertEqual(batch.name, b'HWI-ST960:96:COTO3ACXX:3:1101:1220:2089\x00')
+        self.assertEqual(batch.flags, [bam.get_flag(a) for a in BAMPAIR1])
+        self.assertEqual(split_forward_reverse(batch),
+                         split_forward_reverse(BAMPAIR1))
+        forward, reverse = split_forward_reverse(batch)
+        self.assertIsInstance(forward, AlignBatch)
+        self.assertEqual(get_bamprimary_AS_XS(forward), (198, 126))
+        self.assertEqual(get_bamprimary_AS_XS(reverse), (189, 50))
+        self.assertEqual(get_max_AS_XS(batch), get_max_AS_XS(BAMPAIR1))
+        self.assertEqual(get_max_AS_XS(batch, XS_function=get_ZS),
+                         (198, -2147483648))
+        self.assertEqual(batch.score(0, get_cigar_based_score),
+                         get_cigar_based_score(BAMPAIR1[0]))
+        self.assertRaises(ValueError, get_bamprimary_AS_XS, batch)
+        self.assertEqual(xenomap_states(batch, AlignBatch(BAMPAIR1)),
+                         xenomap_states(BAMPAIR1, BAMPAIR1))
+
+    def _multimapping_bam(self, n_secondary):
+        """An uncompressed BAM stream with a template of many secondaries"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            ubam = gzip.open(resource_filename(__name__,
+                                   'data/paired_end_testdata_human.bam'))
+        reader = bam.FileReader(ubam)
+        header_length = ubam.tell()
+        ubam.seek(0)
+        header = ubam.read(header_length)
+        ubam.close()
+        forward, reverse = BAMPAIR1
+        secondary = bytearray(forward)
+        secondary[18:20] = struct.pack('<H', 0x100 | bam.get_flag(forward))
+        return io.BytesIO(header + forward
+                          + bytes(secondary) * n_secondary + reverse)
+
+    def test_get_max_AS_XS_memory(self):
+        secondaries = (BAMPAIR1[0] for i in range(100000))
+        tracemalloc.start()
+        self.assertEqual(get_max_AS_XS(secondaries), (198, 126))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(peak, 2**16)
+
+    def test_AlignbatchFileReader_spill(self):
+        n_secondary = 20000
+        batch_bytes = len(self._multimapping_bam(n_secondary).getvalue())
+        reader = AlignbatchFileReader(self._multimapping_bam(n_secondary),
+                                      spill_records=1000)
+        tracemalloc.start()
+        batch = next(reader)
+        forward, reverse = split_forward_reverse(batch)
+        scores = (get_bamprimary_AS_XS(forward), get_max_AS_XS(forward),
+                  get_bamprimary_AS_XS(reverse))
+        state = xenomap_states(batch, batch)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertIsInstance(batch, SpilledAlignBatch)
+        self.assertEqual(len(batch), n_secondary + 2)
+        self.assertEqual(len(forward), n_secondary + 1)
+        self.assertEqual(list(reverse), BAMPAIR1[1:])
+        self.assertEqual(scores, ((198, 126), (198, 126), (189, 50)))
+        self.assertEqual(state, xenomap_states(BAMPAIR1, BAMPAIR1))
+        self.assertLess(peak, batch_bytes // 4)
+        self.assertRaises(StopIteration, next, reader)
+        self.assertTrue(batch._file.closed)
+        unspilled = next(AlignbatchFileReader(self._multimapping_bam(5),
+                                              spill_records=1000))
+        self.assertIsInstance(unspilled, AlignBatch)
+        self.assertEqual(list(unspilled),
+                         list(AlignbatchFileReader(self._multimapping_bam(5),
+                                                   spill_records=0).__next__()))
+
+    def test_SpilledAlignBatch_close(self):
+        with SpilledAlignBatch(BAMPAIR1[0][36:36 + BAMPAIR1[0][12]]) as batch:
+            batch.extend(BAMPAIR1)
+            forward, reverse = batch.split_forward_reverse()
+            self.assertEqual(list(reverse), BAMPAIR1[1:])
+        self.assertTrue(batch._file.closed)
+        self.assertTrue(forward._file.closed)
+        # the reader closes a spilled batch when the next batch is read
+        stream = self._multimapping_bam(10)
+        stream.seek(0, io.SEEK_END)
+        stream.write(b''.join(BAMPAIR42))
+        stream.seek(0)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", ResourceWarning)
+            reader = AlignbatchFileReader(stream, spill_records=5)
+            spilled = next(reader)
+            self.assertIsInstance(spilled, SpilledAlignBatch)
+            self.assertFalse(spilled._file.closed)
+            self.assertEqual(list(next(reader)), BAMPAIR42)
+            self.assertTrue(spilled._file.closed)
+            # and when a reader is discarded part way through a batch
+            stream.seek(0)
+            reader = AlignbatchFileReader(stream, spill_records=5)
+            spilled = next(reader)
+            reader.alignment_batches.close()
+            self.assertTrue(spilled._file.closed)
+
+    def test_AlignbatchFileReader_max_secondary(self):
+        reader = AlignbatchFileReader(self._multimapping_bam(20000),
+                                      max_secondary=10)
+        tracemalloc.start()
+        batch = next(reader)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(len(batch), 12)
+        self.assertEqual(reader.discarded_secondary, 19990)
+        self.assertEqual(batch[-1], BAMPAIR1[1])
+        self.assertLess(peak, 2**17)
+
     def test_calc_cigar_based_score(self):
         input_and_output = [(('*', None), -2147483648),
                             (('50M',0),0),
@@ -182,6 +308,536 @@ class test_main(unittest.TestCase):
                 for key in xow.keys():
                     xow[key].write('foo')
 
+    def test_ReadGroupOutputWriter(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                # tag templates with one of three read groups in both genomes
+                # with different IDs in the secondary genome
+                tagged = {}
+                for genome, filename, prefix in (('human', prime, ''),
+                                                 ('mouse', second, 'm')):
+                    reader = AlignbatchFileReader(gzip.open(filename))
+                    tagged[genome] = f'{tempd}/{genome}_rg.bam'
+                    with bam.FileWriter(tagged[genome]) as writer:
+                        writer.raw_header = reader.raw_header
+                        writer.raw_refs = reader.raw_refs
+                        writer.write_header()
+                        for i, batch in enumerate(reader):
+                            if i % 3:
+                                writer.write(add_category_tag(
+                                    batch,
+                                    f'RGZ{prefix}lib{i % 3}\0'.encode()))
+                            else:
+                                writer.write(b''.join(batch))
+                    reader.close()
+
+                output = io.StringIO()
+                cli.main(f"--primary {tagged['human']} "
+                         f"--secondary {tagged['mouse']} "
+                         f"--basename {tempd}/split --read-groups "
+                         f"--max-open-read-groups 1 --fastq unresolved",
+                         output)
+                self.assertIn('3 read groups written', output.getvalue())
+                with open(f'{tempd}/split_read_groups.tsv') as table:
+                    rows = [line.split('\t') for line in table]
+                self.assertEqual(rows[0][:2], ['read_group', 'name'])
+                self.assertEqual({row[0] for row in rows[1:]},
+                                 {'lib1', 'lib2', NO_READ_GROUP})
+                self.assertEqual(sum(int(n) for row in rows[1:]
+                                     for n in row[2:]), 238)
+
+                cli.main(f"--primary {tagged['human']} "
+                         f"--secondary {tagged['mouse']} "
+                         f"--basename {tempd}/whole", io.StringIO())
+                for category in CATEGORIES:
+                    if category == 'unresolved':
+                        continue
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/whole_{category}.bam')) as whole:
+                        expected = list(whole)
+                    split = []
+                    for read_group in ('lib1', 'lib2', NO_READ_GROUP):
+                        name = f'{tempd}/split_{read_group}_{category}.bam'
+                        with open(name, 'rb') as raw:
+                            data = raw.read()
+                        # suspended files are appended without EOF blocks
+                        self.assertEqual(data.count(BGZF_EOF), 1)
+                        self.assertTrue(data.endswith(BGZF_EOF))
+                        with bam.FileReader(gzip.open(name)) as reader:
+                            aligns = list(reader)
+                        # secondary templates follow their primary read group
+                        if read_group == NO_READ_GROUP:
+                            tag = None
+                        elif category.startswith('secondary'):
+                            tag = f'm{read_group}'
+                        else:
+                            tag = read_group
+                        self.assertTrue(all(
+                            get_str_tag(get_tag_bytes(a), b'RG') == tag
+                            for a in aligns))
+                        split.extend(aligns)
+                    self.assertEqual(sorted(split), sorted(expected))
+                self.assertTrue(Path(
+                    f'{tempd}/split_lib1_unresolved_R1.fastq.gz').exists())
+
+                # read groups with the same filename safe name
+                with AlignbatchFileReader(gzip.open(prime)) as reader:
+                    batches = list(islice(reader, 4))
+                with ReadGroupOutputWriter(reader.raw_header, reader.raw_refs,
+                                           reader.raw_header, reader.raw_refs,
+                                           basename=f'{tempd}/clash',
+                                           max_open=1) as writer:
+                    for batch, read_group in zip(batches, ('A:B', 'A_B',
+                                                           'A:B', 'A_B')):
+                        tag = f'RGZ{read_group}\0'.encode()
+                        writer.write_alignbatch('primary_specific',
+                                                [add_category_tag([align], tag)
+                                                 for align in batch])
+                self.assertEqual(writer.names['A:B'], 'A_B')
+                self.assertNotEqual(writer.names['A_B'], 'A_B')
+                for read_group, name in writer.names.items():
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/clash_{name}_primary_specific.bam')
+                            ) as result:
+                        self.assertEqual([get_str_tag(get_tag_bytes(a), b'RG')
+                                          for a in result],
+                                         [read_group] * 4)
+                table = io.StringIO()
+                writer.write_table(table)
+                self.assertIn(f"A_B\t{writer.names['A_B']}\t2\t",
+                              table.getvalue())
+
+                self.assertRaises(ValueError, cli.main,
+                    f"--primary {prime} --secondary {second} "
+                    f"--basename {tempd}/split --read-groups --sort",
+                    io.StringIO())
+
+    def test_TaggedOutputWriter(self):
+        self.assertEqual(add_category_tag([BAMPAIR1[0][:36]], b'XCZa\x00'),
+                         struct.pack('<i', 37) + BAMPAIR1[0][4:36]
+                         + b'XCZa\x00')
+        # an existing tag of the same name (eg BWA XC:i) is replaced
+        others = (b'ZZZXC\x00' + b'BBBS' + struct.pack('<i2H', 2, 1, 2)
+                  + b'YYi' + struct.pack('<i', 7))
+        bwa = BAMPAIR1[0] + b'XCi' + struct.pack('<i', 76) + others
+        tagged = add_category_tag([bwa, BAMPAIR1[0]], b'XCZa\x00')
+        expected = [BAMPAIR1[0] + others + b'XCZa\x00',
+                    BAMPAIR1[0] + b'XCZa\x00']
+        self.assertEqual(tagged, b''.join(struct.pack('<i', len(a) - 4) + a[4:]
+                                          for a in expected))
+        self.assertEqual(get_str_tag(get_tag_bytes(tagged[:len(expected[0])]),
+                                     b'XC'), 'a')
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                for options in ('', '--tagged'):
+                    cli.main(f"--primary {prime} --secondary {second} "
+                             f"--basename {tempd}/out {options}",
+                             io.StringIO())
+                tagged = {}
+                for genome in ('primary', 'secondary'):
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/out_{genome}.bam')) as tagged_bam:
+                        self.assertIn(f'DS:{genome} tagged', tagged_bam.header)
+                        for align in tagged_bam:
+                            category = get_str_tag(get_tag_bytes(align), b'XC')
+                            tagged.setdefault(category, []).append(align)
+                for category in CATEGORIES:
+                    tag = b'XCZ' + category.encode() + b'\x00'
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/out_{category}.bam')) as category_bam:
+                        self.assertEqual(b''.join(tagged[category]),
+                                         add_category_tag(category_bam, tag))
+            xow = TaggedOutputWriter(b'', b'', b'', b'')
+            self.assertEqual(xow.requested, set())
+            xow.write_alignbatch('primary_specific', BAMPAIR1)
+            xow.close()
+
+    def test_BufferedCategorySink(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            with TemporaryDirectory() as tempd:
+                xow = XenomapperOutputWriter(b"p", b"pr", b"s", b"sr",
+                                    primary_specific=f'{tempd}/buffered.bam')
+                self.assertIsInstance(xow['primary_specific'],
+                                      BufferedCategorySink)
+                self.assertEqual(xow['primary_specific'].name,
+                                 f'{tempd}/buffered.bam')
+                direct = bam.FileWriter(f'{tempd}/direct.bam')
+                for i in range(200):
+                    xow.write_alignbatch('primary_specific', BAMPAIR1)
+                    xow.write_alignbatch('primary_multi', BAMPAIR1)
+                    for align in BAMPAIR1:
+                        direct.write(align)
+                xow.close()
+                direct.close()
+                alignments = b''.join(BAMPAIR1) * 200
+                with gzip.open(f'{tempd}/buffered.bam') as buffered:
+                    self.assertEqual(buffered.read()[-len(alignments):],
+                                     alignments)
+                with gzip.open(f'{tempd}/direct.bam') as unbuffered:
+                    self.assertEqual(unbuffered.read(), alignments)
+
+    def test_get_fastq_record(self):
+        record = get_fastq_record(BAMPAIR1[0]).split(b'\n')
+        self.assertEqual(record[0], b'@HWI-ST960:96:COTO3ACXX:3:1101:1220:2089')
+        self.assertEqual(record[2], b'+')
+        self.assertEqual(record[4], b'')
+        # BAMPAIR1[0] has flag 83 so is reverse complemented relative to BAM
+        forward_seq = get_fastq_record(BAMPAIR1[0]).split(b'\n')[1]
+        bam_seq = decode_sequence(get_raw_sequence(BAMPAIR1[0],
+                                  get_len_read_name(BAMPAIR1[0]),
+                                  get_number_cigar_operations(BAMPAIR1[0]),
+                                  get_len_sequence(BAMPAIR1[0])))
+        self.assertEqual(forward_seq[::-1].translate(
+                         bytes.maketrans(b'ACGT', b'TGCA')).decode(),
+                         bam_seq[:get_len_sequence(BAMPAIR1[0])])
+        record = get_fastq_record(BAMPAIR1[1]).split(b'\n')
+        self.assertEqual(len(record[1]), get_len_sequence(BAMPAIR1[1]))
+        self.assertEqual(record[3],
+                         decode_base_qual(get_raw_base_qual(BAMPAIR1[1],
+                                  get_len_read_name(BAMPAIR1[1]),
+                                  get_number_cigar_operations(BAMPAIR1[1]),
+                                  get_len_sequence(BAMPAIR1[1]))).encode())
+
+    def test_get_fastq_pair_names(self):
+        self.assertEqual(get_fastq_pair_names('foo.fastq.gz'),
+                         ('foo_R1.fastq.gz', 'foo_R2.fastq.gz'))
+        self.assertEqual(get_fastq_pair_names('foo.fq'),
+                         ('foo_R1.fq', 'foo_R2.fq'))
+        self.assertEqual(get_fastq_pair_names('foo'),
+                         ('foo_R1', 'foo_R2'))
+
+    def test_XenomapperOutputWriter_fastq(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                cli.main(f"--primary {prime} --secondary {second} "
+                         f"--basename {tempd}/foo --fastq primary_specific",
+                         io.StringIO())
+                with gzip.open(f'{tempd}/foo_primary_specific_R1.fastq.gz') as r1:
+                    r1_lines = r1.read().split(b'\n')
+                with gzip.open(f'{tempd}/foo_primary_specific_R2.fastq.gz') as r2:
+                    r2_lines = r2.read().split(b'\n')
+                self.assertEqual(len(r1_lines) // 4, 134)
+                self.assertEqual(len(r2_lines) // 4, 134)
+                self.assertEqual(r1_lines[0::4][:134], r2_lines[0::4][:134])
+                cli.main(f"--primary {prime} --secondary {second} "
+                         f"--basename {tempd}/bar --fastq all --interleaved",
+                         io.StringIO())
+                with gzip.open(f'{tempd}/bar_secondary_specific.fastq.gz') as fq:
+                    self.assertEqual(len(fq.read().split(b'\n')) // 4, 89 * 2)
+            self.assertRaises(ValueError, XenomapperOutputWriter,
+                              *(b"p", b"pr", b"s", b"sr"),
+                              **{'fastq':['foo']})
+            self.assertRaises(ValueError, XenomapperOutputWriter,
+                              *(b"p", b"pr", b"s", b"sr"),
+                              **{'primary_specific':io.BytesIO(),
+                                 'fastq':['primary_specific']})
+
+    def test_ScoreHistogram(self):
+        self.assertEqual(xenomap_scores(BAMPAIR1, BAMPAIR1),
+                         ((198, 126, 198, 126), (189, 50, 189, 50)))
+        histogram = ScoreHistogram(min_value=-10, max_value=10)
+        histogram.add('unresolved', (198, 126, 198, 126),
+                      (189, MIN32INT, -20, 50))
+        self.assertEqual(histogram.histogram('AS_delta', 'forward',
+                                             'unresolved'), {0: 1})
+        self.assertEqual(histogram.histogram('AS_delta', 'reverse',
+                                             'unresolved'), {10: 1})
+        self.assertEqual(histogram.histogram('primary_margin', 'reverse',
+                                             'unresolved'), {None: 1})
+        self.assertEqual(histogram.histogram('secondary_AS', 'reverse',
+                                             'unresolved'), {-10: 1})
+        output = io.StringIO()
+        histogram.write_tsv(output)
+        self.assertIn('primary_margin\treverse\tunresolved\tNA\t1',
+                      output.getvalue())
+        output = io.StringIO()
+        histogram.write_json(output)
+        self.assertEqual(json.loads(output.getvalue())['histograms']
+                         ['AS_delta']['reverse']['unresolved'], {'10': 1})
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                pair_counts, counts = cli.main(f"--primary {prime} "
+                                               f"--secondary {second} "
+                                               f"--score-histograms "
+                                               f"{tempd}/h.tsv",
+                                               io.StringIO())
+                with open(f'{tempd}/h.tsv') as table:
+                    rows = [line.rstrip('\n').split('\t')
+                            for line in table][1:]
+        self.assertEqual(counts['primary_specific'], 134)
+        for category in CATEGORIES:
+            self.assertEqual(sum(int(row[4]) for row in rows
+                                 if row[:3] == ['primary_AS', 'forward',
+                                                category]),
+                             counts[category])
+
+    def test_ContigCategoryCounter(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                pair_counts, counts = cli.main(f"--primary {prime} "
+                                               f"--secondary {second} "
+                                               f"--contig-stats {tempd}/c.tsv",
+                                               io.StringIO())
+                with open(f'{tempd}/c.tsv') as table:
+                    rows = [line.rstrip('\n').split('\t') for line in table]
+            self.assertEqual(rows[0], ['genome', 'reference', 'length',
+                                       *CATEGORIES])
+            for genome in ('primary', 'secondary'):
+                totals = [sum(int(row[3 + i]) for row in rows[1:]
+                              if row[0] == genome)
+                          for i in range(len(CATEGORIES))]
+                # each template has a forward and reverse primary alignment
+                self.assertEqual(totals, [2 * counts[c] for c in CATEGORIES])
+            refs = {f'chr{i}': 100 for i in range(13)}
+            counter = ContigCategoryCounter(refs, refs)
+            counter.add('primary_specific', AlignBatch(BAMPAIR1), [])
+            counter.add('unassigned', [], BAMPAIR1)
+            self.assertEqual(counter.counts('primary', 'chr12')
+                             ['primary_specific'], 2)
+            self.assertEqual(counter.counts('secondary', 'chr12')
+                             ['unassigned'], 2)
+            self.assertEqual(sum(counter.counts('primary', '*').values()), 0)
+            self.assertRaises(ValueError, counter.counts, 'tertiary', '*')
+            output = io.StringIO()
+            counter.write_table(output)
+            self.assertEqual(len(output.getvalue().splitlines()), 29)
+            self.assertIn('secondary\tchr12\t100\t0\t0\t0\t0\t0\t2',
+                          output.getvalue())
+
+    def test_BarcodeCategoryCounter(self):
+        cell1 = [BAMPAIR1[0] + b'CBZAAACCT-1\x00UBZGGTT\x00', BAMPAIR1[1]]
+        cell1_dup = [BAMPAIR1[0] + b'CBZAAACCT-1\x00UBZGGTT\x00']
+        cell1_umi2 = [BAMPAIR1[0] + b'CBZAAACCT-1\x00UBZCCAA\x00']
+        cell2 = [BAMPAIR42[0] + b'CBZTTTGGA-1\x00UBZGGTT\x00']
+        counter = BarcodeCategoryCounter()
+        counter.add('primary_specific', cell1)
+        counter.add('primary_specific', cell1_dup)
+        counter.add('secondary_specific', cell2)
+        counter.add('primary_specific', cell2)
+        counter.add('unresolved', BAMPAIR1)
+        self.assertEqual(len(counter), 2)
+        self.assertEqual(counter.missing, 1)
+        self.assertEqual(counter.counts('AAACCT-1')['primary_specific'], 2)
+        self.assertEqual(counter.species_call('AAACCT-1'), 'primary')
+        self.assertEqual(counter.species_call('TTTGGA-1'), 'mixed')
+        umi_counter = BarcodeCategoryCounter(b'CB', b'UB')
+        for batch in (cell1, cell1_dup, cell1_umi2):
+            umi_counter.add('primary_specific', batch)
+        umi_counter.add('unassigned', cell2)
+        self.assertEqual(umi_counter.counts('AAACCT-1')['primary_specific'], 2)
+        self.assertEqual(umi_counter.species_call('TTTGGA-1'), 'unassigned')
+        matrix = io.StringIO()
+        umi_counter.write_matrix(matrix)
+        self.assertEqual(matrix.getvalue().split('\n'),
+            ['barcode\tprimary_specific\tprimary_multi\tsecondary_specific'
+             '\tsecondary_multi\tunresolved\tunassigned\tcall',
+             'AAACCT-1\t2\t0\t0\t0\t0\t0\tprimary',
+             'TTTGGA-1\t0\t0\t0\t0\t0\t1\tunassigned',
+             ''])
+        # UMIs are kept per barcode and category and missing UMIs are
+        # counted separately rather than as one shared UMI
+        cell1_no_umi = [BAMPAIR1[0] + b'CBZAAACCT-1\x00']
+        cell3_no_umi = [BAMPAIR42[0] + b'CBZCCCGGG-1\x00']
+        umi_counter = BarcodeCategoryCounter(b'CB', b'UB')
+        for category, batch in (('primary_specific', cell1),
+                                ('primary_specific', cell1_dup),
+                                ('primary_specific', cell1_umi2),
+                                ('primary_multi', cell1_dup),
+                                ('primary_multi', cell1_dup),
+                                ('secondary_specific', cell1_umi2),
+                                ('primary_specific', cell1_no_umi),
+                                ('primary_specific', cell1_no_umi),
+                                ('secondary_specific', cell2),
+                                ('secondary_specific', cell2),
+                                ('unresolved', cell3_no_umi),
+                                ('unresolved', BAMPAIR1)):
+            umi_counter.add(category, batch)
+        self.assertEqual(umi_counter.counts('AAACCT-1'),
+                         {'primary_specific': 2, 'primary_multi': 1,
+                          'secondary_specific': 1, 'secondary_multi': 0,
+                          'unresolved': 0, 'unassigned': 0})
+        self.assertEqual(umi_counter.counts('TTTGGA-1')['secondary_specific'],
+                         1)
+        self.assertEqual(umi_counter.missing_umi, 3)
+        self.assertEqual(umi_counter.missing, 1)
+        self.assertEqual(len(umi_counter), 2)
+        # UMI keys are deduplicated from sorted runs spilled to disk,
+        # including UMIs that are hashed rather than packed
+        with TemporaryDirectory() as tempd:
+            umi_counter = BarcodeCategoryCounter(b'CB', b'UB', tmpdir=tempd)
+            umi_counter._umi_keys = _SortedUint64Runs(run_values=4,
+                                                      max_runs=2,
+                                                      tmpdir=tempd)
+            umis = [b'GGTT', b'GGTTA', b'AGGTT', b'GGNT', b'GGTTNN',
+                    b'ACGT' * 5, b'ACGT' * 5 + b'A']
+            for umi in umis * 3:
+                umi_counter.add('primary_specific',
+                                [BAMPAIR1[0] + b'CBZAAACCT-1\x00UBZ'
+                                 + umi + b'\x00'])
+            self.assertEqual(len(umi_counter._umi_keys._spilled_runs), 1)
+            self.assertEqual(umi_counter.counts('AAACCT-1')
+                             ['primary_specific'], len(umis))
+            umi_counter.add('primary_specific',
+                            [BAMPAIR1[0] + b'CBZAAACCT-1\x00UBZGGTT\x00'])
+            umi_counter.add('primary_specific',
+                            [BAMPAIR1[0] + b'CBZAAACCT-1\x00UBZGGTA\x00'])
+            self.assertEqual(umi_counter.counts('AAACCT-1')
+                             ['primary_specific'], len(umis) + 1)
+
+    def test_reg2bin(self):
+        self.assertEqual(reg2bin(0, 1), 4681)
+        self.assertEqual(reg2bin(16384, 16385), 4682)
+        self.assertEqual(reg2bin(0, 16385), 585)
+        self.assertEqual(reg2bin(0, 2**29), 0)
+
+    def test_set_coordinate_sort_order(self):
+        def raw(text):
+            return struct.pack('<i', len(text)) + text
+        self.assertEqual(set_coordinate_sort_order(
+                             raw(b'@HD\tVN:1.0\tSO:unsorted\n@SQ\n')),
+                         raw(b'@HD\tVN:1.0\tSO:coordinate\n@SQ\n'))
+        self.assertEqual(set_coordinate_sort_order(raw(b'@HD\tVN:1.0\n')),
+                         raw(b'@HD\tVN:1.0\tSO:coordinate\n'))
+        self.assertEqual(set_coordinate_sort_order(raw(b'@SQ\n')),
+                         raw(b'@HD\tVN:1.6\tSO:coordinate\n@SQ\n'))
+
+    def test_SortedBamFileWriter(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                for name, options in (('unsorted', ''),
+                                      ('sorted', '--sort'),
+                                      ('spilled', '--sort --sort-memory 0')):
+                    cli.main(f"--primary {prime} --secondary {second} "
+                             f"--basename {tempd}/{name} {options}",
+                             io.StringIO())
+                for category in CATEGORIES:
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/unsorted_{category}.bam')) as unsorted:
+                        unsorted_aligns = list(unsorted)
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/sorted_{category}.bam')) as sorted_bam:
+                        self.assertEqual(sorted_bam.sort_order, 'coordinate')
+                        sorted_aligns = list(sorted_bam)
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/spilled_{category}.bam')) as spilled:
+                        self.assertEqual(list(spilled), sorted_aligns)
+                    self.assertEqual(sorted(unsorted_aligns), sorted(sorted_aligns))
+                    self.assertEqual(sorted_aligns,
+                                     sorted(unsorted_aligns,
+                                            key=coordinate_sort_key))
+                    with open(f'{tempd}/sorted_{category}.bam.bai', 'rb') as bai:
+                        index = bai.read()
+                    self.assertEqual(index[:4], b'BAI\x01')
+                    # the pseudo-bins hold mapped and unmapped counts per ref
+                    counts = [struct.unpack('<QQ', index[m.end() + 16:m.end() + 32])
+                              for m in re.finditer(struct.pack('<Ii', 37450, 2),
+                                                   index)]
+                    placed = [a for a in sorted_aligns if get_ref_index(a) >= 0]
+                    self.assertEqual(sum(sum(c) for c in counts), len(placed))
+                    self.assertEqual(struct.unpack('<Q', index[-8:])[0],
+                                     len(sorted_aligns) - len(placed))
+
+                # spilled runs are merged so few temporary files are open
+                with bam.FileReader(gzip.open(prime)) as reader:
+                    raw_header, raw_refs = reader.raw_header, reader.raw_refs
+                    aligns = list(reader)
+                writer = SortedBamFileWriter(f'{tempd}/merged.bam',
+                                             sort_memory=0, max_runs=3)
+                writer.raw_header = raw_header
+                writer.raw_refs = raw_refs
+                writer.write_header()
+                open_runs = 0
+                for align in aligns:
+                    writer.write(align)
+                    open_runs = max(open_runs, len(writer._spilled_runs))
+                writer.close()
+                self.assertEqual(open_runs, 2)
+                with bam.FileReader(gzip.open(
+                        f'{tempd}/merged.bam')) as merged:
+                    self.assertEqual(list(merged),
+                                     sorted(aligns, key=coordinate_sort_key))
+                self.assertRaises(ValueError, SortedBamFileWriter,
+                                  f'{tempd}/bad.bam', max_runs=1)
+
+    def test_shard_merge(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                shards = cli.main(f"shard --primary {prime} --secondary {second} "
+                                  f"--n-shards 3 --manifest {tempd}/manifest.json",
+                                  io.StringIO())
+                self.assertGreater(len(shards), 1)
+                self.assertIsNone(shards[-1]['primary_end'])
+                for i in range(len(shards)):
+                    cli.main(f"--primary {prime} --secondary {second} "
+                             f"--basename {tempd}/shard{i} "
+                             f"--manifest {tempd}/manifest.json --shard {i}",
+                             io.StringIO())
+                pair_counts, counts = cli.main(
+                    f"merge --basename {tempd}/merged "
+                    + ' '.join(f'{tempd}/shard{i}' for i in range(len(shards))),
+                    io.StringIO())
+                self.assertEqual(list(counts.values()), [134, 89, 7, 6, 1, 1])
+                cli.main(f"--primary {prime} --secondary {second} "
+                         f"--basename {tempd}/full", io.StringIO())
+                for category in CATEGORIES:
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/merged_{category}.bam')) as merged:
+                        merged_aligns = list(merged)
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/full_{category}.bam')) as full:
+                        self.assertEqual(list(full), merged_aligns)
+
+                # sorted shards can not be merged by concatenation
+                self.assertRaises(ValueError, cli.main,
+                                  f"--primary {prime} --secondary {second} "
+                                  f"--basename {tempd}/shard0 --sort "
+                                  f"--manifest {tempd}/manifest.json "
+                                  f"--shard 0", io.StringIO())
+                for i in range(2):
+                    cli.main(f"--primary {prime} --secondary {second} "
+                             f"--basename {tempd}/sorted{i} --sort",
+                             io.StringIO())
+                self.assertRaises(ValueError, merge_shards,
+                                  [f'{tempd}/sorted0', f'{tempd}/sorted1'],
+                                  f'{tempd}/merged_sorted')
+                self.assertEqual(glob.glob(f'{tempd}/merged_sorted*'), [])
+
     def test_get_mapping_state(self):
         very_negative = -2147483648
         inpt_and_outpt = [
@@ -325,6 +981,75 @@ class test_main(unittest.TestCase):
         self.assertEqual(test_outfile.getvalue(), canned_output2)
         pass
 
+    def test_AlignbatchFileChain(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                # split both genomes into three lanes at the same templates
+                lanes = {}
+                for genome, filename in (('human', prime), ('mouse', second)):
+                    reader = AlignbatchFileReader(gzip.open(filename))
+                    batches = list(reader)
+                    lanes[genome] = []
+                    for lane, start in enumerate((0, 100, 200)):
+                        lane_name = f'{tempd}/{genome}_L{lane}.bam'
+                        header = reader.raw_header[4:].rstrip(b'\0')
+                        if lane:
+                            header += f'@RG\tID:L{lane}\n'.encode()
+                        with bam.FileWriter(lane_name) as writer:
+                            writer.raw_header = (struct.pack('<i', len(header))
+                                                 + header)
+                            writer.raw_refs = reader.raw_refs
+                            writer.write_header()
+                            for batch in batches[start:start + 100]:
+                                for align in batch:
+                                    writer.write(align)
+                        lanes[genome].append(lane_name)
+                    reader.close()
+
+                chain = AlignbatchFileChain(lanes['human'])
+                human = AlignbatchFileReader(gzip.open(prime))
+                self.assertEqual(chain.raw_refs, human.raw_refs)
+                self.assertEqual(chain.header.count('@RG\t'), 2)
+                self.assertEqual(list(chain), list(human))
+                chain.close()
+                human.close()
+                self.assertRaises(ValueError, AlignbatchFileChain,
+                                  [lanes['human'][0], lanes['mouse'][1]])
+                self.assertRaises(ValueError, AlignbatchFileChain,
+                                  lanes['human'], track_offsets=True)
+
+                cli.main(f"--primary {prime} --secondary {second} "
+                         f"--basename {tempd}/single", io.StringIO())
+                pair_counts, counts = cli.main(
+                    f"--primary {','.join(lanes['human'])} "
+                    f"--secondary {','.join(lanes['mouse'])} "
+                    f"--basename {tempd}/lanes", io.StringIO())
+                self.assertEqual(list(counts.values()), [134, 89, 7, 6, 1, 1])
+                for category in CATEGORIES:
+                    with bam.FileReader(gzip.open(
+                            f'{tempd}/single_{category}.bam')) as single:
+                        with bam.FileReader(gzip.open(
+                                f'{tempd}/lanes_{category}.bam')) as chained:
+                            self.assertEqual(list(chained), list(single))
+                self.assertRaises(ValueError, cli.main,
+                    f"--primary {','.join(lanes['human'])} "
+                    f"--secondary {','.join(lanes['mouse'])} "
+                    f"--basename {tempd}/lanes --scores {tempd}/scores.tsv",
+                    io.StringIO())
+
+            background = BackgroundReader(io.BytesIO(b'0123456789'),
+                                          chunk_size=3)
+            self.assertEqual(background.read(4), b'0123')
+            self.assertEqual(background.read(0), b'')
+            self.assertEqual(background.read(), b'456789')
+            self.assertEqual(background.read(1), b'')
+            background.close()
+
     def test_AlignbatchFileReader(self):
         test_bam = resource_stream(__name__, 'data/paired_end_testdata_human.bam')
         the_bam = AlignbatchFileReader(gzip.open(test_bam))
@@ -338,6 +1063,50 @@ class test_main(unittest.TestCase):
         the_bam.close()
         test_bam.close()
 
+    def test_parse_alignment_records(self):
+        with gzip.open(resource_stream(__name__,
+                       'data/paired_end_testdata_human.bam')) as ubam:
+            aligns = list(bam.FileReader(ubam))
+        data = b''.join(aligns)
+        records = parse_alignment_records(data + aligns[-1][:40])
+        self.assertEqual(len(records), len(aligns))
+        self.assertEqual(records.end, len(data))
+        self.assertEqual(list(records.flags), [get_flag(a) for a in aligns])
+        self.assertEqual(list(records.ref_ids),
+                         [get_ref_index(a) for a in aligns])
+        self.assertEqual(list(records.positions), [get_pos(a) for a in aligns])
+        self.assertEqual([data[o:o + l] for o, l in zip(records.offsets,
+                                                        records.lengths)],
+                         aligns)
+        self.assertEqual(list(records.tag_offsets),
+                         AlignBatch(aligns).tag_offsets)
+        names = records.names(data)
+        self.assertEqual(names[0], BAMPAIR1[0][36:36 + BAMPAIR1[0][12]])
+        self.assertEqual(len(template_starts(names)), 238)
+        self.assertEqual(template_starts([]), [])
+
+        # batches are the same however the data is divided into chunks
+        expected = list(AlignbatchFileReader(gzip.open(resource_stream(
+            __name__, 'data/paired_end_testdata_human.bam')),
+            track_offsets=True))
+        for chunk_size in (1, 1000, 2**20):
+            batches = list(AlignbatchFileReader(gzip.open(resource_stream(
+                __name__, 'data/paired_end_testdata_human.bam')),
+                chunk_size=chunk_size))
+            self.assertEqual(batches, expected)
+            self.assertEqual([b.name for b in batches],
+                             [b.name for b in expected])
+            self.assertEqual([b.flags for b in batches],
+                             [b.flags for b in expected])
+            self.assertEqual([b.tag_offsets for b in batches],
+                             [b.tag_offsets for b in expected])
+
+        with gzip.open(resource_stream(__name__,
+                       'data/paired_end_testdata_human.bam')) as ubam:
+            truncated = ubam.read()[:-10]
+        self.assertRaises(ValueError, list,
+                          AlignbatchFileReader(io.BytesIO(truncated)))
+
     def test_xenomap_states(self):
         self.assertEqual(xenomap_states(BAMPAIR1,BAMPAIR1),
                          ('unresolved', 'unresolved'))
@@ -351,7 +1120,7 @@ class test_main(unittest.TestCase):
         # # Manually confirm correct output when hash changes
         # print(err)
         # print(sha256(err.encode()).hexdigest())
-        self.assertEqual('3742b7b3fbb87c14e062465a449b381cea50d46cef89a6dc1cfd9df6cf9c2ac7',
+        self.assertEqual('6ad4a51ed57220d94660d90c0ea1f53c271e299844c195763351bf1c3bc2c9a8',
                          sha256(err.encode()).hexdigest())
         self.assertEqual('',out)
         # check docopt exits. Cant capture error to check output
@@ -395,6 +1164,14 @@ class test_main(unittest.TestCase):
                                                 output
                                                 )[1]).values()),
                              [141, 95, 0, 0, 1, 1])
+            with TemporaryDirectory() as tempd:
+                arguments = (f"--primary {prime} --secondary {second} "
+                             f"--cell-barcode CB --barcode-matrix {tempd}/bc.tsv")
+                self.assertEqual(list(dict(cli.main(arguments,
+                                                    output
+                                                    )[1]).values()),
+                                 [134, 89, 7, 6, 1, 1])
+                self.assertIn('0 cell barcodes', output.getvalue())
             arguments = (f"--primary {prime} --secondary {second} "
                          "--zs")
             self.assertEqual(list(dict(cli.main(arguments,
@@ -402,6 +1179,1028 @@ class test_main(unittest.TestCase):
                                                 )[1]).values()),
                              [141, 95, 0, 0, 1, 1])
 
+    def test_BamTemplateSampler(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with AlignbatchFileReader(gzip.open(prime)) as reader:
+                expected = list(reader)
+            sampler = BamTemplateSampler(prime)
+            secondary = BamTemplateSampler(second)
+            offsets = []
+            for offset in range(0, sampler.size, 512):
+                found = sampler.template_at(offset)
+                if found and found[0] not in offsets:
+                    offsets.append(found[0])
+                    self.assertIn(found[1], expected)
+                    self.assertEqual(secondary.find_template(found[1].name,
+                                                             offset)[1].name,
+                                     found[1].name)
+            self.assertEqual(len(offsets), 2)
+            starts = [start for block in (0, 25488)
+                      for start in sampler._block_templates(block)]
+            self.assertEqual([sampler.reader.get_alignbatch_at(start)
+                              for start in starts], expected)
+            self.assertIsNone(secondary.find_template(b'missing\x00', 0))
+            self.assertEqual(find_alignment_start(b'\x00' * 100, 1), -1)
+            sampler.close()
+            secondary.close()
+
+    def test_wilson_interval(self):
+        low, high = wilson_interval(50, 100)
+        self.assertAlmostEqual(low, 0.4038, places=4)
+        self.assertAlmostEqual(high, 0.5962, places=4)
+        self.assertEqual(wilson_interval(0, 0), (0.0, 1.0))
+
+    def test_xenomap_estimate(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            pair_counts, counts, intervals = xenomap_estimate(prime, second,
+                                                             margin=0.1,
+                                                             seed=1)
+            self.assertEqual(sum(pair_counts.values()), sum(counts.values()))
+            for category in ('primary_specific', 'secondary_specific'):
+                low, high = intervals[category]
+                self.assertLessEqual((high - low) / 2, 0.1)
+            self.assertAlmostEqual(counts['primary_specific']
+                                   / sum(counts.values()), 134 / 238,
+                                   delta=0.15)
+            # sampling without replacement exhausts the file
+            pair_counts, counts, intervals = xenomap_estimate(prime, second,
+                                                             margin=0.0,
+                                                             max_samples=20,
+                                                             seed=1)
+            self.assertEqual(sum(counts.values()), 20)
+            output = io.StringIO()
+            cli.main(f"--primary {prime} --secondary {second} --estimate "
+                     f"--margin 0.1 --seed 1", output)
+            self.assertIn('Proportion [interval]', output.getvalue())
+
+    def test_xenomap_estimate_uneven_blocks(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with AlignbatchFileReader(gzip.open(prime)) as primary, \
+                 AlignbatchFileReader(gzip.open(second)) as secondary:
+                names = {template.primary_aligns.name for template
+                         in classify_alignbatches(zip(primary, secondary))
+                         if template.category == 'primary_specific'}
+            self.assertEqual(len(names), 134)
+            random_generator = random.Random(1)
+            with TemporaryDirectory() as tempd:
+                # primary specific templates padded with incompressible tags
+                # are written first so they fill many sparse blocks
+                for genome, path in (('primary', prime),
+                                     ('secondary', second)):
+                    with AlignbatchFileReader(gzip.open(path)) as reader:
+                        header_length = reader._start_of_alignments
+                        batches = list(reader)
+                    with gzip.open(path) as infile:
+                        header = infile.read(header_length)
+                    batches.sort(key=lambda batch: batch.name not in names)
+                    with BgzfWriter(f'{tempd}/{genome}.bam', 'wb') as outfile:
+                        outfile.write(header)
+                        for alignbatch in batches:
+                            if alignbatch.name in names:
+                                padding = bytes(random_generator.choices(
+                                                    b'ACGT', k=4000))
+                                alignbatch = [add_category_tag(
+                                                [align],
+                                                b'ZZZ' + padding + b'\0')
+                                              for align in alignbatch]
+                            outfile.write(b''.join(alignbatch))
+                sampler = BamTemplateSampler(f'{tempd}/primary.bam')
+                densities = set()
+                for i in range(50):
+                    found = sampler.random_template(random_generator)
+                    if found is not None:
+                        densities.add(found[2])
+                sampler.close()
+                self.assertGreater(max(densities), 5 * min(densities))
+                pair_counts, counts, intervals = xenomap_estimate(
+                                                    f'{tempd}/primary.bam',
+                                                    f'{tempd}/secondary.bam',
+                                                    margin=0.0,
+                                                    max_samples=120,
+                                                    seed=1)
+                self.assertEqual(sum(counts.values()), 120)
+                self.assertEqual(sum(pair_counts.values()), 120)
+                self.assertAlmostEqual(counts['primary_specific'] / 120,
+                                       134 / 238, delta=0.1)
+
+    def test_cli_scores(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            output = io.StringIO()
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                arguments = (f"--primary {prime} --secondary {second} "
+                             f"--scores {tempd}/scores.bin "
+                             f"--basename {tempd}/direct --min-score 190")
+                direct = cli.main(arguments, output)
+                metadata, records = read_score_table(f'{tempd}/scores.bin')
+                self.assertEqual(metadata['AS_function'], 'get_AS')
+                self.assertEqual(len(list(records)), 238)
+                for options, expected in (("", [134, 89, 7, 6, 1, 1]),
+                                          ("--max", [134, 89, 7, 6, 1, 1]),
+                                          ("--min-score 190",
+                                           [124, 76, 4, 3, 0, 31]),
+                                          ("--conservative",
+                                           [133, 89, 7, 6, 2, 1])):
+                    arguments = f"--from-scores {tempd}/scores.bin {options}"
+                    self.assertEqual(list(dict(cli.main(arguments,
+                                                        output)[1]).values()),
+                                     expected)
+                arguments = (f"--from-scores {tempd}/scores.bin "
+                             f"--primary {prime} --secondary {second} "
+                             f"--basename {tempd}/rescored --min-score 190")
+                rescored = cli.main(arguments, output)
+                self.assertEqual(direct, rescored)
+                for category in CATEGORIES:
+                    direct_bam = bam.FileReader(
+                        gzip.open(f'{tempd}/direct_{category}.bam'))
+                    rescored_bam = bam.FileReader(
+                        gzip.open(f'{tempd}/rescored_{category}.bam'))
+                    self.assertEqual(list(direct_bam), list(rescored_bam))
+                    direct_bam.close()
+                    rescored_bam.close()
+                self.assertRaises(ValueError, xenomap_from_scores,
+                                  f'{tempd}/scores.bin',
+                                  XenomapperOutputWriter(b'', b'', b'', b'',
+                                              basename=f'{tempd}/foo'))
+                self.assertRaises(ValueError, read_score_table, prime)
+
+    def test_genome_scores(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            output = io.StringIO()
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                self.assertEqual(cli.main(f"extract-scores {prime} "
+                                          f"{tempd}/human.scores", output),
+                                 238)
+                with AlignbatchFileReader(BgzfReader(second, 'rb'),
+                                          track_offsets=True) as reader:
+                    self.assertEqual(extract_genome_scores(
+                                         reader, f'{tempd}/mouse.scores',
+                                         chunk_templates=100), 238)
+                chunks = list(read_genome_scores(f'{tempd}/mouse.scores',
+                                                 ('name_hash',)))
+                self.assertEqual([len(chunk[0]) for chunk in chunks],
+                                 [100, 100, 38])
+                scores = (f"--primary-scores {tempd}/human.scores "
+                          f"--secondary-scores {tempd}/mouse.scores")
+                for options in ("", "--max", "--min-score 190", "--zs",
+                                "--cigar --max", "--conservative"):
+                    self.assertEqual(cli.main(f"{scores} {options}", output),
+                                     cli.main(f"--primary {prime} "
+                                              f"--secondary {second} "
+                                              f"{options}", output))
+                self.assertEqual(list(cli.main(scores, output)[1].values()),
+                                 [134, 89, 7, 6, 1, 1])
+                cli.main(f"--primary {prime} --secondary {second} "
+                         f"--basename {tempd}/direct", output)
+                cli.main(f"{scores} --primary {prime} --secondary {second} "
+                         f"--basename {tempd}/rescored", output)
+                for category in CATEGORIES:
+                    direct_bam = bam.FileReader(
+                        gzip.open(f'{tempd}/direct_{category}.bam'))
+                    rescored_bam = bam.FileReader(
+                        gzip.open(f'{tempd}/rescored_{category}.bam'))
+                    self.assertEqual(list(direct_bam), list(rescored_bam))
+                    direct_bam.close()
+                    rescored_bam.close()
+                # the same genome twice is unresolved
+                counts = xenomap_from_genome_scores(f'{tempd}/human.scores',
+                                                    f'{tempd}/human.scores')[1]
+                self.assertEqual(counts['primary_specific'], 0)
+                with self.assertRaises(ValueError):
+                    xenomap_from_genome_scores(f'{tempd}/human.scores',
+                                               f'{tempd}/mouse.scores',
+                                               score_type='AS')
+                with GenomeScoresWriter(f'{tempd}/short.scores') as writer:
+                    pass
+                with self.assertRaises(ValueError):
+                    xenomap_from_genome_scores(f'{tempd}/human.scores',
+                                               f'{tempd}/short.scores')
+                with self.assertRaises(ValueError):
+                    list(read_genome_scores(prime))
+
+    def test_preflight(self):
+        raw = lambda text: struct.pack('<i', len(text)) + text
+        self.assertEqual(get_header_fields(raw(b'@HD\tVN:1.6\tSO:coordinate\n'
+                                               b'@SQ\tSN:1\tLN:10\n')),
+                         {'VN': '1.6', 'SO': 'coordinate'})
+        self.assertEqual(get_header_fields(raw(b'@SQ\tSN:1\tLN:10\n')), {})
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            output = io.StringIO()
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            report = cli.main(f"preflight --primary {prime} "
+                              f"--secondary {second}", output)
+            self.assertTrue(report.ok)
+            self.assertEqual(report.matched, report.sampled)
+            self.assertEqual(report.estimated_templates[0], 238)
+            self.assertEqual(report.tags[0]['AS'], 1.0)
+            self.assertIn('No problems found', output.getvalue())
+            self.assertEqual(cli.main(f"--primary {prime} --secondary {second}"
+                                      " --preflight", output)[1],
+                             cli.main(f"--primary {prime} --secondary {second}",
+                                      output)[1])
+            with TemporaryDirectory() as tempd:
+                # the same templates in a different order
+                with AlignbatchFileReader(gzip.open(second)) as reader:
+                    header_length = reader._start_of_alignments
+                    batches = list(reader)
+                with gzip.open(second) as infile:
+                    header = infile.read(header_length)
+                with BgzfWriter(f'{tempd}/reordered.bam', 'wb') as outfile:
+                    outfile.write(header)
+                    for alignbatch in batches[119:] + batches[:119]:
+                        outfile.write(b''.join(alignbatch))
+                report = preflight_check(prime, f'{tempd}/reordered.bam')
+                self.assertFalse(report.ok)
+                self.assertIn('same order', report.problems[0])
+                self.assertRaises(ValueError, cli.main,
+                                  f"--primary {prime} --secondary "
+                                  f"{tempd}/reordered.bam --preflight", output)
+                cli.main(f"--primary {prime} --secondary {second} "
+                         f"--basename {tempd}/sorted --sort", output)
+                report = preflight_check(prime,
+                                         f'{tempd}/sorted_primary_specific.bam')
+                self.assertEqual(report.headers[1]['SO'], 'coordinate')
+                self.assertTrue(any('coordinate sorted' in problem
+                                    for problem in report.problems))
+                self.assertTrue(report.warnings)
+                report.write(output)
+                self.assertIn('Problems:', output.getvalue())
+
+                # score tags are checked for the scoring in use
+                def write_sam_bam(filename, records):
+                    sam = (b'@HD\tVN:1.6\tSO:unsorted\n'
+                           b'@SQ\tSN:chr1\tLN:1000\n' + records.encode())
+                    with BgzfWriter(filename, 'wb') as outfile:
+                        outfile.write(SamStreamReader(io.BytesIO(sam)).read())
+                sequence = 'ACGT' * 25
+                record = ('{0}{1}\t{2}\t{3}\t1\t60\t{4}\t*\t0\t0\t'
+                          f'{sequence}\t*\tNM:i:0\n')
+                for genome in ('primary', 'secondary'):
+                    write_sam_bam(f'{tempd}/{genome}_nm.bam',
+                                  ''.join(record.format('r', i, 64, 'chr1',
+                                                        '100M')
+                                          for i in range(20)))
+                    write_sam_bam(f'{tempd}/{genome}_unmapped.bam',
+                                  ''.join(record.format('r', i, 68, '*', '*')
+                                          for i in range(20)))
+                nm_files = (f'{tempd}/primary_nm.bam',
+                            f'{tempd}/secondary_nm.bam')
+                report = preflight_check(*nm_files)
+                self.assertIn('Use --cigar', report.problems[0])
+                report = preflight_check(*nm_files, score_type='cigar')
+                self.assertTrue(report.ok)
+                self.assertEqual(report.mapped, (1, 1))
+                cli.main(f"--primary {nm_files[0]} --secondary {nm_files[1]} "
+                         f"--preflight --cigar", output)
+                self.assertRaises(ValueError, preflight_check, *nm_files,
+                                  score_type='AS')
+                report = preflight_check(f'{tempd}/primary_unmapped.bam',
+                                         f'{tempd}/secondary_unmapped.bam')
+                self.assertTrue(report.ok)
+                self.assertEqual(report.mapped, (0, 0))
+                self.assertIn('not checked', report.warnings[0])
+                # the search stops after a few templates are not found
+                for genome, prefix in (('primary', 'p'), ('secondary', 's')):
+                    write_sam_bam(f'{tempd}/{genome}_many.bam',
+                                  ''.join(record.format(prefix, i, 64, 'chr1',
+                                                        '100M')
+                                          for i in range(5000)))
+                report = preflight_check(f'{tempd}/primary_many.bam',
+                                         f'{tempd}/secondary_many.bam',
+                                         max_misses=2)
+                self.assertGreater(report.sampled, 10)
+                self.assertEqual(report.matched, 0)
+                self.assertEqual(sum('not in the secondary file' in problem
+                                     for problem in report.problems), 2)
+                self.assertIn('Stopped after 2', report.problems[2])
+
+    def test_sam_stream(self):
+        header = (b'@HD\tVN:1.6\tSO:unsorted\n'
+                  b'@SQ\tSN:chr1\tLN:1000\n@SQ\tSN:chr2\tLN:2000\n')
+        line = (b'r1\t99\tchr2\t11\t42\t3S5M1D2M\t=\t50\t60\tACGTNACgta\t'
+                b'IIIIIIIII#\tAS:i:-5\tXS:i:300\tNM:i:1\tMD:Z:5^A2\t'
+                b'XA:A:x\tXF:f:0.5\tXB:B:s,-1,2\n')
+        stream = SamStreamReader(io.BytesIO(header + line))
+        reader = AlignbatchFileReader(stream)
+        self.assertEqual(reader.refs, {'chr1': 1000, 'chr2': 2000})
+        align = next(reader)[0]
+        self.assertEqual(get_read_name(align, get_len_read_name(align)), 'r1')
+        self.assertEqual((get_ref_index(align), get_pos(align),
+                          get_pair_ref_index(align), get_pair_pos(align),
+                          get_flag(align), get_mapq(align)),
+                         (1, 10, 1, 49, 99, 42))
+        self.assertEqual(decode_cigar(get_raw_cigar(
+                             align, get_len_read_name(align),
+                             get_number_cigar_operations(align))),
+                         '3S5M1D2M')
+        self.assertEqual(get_bin(align), reg2bin(10, 18))
+        self.assertEqual(get_reference_end(align), 18)
+        self.assertEqual(get_int_tag(align, b'NM'), 1)
+        self.assertEqual(get_str_tag(get_tag_bytes(align), b'MD'), '5^A2')
+        tags = get_tag_bytes(align)
+        self.assertIn(b'ASc\xfb', tags)
+        self.assertIn(b'XSS' + struct.pack('<H', 300), tags)
+        self.assertIn(b'XAAx', tags)
+        self.assertIn(b'XFf' + struct.pack('<f', 0.5), tags)
+        self.assertIn(b'XBBs' + struct.pack('<ihh', 2, -1, 2), tags)
+        self.assertRaises(ValueError, encode_sam_record,
+                          line.replace(b'chr2', b'chr3'), {b'chr2': 0})
+        self.assertRaises(ValueError, encode_sam_record, b'r1\t4\t*\n', {})
+        # streams are recognised from their first bytes
+        for data in (header + line, gzip.open(resource_filename(__name__,
+                             'data/paired_end_testdata_human.bam')).read()):
+            self.assertEqual(open_alignment_stream(io.BytesIO(data)).read(4),
+                             b'BAM\x01')
+        self.assertEqual(format_aligner_command('aln -1 {R1} -2 {R2} {R1}',
+                                                ['a 1.fq', 'b.fq']),
+                         "aln -1 'a 1.fq' -2 b.fq 'a 1.fq'")
+        self.assertEqual(format_aligner_command('aln {reads}', ['a', 'b']),
+                         'aln a b')
+        self.assertRaises(ValueError, format_aligner_command,
+                          'aln {R1} {R2}', ['a'])
+
+    def test_aligner_commands(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            output = io.StringIO()
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            python = shlex.quote(sys.executable)
+            # stand in aligners writing BGZF and uncompressed BAM
+            decompress = (f"{python} -c 'import gzip, sys; "
+                          "sys.stdout.buffer.write(gzip.open(sys.argv[1])"
+                          ".read())' {R2}")
+            direct = cli.main(f"--primary {prime} --secondary {second}",
+                              output)
+            self.assertEqual(cli.main(["--primary-command", "cat {R1}",
+                                       "--secondary-command", decompress,
+                                       "--reads", f"{prime},{second}"],
+                                      output),
+                             direct)
+            with TemporaryDirectory() as tempd:
+                header = b'@SQ\tSN:chr1\tLN:1000\n'
+                records = ('r1\t64\tchr1\t1\t60\t4M\t*\t0\t0\tACGT\t*\tAS:i:{0}\n'
+                           'r2\t64\tchr1\t1\t60\t4M\t*\t0\t0\tACGT\t*\tAS:i:{1}\n')
+                for name, scores in (('primary', (8, 2)),
+                                     ('secondary', (2, 8))):
+                    with open(f'{tempd}/{name}.sam', 'wb') as sam_file:
+                        sam_file.write(header
+                                       + records.format(*scores).encode())
+                counts = cli.main(["--primary-command", f"cat {tempd}/primary.sam",
+                                   "--secondary-command",
+                                   f"cat {tempd}/secondary.sam",
+                                   "--basename", f"{tempd}/aligned"],
+                                  output)[1]
+                self.assertEqual(counts['primary_specific'], 1)
+                self.assertEqual(counts['secondary_specific'], 1)
+                with bam.FileReader(gzip.open(
+                        f'{tempd}/aligned_secondary_specific.bam')) as result:
+                    self.assertEqual([get_read_name(align,
+                                                    get_len_read_name(align))
+                                      for align in result], ['r2'])
+                # failing aligners and mismatched outputs stop the run
+                self.assertRaises(ValueError, cli.main,
+                                  ["--primary-command", f"cat {tempd}/primary.sam",
+                                   "--secondary-command",
+                                   f"cat {tempd}/secondary.sam; exit 3"],
+                                  output)
+                self.assertRaises(ValueError, cli.main,
+                                  ["--primary-command", f"cat {prime}",
+                                   "--secondary-command",
+                                   f"cat {tempd}/secondary.sam"],
+                                  output)
+                # options are checked before the aligners are started
+                self.assertRaises(ValueError, cli.main,
+                                  ["--primary-command",
+                                   f"touch {tempd}/started; cat {prime}",
+                                   "--secondary-command", f"cat {second}",
+                                   "--basename", f"{tempd}/tagged",
+                                   "--tagged", "--fastq", "all"],
+                                  output)
+                self.assertFalse(os.path.exists(f'{tempd}/started'))
+                # aligners are stopped when the run fails after they start
+                self.assertRaises(OSError, cli.main,
+                                  ["--primary-command",
+                                   f"cat {prime}; sleep 1; touch {tempd}/ran",
+                                   "--secondary-command", f"cat {second}",
+                                   "--basename", f"{tempd}/no/such/dir"],
+                                  output)
+                time.sleep(2)
+                self.assertFalse(os.path.exists(f'{tempd}/ran'))
+                with AlignerProcess(f"cat {prime}") as aligner:
+                    self.assertEqual(len(list(AlignbatchFileReader(
+                                                  aligner.stream))), 238)
+
+    def test_follow(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            output = io.StringIO()
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with open(prime, 'rb') as infile:
+                data = infile.read()
+            self.assertEqual(data[-28:], BGZF_EOF)
+
+            def write_slowly(filename, data, chunk_size=5000):
+                # an aligner writing partial blocks after a delay
+                time.sleep(0.1)
+                with open(filename, 'wb') as outfile:
+                    for start in range(0, len(data), chunk_size):
+                        outfile.write(data[start:start + chunk_size])
+                        outfile.flush()
+                        time.sleep(0.01)
+
+            with TemporaryDirectory() as tempd:
+                writer = threading.Thread(target=write_slowly,
+                                          args=(f'{tempd}/growing.bam', data))
+                writer.start()
+                followed = cli.main(f"--primary {tempd}/growing.bam "
+                                    f"--secondary {second} --follow",
+                                    output)
+                writer.join()
+                self.assertEqual(followed,
+                                 cli.main(f"--primary {prime} "
+                                          f"--secondary {second}", output))
+                # data after an EOF block is read
+                with open(f'{tempd}/twice.bam', 'wb') as outfile:
+                    outfile.write(data + data)
+                follower = BgzfFollower(f'{tempd}/twice.bam', timeout=1)
+                self.assertEqual(follower.read(),
+                                 gzip.open(prime).read() * 2)
+                follower.close()
+                # and data written soon after an EOF block that was last
+                def append_later(filename, data, delay):
+                    time.sleep(delay)
+                    with open(filename, 'ab') as outfile:
+                        outfile.write(data)
+                with open(f'{tempd}/paused.bam', 'wb') as outfile:
+                    outfile.write(data)
+                writer = threading.Thread(target=append_later,
+                                          args=(f'{tempd}/paused.bam', data,
+                                                0.2))
+                writer.start()
+                follower = BgzfFollower(f'{tempd}/paused.bam', timeout=1,
+                                        poll_interval=1)
+                self.assertEqual(follower.read(),
+                                 gzip.open(prime).read() * 2)
+                writer.join()
+                follower.close()
+                # lanes are only followed once the previous lane is read, so
+                # a later lane may start after the timeout of the first
+                third = len(data) // 3
+                first_lane = threading.Thread(target=lambda: [
+                    append_later(f'{tempd}/lane1.bam', part, 0.7)
+                    for part in (data[:third], data[third:2 * third],
+                                 data[2 * third:])])
+                second_lane = threading.Thread(target=append_later,
+                                               args=(f'{tempd}/lane2.bam',
+                                                     data, 2.0))
+                follow = lambda filename: BgzfFollower(filename, timeout=1,
+                                                       poll_interval=0.05)
+                first_lane.start()
+                second_lane.start()
+                chain = AlignbatchFileChain([f'{tempd}/lane1.bam',
+                                             f'{tempd}/lane2.bam'],
+                                            open_file=follow, lazy=True)
+                self.assertEqual(len(chain._readers), 1)
+                self.assertEqual(len(list(chain)), 2 * 238)
+                chain.close()
+                first_lane.join()
+                second_lane.join()
+                # a file without an EOF block times out
+                with open(f'{tempd}/truncated.bam', 'wb') as outfile:
+                    outfile.write(data[:-28])
+                follower = BgzfFollower(f'{tempd}/truncated.bam',
+                                        timeout=0.2, poll_interval=0.05)
+                self.assertRaises(ValueError, follower.read)
+                follower.close()
+                self.assertRaises(ValueError, cli.main,
+                                  f"--primary {tempd}/missing.bam "
+                                  f"--secondary {second} --follow "
+                                  f"--follow-timeout 0.2", output)
+                with open(f'{tempd}/not.bam', 'wb') as outfile:
+                    outfile.write(b'not a BGZF file' * 2)
+                self.assertRaises(ValueError,
+                                  BgzfFollower(f'{tempd}/not.bam').read)
+                self.assertRaises(ValueError, cli.main,
+                                  f"--primary {prime} --secondary {second} "
+                                  f"--follow --name-index", output)
+
+    def test_name_index(self):
+        self.assertLess(natural_name_key(b'r:9:2'), natural_name_key(b'r:10:1'))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            output = io.StringIO()
+            with TemporaryDirectory() as tempd:
+                # indexes are written beside the inputs
+                for genome in ('human', 'mouse'):
+                    with resource_stream(__name__,
+                            f'data/paired_end_testdata_{genome}.bam') as data:
+                        with open(f'{tempd}/{genome}.bam', 'wb') as copy:
+                            copy.write(data.read())
+                inputs = (f"--primary {tempd}/human.bam "
+                          f"--secondary {tempd}/mouse.bam")
+                cli.main(f"{inputs} --basename {tempd}/out --name-index "
+                         f"--index-every 16", output)
+                index = NameIndex(f'{tempd}/human.bam{NAME_INDEX_SUFFIX}')
+                self.assertEqual(index.templates, 238)
+                self.assertEqual(index.order, 'unsorted')
+                self.assertEqual(index.hashed, 238)
+                self.assertEqual(len(index.offsets), 15)
+                # a lookup in an unsorted file reads a single interval
+                with AlignbatchFileReader(
+                        gzip.open(f'{tempd}/human.bam')) as reader:
+                    batches = list(reader)
+                for batch in batches:
+                    ranges = index.search(batch.name[:-1])
+                    self.assertEqual(len(ranges), 1)
+                    self.assertEqual(ranges[0][1], 16)
+                for batch in batches[::11]:
+                    self.assertEqual(find_indexed_template(
+                                        f'{tempd}/human.bam',
+                                        batch.name[:-1]), batch)
+                self.assertEqual(index.search(b'nothere'), [])
+                # records sorted in runs spilled to disk give the same index
+                index_writer = NameIndexWriter(every=16, tmpdir=tempd)
+                index_writer._records = _SortedUint64Runs(run_values=10,
+                                                          max_runs=3,
+                                                          tmpdir=tempd)
+                for offset, batch in enumerate(batches):
+                    index_writer.add(batch.name[:-1], offset)
+                self.assertEqual(len(index_writer._records._spilled_runs), 1)
+                index_writer.write(f'{tempd}/runs{NAME_INDEX_SUFFIX}')
+                with open(f'{tempd}/runs{NAME_INDEX_SUFFIX}', 'rb') as runs:
+                    records = runs.read()[-238 * 8:]
+                with open(f'{tempd}/human.bam{NAME_INDEX_SUFFIX}',
+                          'rb') as written:
+                    self.assertEqual(records, written.read()[-238 * 8:])
+                runs_index = NameIndex(f'{tempd}/runs{NAME_INDEX_SUFFIX}')
+                for offset, batch in enumerate(batches):
+                    self.assertIn((offset - offset % 16, 16),
+                                  runs_index.search(batch.name[:-1]))
+                runs_index.close()
+                index.close()
+                name = 'HWI-ST960:96:COTO3ACXX:3:1101:1219:2200'
+                template = cli.main(f"explain {name} {inputs}", output)
+                self.assertEqual(template.category, 'secondary_specific')
+                self.assertEqual(template.forward_scores[2], 192)
+                self.assertIsNone(cli.main(f"explain nothere {inputs}", output))
+                found = find_indexed_template(
+                                f'{tempd}/out_secondary_specific.bam', name)
+                self.assertEqual(found.name, name.encode() + b'\x00')
+                self.assertEqual(len(found), 2)
+                self.assertRaises(ValueError, NameIndex, f'{tempd}/human.bam')
+
+                # sampled names are searched in name sorted files
+                reader = AlignbatchFileReader(gzip.open(f'{tempd}/human.bam'))
+                batches = sorted(reader, key=lambda batch: batch.name)
+                writer = bam.FileWriter(f'{tempd}/sorted.bam')
+                writer.raw_header = reader.raw_header
+                writer.raw_refs = reader.raw_refs
+                writer.write_header()
+                for batch in batches:
+                    for align in batch:
+                        writer.write(align)
+                writer.close()
+                reader = AlignbatchFileReader(BgzfReader(f'{tempd}/sorted.bam',
+                                                         'rb'),
+                                              track_offsets=True)
+                index_writer = NameIndexWriter(every=10)
+                for batch in reader:
+                    index_writer.add(batch.name[:-1], reader.batch_offset)
+                index_writer.write(f'{tempd}/sorted.bam{NAME_INDEX_SUFFIX}')
+                reader._ubam.close()
+                index = NameIndex(f'{tempd}/sorted.bam{NAME_INDEX_SUFFIX}')
+                self.assertEqual(index.order, 'bytes')
+                self.assertEqual(len(index.names), 24)
+                self.assertEqual(index.search(b'A'), [])
+                for batch in batches[::7]:
+                    self.assertEqual(find_indexed_template(
+                                        f'{tempd}/sorted.bam',
+                                        batch.name[:-1]), batch)
+                self.assertIsNone(find_indexed_template(f'{tempd}/sorted.bam',
+                                                        'ZZZ'))
+
+    def test_server(self):
+        scheduler = FairScheduler()
+        for job in ('a1', 'a2', 'a3'):
+            scheduler.put('a', job)
+        scheduler.put('b', 'b1')
+        scheduler.put('c', 'c1')
+        self.assertEqual(len(scheduler), 5)
+        self.assertEqual([scheduler.get() for _ in range(5)],
+                         ['a1', 'b1', 'c1', 'a2', 'a3'])
+        scheduler.put('a', 'a4')
+        scheduler.cancel('a')
+        scheduler.close()
+        self.assertIsNone(scheduler.get())
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            output = io.StringIO()
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            with TemporaryDirectory() as tempd:
+                socket_path = f'{tempd}/xenomapper2.sock'
+                server = XenomapperServer(socket_path, workers=2)
+                serving = threading.Thread(target=server.serve_forever)
+                serving.start()
+                try:
+                    jobs = [f"--primary={prime} --secondary={second} "
+                            f"--basename={tempd}/job0",
+                            f"--primary={prime} --secondary={second} "
+                            f"--basename={tempd}/job1 --min-score 190",
+                            "--bogus"]
+                    summaries = cli.main(['submit', f'--socket={socket_path}',
+                                          '--', *jobs], output)
+                    # relative filenames are relative to the cwd of the job
+                    relative = list(submit_jobs(socket_path,
+                                                [['--primary', prime,
+                                                  '--secondary', second,
+                                                  '--basename', 'job2']],
+                                                cwd=tempd))
+                    # the socket is private and a live server is not replaced
+                    self.assertEqual(os.stat(socket_path).st_mode & 0o777,
+                                     0o600)
+                    self.assertRaises(ValueError, XenomapperServer,
+                                      socket_path)
+                finally:
+                    server.shutdown()
+                    server.server_close()
+                    serving.join()
+                summaries.sort(key=lambda summary: summary['job'])
+                self.assertEqual([summary['status'] for summary in summaries],
+                                 ['ok', 'ok', 'error'])
+                self.assertEqual(list(summaries[0]['counts'].values()),
+                                 [134, 89, 7, 6, 1, 1])
+                self.assertEqual(list(summaries[1]['counts'].values()),
+                                 [124, 76, 4, 3, 0, 31])
+                self.assertEqual(sum(summaries[0]['pair_counts'].values()),
+                                 238)
+                self.assertTrue(Path(f'{tempd}/job1_unassigned.bam').exists())
+                self.assertEqual(relative[0]['status'], 'ok')
+                self.assertTrue(Path(f'{tempd}/job2_unassigned.bam').exists())
+                self.assertFalse(Path(socket_path).exists())
+
+                # only a stale socket is replaced
+                with open(socket_path, 'w') as not_socket:
+                    not_socket.write('data')
+                self.assertRaises(ValueError, XenomapperServer, socket_path)
+                with open(socket_path) as not_socket:
+                    self.assertEqual(not_socket.read(), 'data')
+                os.unlink(socket_path)
+                with socket.socket(socket.AF_UNIX) as stale:
+                    stale.bind(socket_path)
+                server = XenomapperServer(socket_path, workers=1)
+                server.server_close()
+                self.assertFalse(Path(socket_path).exists())
+
+                # jobs do not change the working directory of the worker
+                cwd = os.getcwd()
+                summary = run_job(['--primary', prime, '--secondary', second,
+                                   '--basename', 'job3'], cwd=tempd)
+                self.assertEqual(summary['status'], 'ok')
+                self.assertTrue(Path(f'{tempd}/job3_unassigned.bam').exists())
+                self.assertEqual(os.getcwd(), cwd)
+                run_job(['--bogus'], cwd=tempd)
+                self.assertEqual(os.getcwd(), cwd)
+
+                # only classification runs and merge are run as jobs
+                for job in (['shard', '--primary', prime, '--secondary',
+                             second, '--n-shards=2', '--manifest=m.json'],
+                            ['preflight', '--primary', prime,
+                             '--secondary', second],
+                            ['serve', f'--socket={tempd}/other.sock'],
+                            ['submit', f'--socket={socket_path}', '--',
+                             f'--primary {prime} --secondary {second}']):
+                    summary = run_job(job, cwd=tempd)
+                    self.assertEqual(summary['status'], 'error')
+                    self.assertEqual(summary['error'],
+                                     f"xenomapper2 {job[0]} can not be run "
+                                     f"as a server job, only classification "
+                                     f"runs and merge")
+                self.assertFalse(Path(f'{tempd}/m.json').exists())
+                self.assertFalse(Path(f'{tempd}/other.sock').exists())
+                summary = run_job(['merge', '--basename=merged', 'job3'],
+                                  cwd=tempd)
+                self.assertEqual(summary['status'], 'error')
+                self.assertNotIn('server job', summary['error'])
+
+    def test_codecs(self):
+        self.assertEqual(available_codecs()[-1], 'zlib')
+        self.assertEqual(get_codec().name, available_codecs()[0])
+        self.assertRaises(ValueError, Codec, 'brotli')
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            output = io.StringIO()
+            prime = resource_filename(__name__,
+                                      'data/paired_end_testdata_human.bam')
+            second = resource_filename(__name__,
+                                       'data/paired_end_testdata_mouse.bam')
+            results = cli.main(f"codecs --primary {prime}", output)
+            self.assertEqual(list(results), available_codecs())
+            self.assertEqual(results['zlib']['compress_speedup'], 1.0)
+            self.assertIn('Decompress MB/s', output.getvalue())
+            with TemporaryDirectory() as tempd:
+                for name in available_codecs():
+                    cli.main(f"--primary {prime} --secondary {second} "
+                             f"--basename {tempd}/{name} --codec {name} "
+                             f"--fastq unresolved --interleaved", output)
+                for category in CATEGORIES:
+                    if category == 'unresolved':
+                        continue
+                    expected = None
+                    for name in available_codecs():
+                        # outputs of every codec are standard BGZF
+                        filename = f'{tempd}/{name}_{category}.bam'
+                        with open(filename, 'rb') as bgzf_file:
+                            blocks = list(iter_bgzf_blocks(bgzf_file))
+                        self.assertEqual(blocks[-1], BGZF_EOF)
+                        with bam.FileReader(gzip.open(filename)) as reader:
+                            alignments = list(reader)
+                        if expected is None:
+                            expected = alignments
+                        self.assertEqual(alignments, expected)
+                fastq = {name: gzip.open(f'{tempd}/{name}_unresolved.fastq.gz'
+                                         ).read()
+                         for name in available_codecs()}
+                self.assertEqual(len(set(fastq.values())), 1)
+
+    def test_codec_modules(self):
+        # a stand in for isal wrapping zlib and gzip to record their use
+        calls = {'levels': [], 'opened': []}
+        stub_zlib = types.ModuleType('xenomapper2_stub_zlib')
+        stub_zlib.DEFLATED = zlib.DEFLATED
+        stub_zlib.decompress = zlib.decompress
+        def compressobj(level, *args):
+            calls['levels'].append(level)
+            return zlib.compressobj(level, *args)
+        stub_zlib.compressobj = compressobj
+        stub_gzip = types.ModuleType('xenomapper2_stub_gzip')
+        def stub_open(filename, mode='rb'):
+            calls['opened'].append(str(filename))
+            return gzip.open(filename, mode)
+        stub_gzip.open = stub_open
+        sys.modules[stub_zlib.__name__] = stub_zlib
+        sys.modules[stub_gzip.__name__] = stub_gzip
+        isal_modules = CODEC_MODULES['isal']
+        CODEC_MODULES['isal'] = (stub_zlib.__name__, stub_gzip.__name__)
+        try:
+            self.assertEqual(available_codecs()[0], 'isal')
+            codec = get_codec()
+            self.assertIs(codec.zlib, stub_zlib)
+            # isal levels 0 to 3 from zlib levels 0 to 9
+            self.assertEqual([codec.compresslevel(level)
+                              for level in range(10)],
+                             [0, 0, 0, 1, 1, 1, 2, 2, 2, 3])
+            self.assertEqual(Codec('zlib').compresslevel(9), 9)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                output = io.StringIO()
+                prime = resource_filename(
+                    __name__, 'data/paired_end_testdata_human.bam')
+                second = resource_filename(
+                    __name__, 'data/paired_end_testdata_mouse.bam')
+                with TemporaryDirectory() as tempd:
+                    # inputs are read with the gzip module of the codec and
+                    # outputs compressed with its zlib module
+                    counts = cli.main(f"--primary {prime} "
+                                      f"--secondary {second} "
+                                      f"--basename {tempd}/stub --codec isal",
+                                      output)[1]
+                    self.assertEqual(list(counts.values()),
+                                     [134, 89, 7, 6, 1, 1])
+                    self.assertEqual(calls['opened'], [prime, second])
+                    self.assertTrue(calls['levels'])
+                    self.assertEqual(set(calls['levels']), {2})
+                    cli.main(f"--primary {prime} --secondary {second} "
+                             f"--basename {tempd}/zlib --codec zlib", output)
+                    for category in CATEGORIES:
+                        with bam.FileReader(gzip.open(
+                                f'{tempd}/stub_{category}.bam')) as stub, \
+                             bam.FileReader(gzip.open(
+                                f'{tempd}/zlib_{category}.bam')) as plain:
+                            self.assertEqual(list(stub), list(plain))
+                    # writers that are already open change module
+                    writer = bam.FileWriter(f'{tempd}/switched.bam')
+                    self.assertTrue(set_bgzf_codec(writer, codec))
+                    self.assertIsInstance(writer.bgzf_file, CodecBgzfWriter)
+                    self.assertIs(writer.bgzf_file.codec.zlib, stub_zlib)
+                    del calls['levels'][:]
+                    writer.raw_header = struct.pack('<i', 0)
+                    writer.raw_refs = struct.pack('<i', 0)
+                    writer.write_header()
+                    writer.close()
+                    self.assertEqual(calls['levels'], [2])
+                    self.assertEqual(gzip.open(f'{tempd}/switched.bam').read(),
+                                     b'BAM\x01' + struct.pack('<ii', 0, 0))
+                    # blocks that do not fit in 64KiB are an error
+                    random_generator = random.Random(1)
+                    data = bytes(random_generator.getrandbits(8)
+                                 for i in range(2**16))
+                    with open(f'{tempd}/random.bgzf', 'wb') as handle:
+                        writer = CodecBgzfWriter(fileobj=handle, codec=codec)
+                        self.assertRaises(ValueError, writer.write, data)
+        finally:
+            CODEC_MODULES['isal'] = isal_modules
+            del sys.modules[stub_zlib.__name__]
+            del sys.modules[stub_gzip.__name__]
+        self.assertNotIn(stub_zlib.__name__, sys.modules)
+
+    def test_AdaptiveTuner(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            with TemporaryDirectory() as tempd:
+                primary = AlignbatchFileReader(gzip.open(resource_stream(__name__,'data/paired_end_testdata_human.bam')))
+                secondary = AlignbatchFileReader(gzip.open(resource_stream(__name__,'data/paired_end_testdata_mouse.bam')))
+                xow = XenomapperOutputWriter(primary.raw_header,
+                                             primary.raw_refs,
+                                             secondary.raw_header,
+                                             secondary.raw_refs,
+                                             basename=f'{tempd}/tuned')
+                tuner = AdaptiveTuner(sample_seconds=0)
+                self.assertEqual(tuner.summary(), 'No BAM output to auto-tune')
+                output = xenomap(primary, secondary, xow, tuner=tuner)
+                self.assertEqual(list(dict(output[1]).values()),
+                                 [134, 89, 7, 6, 1, 1])
+                self.assertEqual(tuner.settings['timed_templates'], 1)
+                self.assertEqual(tuner.settings['written_templates'], 1)
+                self.assertEqual(tuner.settings['compressed_templates'], 1)
+                self.assertIn(tuner.settings['compresslevel'], range(1, 10))
+                self.assertEqual(xow['primary_specific'].bgzf_file.compresslevel,
+                                 tuner.settings['compresslevel'])
+                self.assertTrue(tuner.summary().startswith(
+                    f"Auto-tuned output compresslevel "
+                    f"{tuner.settings['compresslevel']}"))
+                xow.close()
+                with bam.FileReader(gzip.open(
+                        f'{tempd}/tuned_primary_specific.bam')) as tuned:
+                    self.assertEqual(len(list(tuned)), 268)
+                self.assertFalse(set_bgzf_compresslevel(DummyFile(), 1))
+
+                # runs without output are not tuned
+                primary = AlignbatchFileReader(gzip.open(resource_stream(
+                    __name__, 'data/paired_end_testdata_human.bam')))
+                secondary = AlignbatchFileReader(gzip.open(resource_stream(
+                    __name__, 'data/paired_end_testdata_mouse.bam')))
+                tuner = AdaptiveTuner(sample_seconds=0)
+                xenomap(primary, secondary, None, tuner=tuner)
+                self.assertIsNone(tuner.settings)
+                self.assertEqual(tuner.summary(), 'No BAM output to auto-tune')
+
+        # the highest level adding at most a quarter of the run time
+        # without compression, which is estimated by removing the time to
+        # compress the written bytes at the lowest level
+        tuner = AdaptiveTuner(levels=(9, 5, 1))
+        rates = {1: 1000.0, 5: 100.0, 9: 10.0}
+        for written, elapsed, level in ((10, 1.0, 1), (10, 40.0, 1),
+                                        (10, 42.0, 5), (10, 400.0, 5),
+                                        (10, 402.0, 9), (5, 21.0, 5)):
+            # 10 templates timed, written of them written with 100 bytes
+            tuner._choose(None, b'x' * 1000, 10, written, 10, elapsed,
+                          compress_rates=rates)
+            self.assertEqual(tuner.settings['compresslevel'], level)
+        self.assertEqual(tuner.settings['bytes_per_template'], 50.0)
+        self.assertEqual(tuner.settings['compress_bytes_per_second'], 100.0)
+        self.assertAlmostEqual(tuner.settings['compress_share'],
+                               0.5 / (2.05 + 0.5))
+        self.assertAlmostEqual(tuner.settings['templates_per_second'],
+                               10 / 21)
+
+    def test_classify_alignbatches_threaded(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            primary = list(AlignbatchFileReader(gzip.open(resource_stream(__name__,'data/paired_end_testdata_human.bam'))))
+            secondary = list(AlignbatchFileReader(gzip.open(resource_stream(__name__,'data/paired_end_testdata_mouse.bam'))))
+            for options in ({}, {'scores': True, 'conservative': True,
+                                 'score_function': get_max_AS_XS}):
+                serial = list(classify_alignbatches(zip(primary, secondary),
+                                                    **options))
+                self.assertEqual(len(serial), 238)
+                for threads, chunk_templates in ((1, 1), (2, 10), (4, 1024)):
+                    threaded = list(classify_alignbatches_threaded(
+                                        zip(primary, secondary), threads,
+                                        chunk_templates=chunk_templates,
+                                        **options))
+                    self.assertEqual(threaded, serial)
+                self.assertEqual(serial[0].forward_scores is not None,
+                                 bool(options.get('scores')))
+            serial = list(classify_alignbatches(zip(primary, secondary)))
+            self.assertIsNone(serial[0].forward_scores)
+            self.assertEqual(Counter(t.category for t in serial),
+                             {'primary_specific': 134,
+                              'secondary_specific': 89, 'primary_multi': 7,
+                              'secondary_multi': 6, 'unresolved': 1,
+                              'unassigned': 1})
+            self.assertIsInstance(gil_enabled(), bool)
+            output = io.StringIO()
+            pair_counts, counts = cli.main(
+                f"--primary {resource_filename(__name__, 'data/paired_end_testdata_human.bam')} "
+                f"--secondary {resource_filename(__name__, 'data/paired_end_testdata_mouse.bam')} "
+                "--threads 2", output)
+            self.assertEqual(list(counts.values()), [134, 89, 7, 6, 1, 1])
+            results = benchmark_threads(list(zip(primary, secondary)), (1, 3))
+            self.assertEqual(list(results), [0, 1, 3])
+            self.assertEqual(results[0]['speedup'], 1.0)
+            results = cli.main(
+                f"threads --primary {resource_filename(__name__, 'data/paired_end_testdata_human.bam')} "
+                f"--secondary {resource_filename(__name__, 'data/paired_end_testdata_mouse.bam')} "
+                "--threads 6", output)
+            self.assertEqual(list(results), [0, 1, 2, 4, 6])
+            self.assertIn('238 templates classified with the GIL',
+                          output.getvalue())
+
+    def test_iter_classified(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            primary = AlignbatchFileReader(gzip.open(resource_stream(__name__,'data/paired_end_testdata_human.bam')))
+            secondary = AlignbatchFileReader(gzip.open(resource_stream(__name__,'data/paired_end_testdata_mouse.bam')))
+            templates = list(iter_classified(primary, secondary))
+            self.assertEqual(len(templates), 238)
+            category, forward_state, reverse_state, primary_aligns, \
+                secondary_aligns, _, _ = templates[0]
+            self.assertEqual(primary_aligns, BAMPAIR1)
+            self.assertEqual(category, state_map(forward_state, reverse_state))
+            self.assertIsNone(templates[0].forward_scores)
+            self.assertEqual(Counter(t.category for t in templates),
+                             {'primary_specific': 134,
+                              'secondary_specific': 89, 'primary_multi': 7,
+                              'secondary_multi': 6, 'unresolved': 1,
+                              'unassigned': 1})
+            for template in templates:
+                self.assertIs(template.output_aligns,
+                              template.secondary_aligns
+                              if template.category.startswith('secondary')
+                              else template.primary_aligns)
+
+            # sinks without an output writer
+            primary = AlignbatchFileReader(gzip.open(resource_stream(__name__,'data/paired_end_testdata_human.bam')))
+            secondary = AlignbatchFileReader(gzip.open(resource_stream(__name__,'data/paired_end_testdata_mouse.bam')))
+            seen = []
+            scored = CallbackSink(seen.append, needs_scores=True)
+            pair_counts, counts, writer = xenomap(primary, secondary, None,
+                                                  sinks=[scored])
+            self.assertIsNone(writer)
+            self.assertEqual(list(counts.values()), [134, 89, 7, 6, 1, 1])
+            self.assertEqual([t[:5] for t in seen],
+                             [t[:5] for t in templates])
+            self.assertIsNotNone(seen[0].forward_scores)
+
+            counter = CategoryCounter()
+            collected = XenomapperOutputWriter(primary.raw_header,
+                                               primary.raw_refs,
+                                               secondary.raw_header,
+                                               secondary.raw_refs)
+            written = []
+            collected.write_alignbatch = lambda category, aligns: \
+                written.append((category, aligns))
+            writer_sink = OutputWriterSink(collected)
+            for template in templates:
+                counter.add_template(template)
+                writer_sink.add_template(template)
+            self.assertEqual(counter.counts, counts)
+            self.assertEqual(counter.pair_counts, pair_counts)
+            self.assertEqual(written, [(t.category, t.output_aligns)
+                                       for t in templates])
+
+            sorted_bam = AlignbatchFileReader(gzip.open(resource_stream(__name__,'data/minitest.sorted.bam')))
+            self.assertRaises(ValueError, iter_classified, sorted_bam,
+                              secondary)
+
     def test_xenomap(self):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
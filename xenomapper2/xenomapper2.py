@@ -24,12 +24,17 @@ All rights reserved.
 
 """
 
-import sys, gzip
-from typing import List, Tuple, BinaryIO, Union, Iterable, Callable
-from collections import Counter
-from itertools import zip_longest
+import sys, glob, gzip, io, json, math, mmap, heapq, queue, random, shlex
+import bisect, hashlib, importlib, subprocess, tempfile, threading, time, zlib
+from array import array
+from typing import (List, Tuple, BinaryIO, Union, Iterable, Callable, TextIO,
+                    NamedTuple, Dict)
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest, compress, islice
 
 from pylazybam.bam import *
+from pylazybam.bgzf import BgzfReader, BgzfWriter, BgzfBlocks
 
 __author__ = "Matthew Wakefield"
 __copyright__ = ("Copyright 2018-2020 Matthew Wakefield"
@@ -44,6 +49,423 @@ __status__ = "Development/Beta"
 
 MIN32INT: int = -2147483648
 
+CATEGORIES: Tuple[str, ...] = ('primary_specific', 'primary_multi',
+                               'secondary_specific', 'secondary_multi',
+                               'unresolved', 'unassigned')
+
+
+class ClassifiedTemplate(NamedTuple):
+    """A template classified by xenomapper
+
+    Yielded by iter_classified and passed to the add_template method of
+    sinks (see xenomap). The scores are None unless requested.
+    """
+    category: str
+    forward_state: str
+    reverse_state: Union[str, None]
+    primary_aligns: List[bytes]
+    secondary_aligns: List[bytes]
+    forward_scores: Union[Tuple[int, int, int, int], None] = None
+    reverse_scores: Union[Tuple[int, int, int, int], None] = None
+
+    @property
+    def output_aligns(self) -> List[bytes]:
+        """The alignments written for the category (secondary genome
+        alignments for secondary_specific and secondary_multi)"""
+        if self.category in ('secondary_specific', 'secondary_multi'):
+            return self.secondary_aligns
+        return self.primary_aligns
+
+
+# BAM flag for SEQ being reverse complemented (not in pylazybam FLAGS)
+REVERSE_COMPLEMENTED: int = 0x10
+
+# lookup tables for converting raw BAM sequence and qualities to FASTQ
+_BAM_BASES = b"=ACMGRSVTWYHKDBN"
+_BAM_BASE_PAIRS = [bytes([_BAM_BASES[x >> 4], _BAM_BASES[x & 0b1111]])
+                   for x in range(256)]
+_COMPLEMENT = bytes.maketrans(b"ACGTMRWSYKVHDBN=",
+                              b"TGCAKYWSRMBDHVN=")
+_PHRED33 = bytes([min(q + 33, 126) for q in range(256)])
+
+# block_size, refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq
+BAM_CORE = struct.Struct('<iiiBBHHHi')
+
+# precompiled patterns equivalent to pylazybam tag functions
+TAG_PATTERNS = {get_AS: re.compile(b"ASC."),
+                get_XS: re.compile(b"XSC."),
+                get_ZS: re.compile(b"ZSC."),
+                }
+
+
+class AlignBatch(list):
+    """A list of raw BAM alignments from one template with parsed fields
+
+    The fixed fields needed by xenomapper are unpacked once when the batch
+    is created. As a list of raw alignments it can be used anywhere a
+    List[bytes] is expected, and all xenomapper scoring and state functions
+    use the parsed fields when given an AlignBatch.
+
+    Parameters
+    ----------
+    alignments : Iterable[bytes]
+        raw BAM alignments with the same read name
+    name : bytes, optional
+        the raw read name (including null terminator) if already known
+
+    Attributes
+    ----------
+    name : bytes
+        the raw read name including the null terminator
+    flags : List[int]
+        the flag of each alignment
+    tag_offsets : List[int]
+        the offset of the start of the tags in each alignment
+    """
+    __slots__ = ('name', 'flags', 'tag_offsets', '_split')
+
+    def __init__(self, alignments: Iterable[bytes] = (), name: bytes = None):
+        super().__init__(alignments)
+        unpack_from = BAM_CORE.unpack_from
+        flags = []
+        tag_offsets = []
+        for align in self:
+            (_, _, _, len_read_name, _, _, number_cigar_operations,
+             flag, len_sequence) = unpack_from(align)
+            flags.append(flag)
+            tag_offsets.append(36 + len_read_name
+                               + 4 * number_cigar_operations
+                               + (len_sequence + 1) // 2
+                               + len_sequence)
+        self.flags = flags
+        self.tag_offsets = tag_offsets
+        if name is None and self:
+            name = self[0][36:36 + self[0][12]]
+        self.name = name
+        self._split = None
+
+    @classmethod
+    def _from_parsed(cls, alignments, flags, tag_offsets, name):
+        batch = cls.__new__(cls)
+        batch.extend(alignments)
+        batch.flags = flags
+        batch.tag_offsets = tag_offsets
+        batch.name = name
+        batch._split = None
+        return batch
+
+    def split_forward_reverse(self) -> Tuple['AlignBatch', 'AlignBatch']:
+        """Split into forward and reverse batches (cached)
+
+        See split_forward_reverse
+        """
+        if self._split is None:
+            forward, forward_flags, forward_offsets = [], [], []
+            reverse, reverse_flags, reverse_offsets = [], [], []
+            for align, flag, offset in zip(self, self.flags, self.tag_offsets):
+                if flag & 0x40:
+                    forward.append(align)
+                    forward_flags.append(flag)
+                    forward_offsets.append(offset)
+                elif flag & 0x80:
+                    reverse.append(align)
+                    reverse_flags.append(flag)
+                    reverse_offsets.append(offset)
+                else: #pragma: no cover
+                    raise ValueError(f"The alignment {align} has neither "
+                                     "the forward or the reverse flag set")
+            self._split = (self._from_parsed(forward, forward_flags,
+                                             forward_offsets, self.name),
+                           self._from_parsed(reverse, reverse_flags,
+                                             reverse_offsets, self.name))
+        return self._split
+
+    def bamprimary_indices(self) -> List[int]:
+        """The indices of alignments without the secondary flag"""
+        return [i for i, flag in enumerate(self.flags) if not flag & 0x100]
+
+    def score(self, index: int, function: Callable) -> int:
+        """Get a score of an alignment
+
+        get_AS, get_XS and get_ZS are evaluated with precompiled patterns
+        that only search the tags of the alignment.
+
+        Parameters
+        ----------
+        index : int
+            the index of the alignment in the batch
+        function : Callable[[bytes], int]
+            a score function eg get_AS, get_XS or get_cigar_based_score
+
+        Returns
+        -------
+        int
+            the value of function for the alignment
+
+        Raises
+        ------
+        ValueError
+            if a tag is present more than once (as pylazybam.tags.get_AS)
+        """
+        pattern = TAG_PATTERNS.get(function)
+        if pattern is None:
+            return function(self[index])
+        match = pattern.findall(self[index], self.tag_offsets[index])
+        if not match:
+            return MIN32INT
+        elif len(match) != 1:
+            raise ValueError(f"More than one match to {pattern.pattern} "
+                             f"was found in {self[index]}")
+        return match[0][3]
+
+    def scores(self, AS_function: Callable, XS_function: Callable,
+               bamprimary: bool = False) -> List[Tuple[int, int]]:
+        """Get the AS and XS scores of alignments in the batch
+
+        Parameters
+        ----------
+        AS_function : Callable[[bytes], int]
+            a function returning the AS score of an alignment
+        XS_function : Callable[[bytes], int]
+            a function returning the XS score of an alignment
+        bamprimary : bool
+            only score alignments without the secondary flag
+
+        Returns
+        -------
+        List[Tuple[int, int]]
+            the (AS, XS) scores of each alignment
+        """
+        score = self.score
+        return [(score(i, AS_function), score(i, XS_function))
+                for i, flag in enumerate(self.flags)
+                if not (bamprimary and flag & 0x100)]
+
+
+class SpilledAlignBatch():
+    """A batch of alignments from one template held in a temporary file
+
+    Used by AlignbatchFileReader for templates with more records than
+    spill_records so pathological multi-mapping templates do not need to be
+    held in memory. Only the flag and file offset of each alignment are kept
+    in memory. Supports iteration, len() and indexing so it can be used in
+    place of a List[bytes] by the xenomapper scoring and output functions.
+    The temporary file is removed by close() or on leaving a with block.
+    Batches from split_forward_reverse share the file of the batch they were
+    split from so are closed with it.
+
+    Parameters
+    ----------
+    name : bytes
+        the raw read name including the null terminator
+    tmpdir : str, optional
+        directory for the temporary file [ Default : system temp directory ]
+
+    Attributes
+    ----------
+    name : bytes
+        the raw read name including the null terminator
+    flags : array
+        the flag of each alignment
+    """
+
+    def __init__(self, name: bytes, tmpdir: str = None):
+        self.name = name
+        self.flags = array('H')
+        self._offsets = array('Q')
+        self._file = tempfile.TemporaryFile(dir=tmpdir)
+        self._end = 0
+
+    def append(self, align: bytes):
+        self.flags.append(BAM_CORE.unpack_from(align)[7])
+        self._offsets.append(self._end)
+        self._file.seek(self._end)
+        self._file.write(align)
+        self._end += len(align)
+
+    def extend(self, alignments: Iterable[bytes]):
+        for align in alignments:
+            self.append(align)
+
+    def _view(self, forward: bool) -> 'SpilledAlignBatch':
+        view = SpilledAlignBatch.__new__(SpilledAlignBatch)
+        view.name = self.name
+        view.flags = array('H', compress(self.flags,
+                                         (bool(flag & 0x40) == forward
+                                          for flag in self.flags)))
+        view._offsets = array('Q', compress(self._offsets,
+                                            (bool(flag & 0x40) == forward
+                                             for flag in self.flags)))
+        view._file = self._file
+        view._end = self._end
+        return view
+
+    def split_forward_reverse(self) -> Tuple['SpilledAlignBatch',
+                                             'SpilledAlignBatch']:
+        """Split into forward and reverse batches sharing the same file
+
+        See split_forward_reverse
+        """
+        if any(not flag & 0xC0 for flag in self.flags): #pragma: no cover
+            raise ValueError("An alignment in the batch has neither "
+                             "the forward or the reverse flag set")
+        return self._view(forward=True), self._view(forward=False)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, index: int) -> bytes:
+        self._file.seek(self._offsets[index])
+        raw_blocksize = self._file.read(4)
+        return raw_blocksize + self._file.read(
+                                    struct.unpack('<i', raw_blocksize)[0])
+
+    def __iter__(self) -> Generator[bytes, None, None]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self):
+        """Close and remove the temporary file"""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AlignmentRecords():
+    """Fixed fields of the complete BAM alignments in a buffer
+
+    Built by parse_alignment_records in a single pass over a buffer of
+    decompressed alignment data. Each field is an array with one value per
+    alignment so batching, scoring and output can slice the buffer without
+    unpacking each alignment again. The read name of every alignment starts
+    36 bytes after its offset.
+
+    Attributes
+    ----------
+    offsets : array
+        the offset of each alignment in the buffer
+    lengths : array
+        the length of each alignment including the block_size field
+    name_lengths : array
+        the length of each read name including the null terminator
+    flags : array
+        the flag of each alignment
+    ref_ids : array
+        the reference index of each alignment
+    positions : array
+        the 0-based leftmost position of each alignment
+    tag_offsets : array
+        the offset of the tags within each alignment
+    end : int
+        the offset after the last complete alignment. Any data after this
+        is the start of an incomplete alignment
+    """
+    __slots__ = ('offsets', 'lengths', 'name_lengths', 'flags', 'ref_ids',
+                 'positions', 'tag_offsets', 'end')
+
+    def __init__(self):
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self.name_lengths = array('B')
+        self.flags = array('H')
+        self.ref_ids = array('i')
+        self.positions = array('i')
+        self.tag_offsets = array('I')
+        self.end = 0
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def names(self, data: bytes) -> List[bytes]:
+        """The raw read names (including null terminator) of the alignments
+
+        Parameters
+        ----------
+        data : bytes
+            the buffer the records were parsed from
+
+        Returns
+        -------
+        List[bytes]
+        """
+        return [data[offset + 36:offset + 36 + name_length]
+                for offset, name_length in zip(self.offsets,
+                                               self.name_lengths)]
+
+
+def template_starts(names: List[bytes]) -> List[int]:
+    """The indices of read names that differ from the previous name
+
+    Parameters
+    ----------
+    names : List[bytes]
+        read names in file order eg from AlignmentRecords.names
+
+    Returns
+    -------
+    List[int]
+        the index of the first alignment of each template. The first
+        alignment is always the start of a template
+    """
+    if not names:
+        return []
+    return [0] + [i for i in range(1, len(names)) if names[i] != names[i - 1]]
+
+
+
+def parse_alignment_records(data: bytes, start: int = 0) -> AlignmentRecords:
+    """Find the complete alignments in a buffer of decompressed BAM data
+
+    Parameters
+    ----------
+    data : bytes
+        decompressed BAM alignment data starting with a block_size field
+    start : int
+        the offset of the first alignment in data [ Default : 0 ]
+
+    Returns
+    -------
+    AlignmentRecords
+        the fixed fields of each complete alignment. A trailing incomplete
+        alignment is not included and starts at the returned end
+    """
+    records = AlignmentRecords()
+    unpack_from = BAM_CORE.unpack_from
+    add_offset = records.offsets.append
+    add_length = records.lengths.append
+    add_name_length = records.name_lengths.append
+    add_flag = records.flags.append
+    add_ref_id = records.ref_ids.append
+    add_position = records.positions.append
+    add_tag_offset = records.tag_offsets.append
+    data_length = len(data)
+    offset = start
+    while offset + 36 <= data_length:
+        (block_size, ref_id, position, len_read_name, _, _,
+         number_cigar_operations, flag, len_sequence) = unpack_from(data,
+                                                                    offset)
+        end = offset + 4 + block_size
+        if end > data_length:
+            break
+        add_offset(offset)
+        add_length(block_size + 4)
+        add_name_length(len_read_name)
+        add_flag(flag)
+        add_ref_id(ref_id)
+        add_position(position)
+        add_tag_offset(36 + len_read_name
+                       + 4 * number_cigar_operations
+                       + (len_sequence + 1) // 2
+                       + len_sequence)
+        offset = end
+    records.end = offset
+    return records
+
+
 class AlignbatchFileReader(FileReader):
     """A BAM file reader that iterates batches of reads with the same name
 
@@ -52,11 +474,32 @@ class AlignbatchFileReader(FileReader):
         ubam : BinaryIO
             An binary (bytes) file or stream containing a valid uncompressed
             bam file conforming to the specification.
+        track_offsets : bool
+            record the offset (ubam.tell()) of the first alignment of each
+            batch in batch_offset. Use a pylazybam.bgzf.BgzfReader for ubam
+            to get BGZF virtual offsets. [ Default : False ]
+        spill_records : int, optional
+            batches with more than this number of alignments are moved to a
+            temporary file and yielded as a SpilledAlignBatch. The
+            temporary file is closed when the next batch is read, so a
+            spilled batch can not be used after the reader moves on.
+            [ Default : None (never spill) ]
+        max_secondary : int, optional
+            retain at most this number of secondary alignments per template.
+            Additional secondary alignments are discarded when read and are
+            not output or used for scoring with get_max_AS_XS.
+            [ Default : None (retain all) ]
+        tmpdir : str, optional
+            directory for temporary files of spilled batches
+        chunk_size : int, optional
+            bytes of decompressed data to parse at a time when neither
+            track_offsets nor batch limits are used [ Default : 1MB ]
 
     Yields
     ------
-        alignbatch : List[bytes]
-            A byte string of a bam alignment entry in raw binary format
+        alignbatch : AlignBatch or SpilledAlignBatch
+            A list of byte strings of bam alignment entries in raw binary
+            format with the same read name
 
     Attributes
     ----------
@@ -72,6 +515,10 @@ class AlignbatchFileReader(FileReader):
             A dictionary mapping reference names to the bam numeric identifier
         index_to_ref : Dict[int:str]
             A dictionary mapping bam reference numeric identifiers to names
+        batch_offset : int
+            The offset of the most recently yielded batch if track_offsets
+        discarded_secondary : int
+            The number of secondary alignments discarded by max_secondary
 
     Notes
     -----
@@ -107,27 +554,789 @@ class AlignbatchFileReader(FileReader):
 
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args,
+                 track_offsets: bool = False,
+                 spill_records: int = None,
+                 max_secondary: int = None,
+                 tmpdir: str = None,
+                 chunk_size: int = 2**20,
+                 **kwargs):
         super().__init__(*args, **kwargs)
-        self.alignment_batches = self._get_alignment_batches()
+        self.chunk_size = chunk_size
+        self.spill_records = spill_records
+        self.batch_offset = None
+        self.discarded_secondary = 0
+        if spill_records is not None or max_secondary is not None:
+            self.alignment_batches = self._get_bounded_alignment_batches(
+                                                track_offsets,
+                                                spill_records,
+                                                max_secondary,
+                                                tmpdir)
+        elif track_offsets:
+            self.alignment_batches = self._get_alignment_batches_with_offsets()
+        else:
+            self.alignment_batches = self._get_alignment_batches()
 
     def _get_alignment_batches(self) -> Generator[bytes, None, None]:
+        # alignments are parsed in bulk from chunks of decompressed data.
+        # The last template of a chunk may continue in the next chunk so is
+        # carried over until a new name or the end of the file is found
+        read = self._ubam.read
+        chunk_size = self.chunk_size
+        from_parsed = AlignBatch._from_parsed
+        data = b''
+        name = None
+        aligns, flags, tag_offsets = [], [], []
+        while True:
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            data = data + chunk if data else chunk
+            records = parse_alignment_records(data)
+            names = records.names(data)
+            starts = template_starts(names)
+            chunk_aligns = [data[offset:offset + length]
+                            for offset, length in zip(records.offsets,
+                                                      records.lengths)]
+            chunk_flags = records.flags.tolist()
+            chunk_tag_offsets = records.tag_offsets.tolist()
+            for start, end in zip(starts, starts[1:] + [len(names)]):
+                if names[start] == name:
+                    aligns.extend(chunk_aligns[start:end])
+                    flags.extend(chunk_flags[start:end])
+                    tag_offsets.extend(chunk_tag_offsets[start:end])
+                    continue
+                # a new name so the previous template is complete
+                if aligns:
+                    yield from_parsed(aligns, flags, tag_offsets, name)
+                name = names[start]
+                aligns = chunk_aligns[start:end]
+                flags = chunk_flags[start:end]
+                tag_offsets = chunk_tag_offsets[start:end]
+            data = data[records.end:]
+        if data:
+            raise ValueError("Incomplete alignment at the end of the file")
+        if aligns:
+            yield from_parsed(aligns, flags, tag_offsets, name)
+
+    def _get_alignment_batches_with_offsets(self
+                                            ) -> Generator[bytes, None, None]:
+        previous_name = None
+        alignbatch = []
+        next_offset = self._ubam.tell()
+        batch_offset = next_offset
+        for align in self.alignments:
+            offset = next_offset
+            next_offset = self._ubam.tell()
+            name = align[36:36 + align[12]]
+            if previous_name and name != previous_name:
+                self.batch_offset = batch_offset
+                yield AlignBatch(alignbatch, previous_name)
+                alignbatch = []
+                batch_offset = offset
+            alignbatch.append(align)
+            previous_name = name
+        if alignbatch:
+            self.batch_offset = batch_offset
+            yield AlignBatch(alignbatch, previous_name)
+
+    def _get_bounded_alignment_batches(self,
+                                       track_offsets: bool,
+                                       spill_records: int,
+                                       max_secondary: int,
+                                       tmpdir: str,
+                                       ) -> Generator[bytes, None, None]:
+        if spill_records is None:
+            spill_records = float('inf')
+        if max_secondary is None:
+            max_secondary = float('inf')
         previous_name = None
         alignbatch = []
+        secondary = 0
+        next_offset = self._ubam.tell() if track_offsets else None
+        batch_offset = next_offset
         for align in self.alignments:
-            name = get_raw_read_name(align, get_len_read_name(align))
+            if track_offsets:
+                offset = next_offset
+                next_offset = self._ubam.tell()
+            name = align[36:36 + align[12]]
             if previous_name and name != previous_name:
+                self.batch_offset = batch_offset
+                yield from self._yield_bounded_batch(alignbatch, previous_name)
+                alignbatch = []
+                secondary = 0
+                if track_offsets:
+                    batch_offset = offset
+            previous_name = name
+            if BAM_CORE.unpack_from(align)[7] & 0x100:
+                secondary += 1
+                if secondary > max_secondary:
+                    self.discarded_secondary += 1
+                    continue
+            if len(alignbatch) == spill_records:
+                spilled = SpilledAlignBatch(name, tmpdir=tmpdir)
+                spilled.extend(alignbatch)
+                alignbatch = spilled
+            alignbatch.append(align)
+        if alignbatch:
+            self.batch_offset = batch_offset
+            yield from self._yield_bounded_batch(alignbatch, previous_name)
+
+    @staticmethod
+    def _yield_bounded_batch(alignbatch: Union[List[bytes],
+                                               SpilledAlignBatch],
+                             name: bytes
+                             ) -> Generator[bytes, None, None]:
+        # a spilled batch is closed when the next batch is requested or the
+        # reader is discarded so temporary files do not accumulate
+        if isinstance(alignbatch, list):
+            yield AlignBatch(alignbatch, name)
+        else:
+            with alignbatch:
                 yield alignbatch
+
+    def get_alignbatch_at(self, offset: int) -> AlignBatch:
+        """Read the batch of alignments starting at an offset
+
+        This moves the underlying file pointer and should not be mixed with
+        iterating over the reader.
+
+        Parameters
+        ----------
+        offset : int
+            an offset from batch_offset (a virtual offset for BGZF readers)
+
+        Returns
+        -------
+        AlignBatch
+            the alignments with the same name as the alignment at offset
+        """
+        for batch_offset, alignbatch in self.iter_alignbatches_at(offset):
+            return alignbatch
+        return AlignBatch()
+
+    def iter_alignbatches_at(self, offset: int
+                             ) -> Generator[Tuple[int, AlignBatch], None, None]:
+        """Iterate over batches of alignments starting at an offset
+
+        This moves the underlying file pointer and should not be mixed with
+        iterating over the reader.
+
+        Parameters
+        ----------
+        offset : int
+            an offset from batch_offset (a virtual offset for BGZF readers)
+
+        Yields
+        ------
+        (int, AlignBatch)
+            the offset of each batch and the batch of alignments
+        """
+        self._ubam.seek(offset)
+        alignbatch = []
+        previous_name = None
+        batch_offset = offset
+        while True:
+            align_offset = self._ubam.tell()
+            raw_blocksize = self._ubam.read(4)
+            if not raw_blocksize:
+                break
+            align = raw_blocksize + self._ubam.read(
+                                        struct.unpack("<i", raw_blocksize)[0])
+            name = align[36:36 + align[12]]
+            if previous_name and name != previous_name:
+                yield batch_offset, AlignBatch(alignbatch, previous_name)
                 alignbatch = []
+                batch_offset = align_offset
             alignbatch.append(align)
             previous_name = name
         if alignbatch:
+            yield batch_offset, AlignBatch(alignbatch, previous_name)
+
+    def set_range(self, start: int, end: int = None):
+        """Restrict iteration to batches starting in a range of offsets
+
+        Parameters
+        ----------
+        start : int
+            the offset of the first batch (a virtual offset for BGZF readers)
+        end : int, optional
+            iteration stops at the first batch starting at or after end
+            [ Default : None (the end of the file) ]
+        """
+        self.alignment_batches = self._get_alignment_batches_in_range(start,
+                                                                      end)
+
+    def _get_alignment_batches_in_range(self, start, end
+                                        ) -> Generator[bytes, None, None]:
+        for batch_offset, alignbatch in self.iter_alignbatches_at(start):
+            if end is not None and batch_offset >= end:
+                break
+            self.batch_offset = batch_offset
             yield alignbatch
 
     def __next__(self):
         return next(self.alignment_batches)
 
 
+class BackgroundReader():
+    """A read only file that reads ahead from another file on a thread
+
+    Chunks are read from fileobj by a background thread while earlier
+    chunks are being processed. For a gzip or BGZF file this overlaps
+    decompression (which releases the GIL) with processing.
+
+    Parameters
+    ----------
+    fileobj : BinaryIO
+        a file to read sequentially eg from gzip.open
+    chunk_size : int
+        the number of bytes read from fileobj at a time [ Default : 1MB ]
+    depth : int
+        the number of chunks read ahead [ Default : 2 ]
+    """
+
+    def __init__(self, fileobj: BinaryIO, chunk_size: int = 2**20,
+                 depth: int = 2):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        self.chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._chunk = b''
+        self._position = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self._thread.start()
+
+    def _read_ahead(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self.fileobj.read(self.chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except Exception as error:
+            self._put(error)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _next_chunk(self) -> bytes:
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        if not item:
+            self._eof = True
+        return item
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while not self._eof:
+            available = len(self._chunk) - self._position
+            if 0 <= size <= available:
+                parts.append(self._chunk[self._position:self._position + size])
+                self._position += size
+                break
+            parts.append(self._chunk[self._position:])
+            size -= available
+            self._chunk = self._next_chunk()
+            self._position = 0
+        return b''.join(parts)
+
+    @property
+    def finished(self) -> bool:
+        """True once fileobj has been read to its end (or failed)"""
+        return not self._thread.is_alive()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.fileobj.close()
+
+
+# header lines that may differ between the files of an AlignbatchFileChain
+_CHAIN_VARIABLE_HEADER = (b'@RG', b'@PG', b'@CO')
+
+
+class AlignbatchFileChain():
+    """Read several name ordered BAM files as one stream of alignment batches
+
+    For samples sequenced in several lanes. The files are read in order as
+    if they had been concatenated. All headers are read when the chain is
+    created and must have the same references and @HD and @SQ lines. The
+    @RG lines of all files are combined in raw_header. Each file is read
+    through a BackgroundReader, so the start of the next file is already
+    decompressed when the current file is finished.
+
+    With lazy, only the first file is opened when the chain is created and
+    each later file is opened once the previous file has been read to its
+    end (so only the chunks read ahead remain). This suits files that are
+    still being written (see BgzfFollower), as a follower only starts
+    waiting for its file when the previous lane is nearly consumed. The
+    headers of later files are then checked when they are opened, and their
+    @RG lines are not in raw_header.
+
+    Parameters
+    ----------
+    files : Iterable[str or Path]
+        BAM files in the order to read them
+    open_file : Callable
+        function to open and decompress a file [ Default : gzip.open ]
+    lazy : bool
+        open each file after the previous file is read [ Default : False ]
+    **kwargs
+        keyword arguments for AlignbatchFileReader. track_offsets is not
+        supported as offsets are not unique across files
+
+    Yields
+    ------
+    alignbatch : AlignBatch or SpilledAlignBatch
+        as AlignbatchFileReader
+
+    Raises
+    ------
+    ValueError
+        if the headers of the files do not agree
+    """
+
+    def __init__(self, files: Iterable[Union[str, Path]],
+                 open_file: Callable = gzip.open,
+                 lazy: bool = False,
+                 **kwargs):
+        if kwargs.get('track_offsets'):
+            raise ValueError("Offsets can not be tracked across several files")
+        self._files = list(files)
+        self._open_file = open_file
+        self._kwargs = kwargs
+        self._readers = []
+        try:
+            for file in self._files[:1] if lazy else self._files:
+                self._open(file)
+        except Exception:
+            self.close()
+            raise
+        first = self._readers[0]
+        self.raw_refs = first.raw_refs
+        self.refs = first.refs
+        self.index_to_ref = first.index_to_ref
+        self.ref_to_index = first.ref_to_index
+        self.sort_order = first.sort_order
+        self.raw_header = self._combine_headers()
+        self.header = self.raw_header[4:].decode('latin-1')
+        self.batch_offset = None
+        self.spill_records = kwargs.get('spill_records')
+        self._ubam = first._ubam
+        self.alignment_batches = self._get_alignment_batches()
+
+    def _open(self, file: Union[str, Path]):
+        reader = AlignbatchFileReader(BackgroundReader(self._open_file(file)),
+                                      **self._kwargs)
+        self._readers.append(reader)
+        self._check_header(reader, file)
+
+    @staticmethod
+    def _fixed_header_lines(reader) -> List[bytes]:
+        return [line for line in reader.raw_header[4:].rstrip(b'\0').split(b'\n')
+                if line and not line.startswith(_CHAIN_VARIABLE_HEADER)]
+
+    def _check_header(self, reader, file):
+        first = self._readers[0]
+        if (reader.raw_refs != first.raw_refs
+                or self._fixed_header_lines(reader)
+                != self._fixed_header_lines(first)):
+            raise ValueError(f"The header of {file} does not match the header "
+                             f"of {first._ubam.name}")
+
+    def _combine_headers(self) -> bytes:
+        header = self._readers[0].raw_header[4:].rstrip(b'\0')
+        lines = header.split(b'\n')
+        for reader in self._readers[1:]:
+            for line in reader.raw_header[4:].rstrip(b'\0').split(b'\n'):
+                if line.startswith(b'@RG') and line not in lines:
+                    lines.append(line)
+        header = b'\n'.join(line for line in lines if line) + b'\n'
+        return struct.pack('<i', len(header)) + header
+
+    @property
+    def discarded_secondary(self) -> int:
+        """The number of secondary alignments discarded in all files"""
+        return sum(reader.discarded_secondary for reader in self._readers)
+
+    def _get_alignment_batches(self) -> Generator[bytes, None, None]:
+        for index, file in enumerate(self._files):
+            if index == len(self._readers):
+                self._open(file)
+            reader = self._readers[index]
+            self._ubam = reader._ubam
+            for alignbatch in reader:
+                # open the next lazy file once this one is read ahead to
+                # its end
+                if (len(self._readers) == index + 1 < len(self._files)
+                        and reader._ubam.finished):
+                    self._open(self._files[index + 1])
+                yield alignbatch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.alignment_batches)
+
+    def close(self):
+        for reader in self._readers:
+            reader.close()
+
+
+# BAM codes of SAM cigar operations and the 4 bit encoding of sequence bases
+_SAM_CIGAR_OPERATIONS = {operation: code
+                         for code, operation in enumerate(b'MIDNSHP=X')}
+_SAM_BASES = {base: code for code, base in enumerate(b'=ACMGRSVTWYHKDBN')}
+# struct formats of SAM B array tag subtypes
+_SAM_ARRAY_FORMATS = {b'c': 'b', b'C': 'B', b's': 'h', b'S': 'H',
+                      b'i': 'i', b'I': 'I', b'f': 'f'}
+
+
+def _sam_integer_tag(value: int) -> bytes:
+    # the smallest BAM integer type holding value, as chosen by samtools
+    if value >= 0:
+        for code, fmt, limit in ((b'C', '<B', 0xff), (b'S', '<H', 0xffff)):
+            if value <= limit:
+                return code + struct.pack(fmt, value)
+        return b'I' + struct.pack('<I', value)
+    for code, fmt, limit in ((b'c', '<b', -0x80), (b's', '<h', -0x8000)):
+        if value >= limit:
+            return code + struct.pack(fmt, value)
+    return b'i' + struct.pack('<i', value)
+
+
+def _sam_header_refs(header: bytes) -> List[Tuple[bytes, int]]:
+    # the names and lengths of the @SQ lines of a SAM header
+    refs = []
+    for line in header.split(b'\n'):
+        if line.startswith(b'@SQ\t'):
+            fields = dict(field.split(b':', 1)
+                          for field in line.rstrip(b'\r').split(b'\t')[1:]
+                          if b':' in field)
+            refs.append((fields[b'SN'], int(fields[b'LN'])))
+    return refs
+
+
+def sam_header_to_bam(header: bytes) -> bytes:
+    """Encode SAM header lines as the start of an uncompressed BAM file
+
+    Parameters
+    ----------
+    header : bytes
+        the SAM header lines (starting with @) including newlines
+
+    Returns
+    -------
+    bytes
+        the BAM magic, header text and references of the @SQ lines. An
+        @HD line with SO:unknown is added if there is none (eg bwa output)
+        as readers require the sort order
+    """
+    refs = _sam_header_refs(header)
+    if not header.startswith(b'@HD\t'):
+        header = b'@HD\tVN:1.6\tSO:unknown\n' + header
+    data = [b'BAM\x01', struct.pack('<i', len(header)), header,
+            struct.pack('<i', len(refs))]
+    for name, length in refs:
+        data.append(struct.pack('<i', len(name) + 1) + name + b'\0'
+                    + struct.pack('<i', length))
+    return b''.join(data)
+
+
+def encode_sam_record(line: bytes, ref_to_index: Dict[bytes, int]) -> bytes:
+    """Encode a SAM alignment line as a raw BAM alignment
+
+    Parameters
+    ----------
+    line : bytes
+        a SAM alignment line
+    ref_to_index : Dict[bytes, int]
+        the index of each reference name in the @SQ lines of the header
+
+    Returns
+    -------
+    bytes
+        the raw BAM alignment including the four byte block size
+
+    Raises
+    ------
+    ValueError
+        if the line has fewer than 11 fields or an unknown reference
+    """
+    fields = line.rstrip(b'\r\n').split(b'\t')
+    if len(fields) < 11:
+        raise ValueError(f"Not a SAM alignment line: {line[:80]}")
+    (name, flag, ref, pos, mapq, cigar,
+     next_ref, next_pos, tlen, seq, qual) = fields[:11]
+    try:
+        ref_index = -1 if ref == b'*' else ref_to_index[ref]
+        if next_ref == b'=':
+            next_ref_index = ref_index
+        else:
+            next_ref_index = -1 if next_ref == b'*' else ref_to_index[next_ref]
+    except KeyError as error:
+        raise ValueError(f"Reference {error.args[0].decode()} is not in the "
+                         "SAM header") from None
+    pos = int(pos) - 1
+    operations = []
+    reference_length = 0
+    if cigar != b'*':
+        for length, operation in re.findall(rb'(\d+)([MIDNSHP=X])', cigar):
+            code = _SAM_CIGAR_OPERATIONS[operation[0]]
+            operations.append(int(length) << 4 | code)
+            if code in (0, 2, 3, 7, 8): # M D N = X
+                reference_length += int(length)
+    if seq == b'*':
+        seq_length = 0
+        packed_seq = b''
+    else:
+        seq_length = len(seq)
+        codes = [_SAM_BASES.get(base, 15) for base in seq.upper()]
+        if seq_length % 2:
+            codes.append(0)
+        packed_seq = bytes(codes[i] << 4 | codes[i + 1]
+                           for i in range(0, len(codes), 2))
+    if qual == b'*':
+        qual = b'\xff' * seq_length
+    else:
+        qual = bytes(quality - 33 for quality in qual)
+    tags = []
+    for tag in fields[11:]:
+        key, tag_type, value = tag[:2], tag[3:4], tag[5:]
+        if tag_type == b'i':
+            tags.append(key + _sam_integer_tag(int(value)))
+        elif tag_type == b'A':
+            tags.append(key + b'A' + value[:1])
+        elif tag_type == b'f':
+            tags.append(key + b'f' + struct.pack('<f', float(value)))
+        elif tag_type in (b'Z', b'H'):
+            tags.append(key + tag_type + value + b'\0')
+        elif tag_type == b'B':
+            subtype, *values = value.split(b',')
+            fmt = _SAM_ARRAY_FORMATS[subtype]
+            convert = float if fmt == 'f' else int
+            tags.append(key + b'B' + subtype
+                        + struct.pack(f'<i{len(values)}{fmt}', len(values),
+                                      *map(convert, values)))
+        else:
+            raise ValueError(f"Unknown SAM tag type in {tag.decode()}")
+    record = b''.join([struct.pack('<iiBBHHHiiii',
+                                   ref_index,
+                                   pos,
+                                   len(name) + 1,
+                                   int(mapq),
+                                   reg2bin(pos,
+                                           pos + max(reference_length, 1)),
+                                   len(operations),
+                                   int(flag),
+                                   seq_length,
+                                   next_ref_index,
+                                   int(next_pos) - 1,
+                                   int(tlen)),
+                       name, b'\0',
+                       array('I', operations).tobytes(),
+                       packed_seq,
+                       qual,
+                       *tags])
+    return struct.pack('<i', len(record)) + record
+
+
+class SamStreamReader():
+    """A read only file of uncompressed BAM encoded from a SAM text stream
+
+    Parameters
+    ----------
+    fileobj : BinaryIO
+        a SAM format stream (eg the standard output of an aligner)
+
+    Raises
+    ------
+    ValueError
+        when read if a line is not a valid SAM alignment
+    """
+
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        header = []
+        line = fileobj.readline()
+        while line.startswith(b'@'):
+            header.append(line)
+            line = fileobj.readline()
+        header = b''.join(header)
+        self._buffer = bytearray(sam_header_to_bam(header))
+        self._ref_to_index = {name: index for index, (name, length)
+                              in enumerate(_sam_header_refs(header))}
+        self._line = line
+
+    def read(self, size: int = -1) -> bytes:
+        while self._line and (size < 0 or len(self._buffer) < size):
+            if self._line.strip():
+                self._buffer += encode_sam_record(self._line,
+                                                  self._ref_to_index)
+            self._line = self.fileobj.readline()
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def close(self):
+        self.fileobj.close()
+
+
+def open_alignment_stream(fileobj: BinaryIO) -> BinaryIO:
+    """Open a SAM, uncompressed BAM or BGZF BAM stream as uncompressed BAM
+
+    The format is recognised from the first bytes without reading past
+    them, so the stream does not need to be seekable.
+
+    Parameters
+    ----------
+    fileobj : BinaryIO
+        a readable binary stream eg the standard output of an aligner
+
+    Returns
+    -------
+    BinaryIO
+        an uncompressed BAM stream for AlignbatchFileReader
+    """
+    if not hasattr(fileobj, 'peek'):
+        fileobj = io.BufferedReader(fileobj)
+    start = fileobj.peek(4)[:4]
+    if start == b'BAM\x01':
+        return fileobj
+    if start[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    return SamStreamReader(fileobj)
+
+
+def format_aligner_command(template: str, reads: List[str] = ()) -> str:
+    """Fill the read filenames into an aligner command template
+
+    Parameters
+    ----------
+    template : str
+        a shell command where {R1} and {R2} are replaced by the first and
+        second reads files and {reads} by all the reads files
+    reads : List[str]
+        the reads filenames. Filenames are quoted for the shell
+
+    Returns
+    -------
+    str
+        the command
+
+    Examples
+    --------
+    >>> format_aligner_command('bowtie2 -x hg38 -1 {R1} -2 {R2}',
+    >>>                        ['a_R1.fq.gz', 'a_R2.fq.gz'])
+    'bowtie2 -x hg38 -1 a_R1.fq.gz -2 a_R2.fq.gz'
+    """
+    quoted = [shlex.quote(str(filename)) for filename in reads]
+    command = template.replace('{reads}', ' '.join(quoted))
+    for number, filename in enumerate(quoted, 1):
+        command = command.replace(f'{{R{number}}}', filename)
+    missing = re.findall(r'\{R\d+\}', command)
+    if missing:
+        raise ValueError(f"No reads file for {missing[0]} in {template}")
+    return command
+
+
+class AlignerProcess():
+    """Run an aligner command and read its standard output as BAM
+
+    The command is run by the shell (so may be a pipeline) and may write
+    SAM, uncompressed BAM or BGZF BAM. Nothing is written to disk. Reading
+    two aligners in lockstep with xenomap applies backpressure: an aligner
+    blocks once the pipe and the AlignbatchFileReader chunk (1MB) ahead of
+    the classification are full, so neither runs far ahead of the other.
+
+    Parameters
+    ----------
+    command : str
+        the shell command
+    pipe_size : int
+        buffer size of the pipe reader [ Default : 64KB ]
+
+    Attributes
+    ----------
+    process : subprocess.Popen
+    stream : BinaryIO
+        the uncompressed BAM output for AlignbatchFileReader
+
+    Examples
+    --------
+    >>> with AlignerProcess('bowtie2 -x hg38 -U reads.fq.gz') as aligner:
+    >>>     for alignbatch in AlignbatchFileReader(aligner.stream):
+    >>>         print(alignbatch.name)
+    """
+
+    def __init__(self, command: str, pipe_size: int = 2**16):
+        self.command = command
+        self.process = subprocess.Popen(command, shell=True,
+                                        stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE,
+                                        bufsize=pipe_size)
+        try:
+            self.stream = open_alignment_stream(self.process.stdout)
+        except Exception:
+            self.terminate()
+            raise
+
+    def close(self):
+        """Wait for the command to finish
+
+        Raises
+        ------
+        ValueError
+            if the command exits with an error status
+        """
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        if returncode:
+            raise ValueError(f"The aligner command exited with status "
+                             f"{returncode}: {self.command}")
+
+    def terminate(self):
+        """Stop the command without waiting for its output"""
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.stdout.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
 def calc_cigar_based_score(cigar_string: bytes,
                          NM: int = None,
                          mismatch: int = -6,
@@ -248,7 +1457,7 @@ def split_forward_reverse(alignments: List[bytes]
 
     Parameters
     ----------
-    alignments : List[bytes]
+    alignments : List[bytes] or AlignBatch
         a list of BAM alignments in raw binary format containing forward
         and optionally reverse alignments
 
@@ -262,6 +1471,8 @@ def split_forward_reverse(alignments: List[bytes]
     ValueError
         if there are any reads that do not have the forward or reverse flag
     """
+    if isinstance(alignments, (AlignBatch, SpilledAlignBatch)):
+        return alignments.split_forward_reverse()
     forward = []
     reverse = []
     for align in alignments:
@@ -283,7 +1494,7 @@ def get_bamprimary_AS_XS(alignments: List[bytes],
 
     Parameters
     ----------
-    alignments : List[bytes]
+    alignments : List[bytes] or AlignBatch
         a list of binary format BAM alignments from the same read.
         Should contain only forward or reverse reads and only one primary flag
 
@@ -308,7 +1519,14 @@ def get_bamprimary_AS_XS(alignments: List[bytes],
 
     """
 
-    bamprimary = [a for a in alignments if not is_flag(a,FLAGS['secondary'])]
+    if isinstance(alignments, AlignBatch):
+        bamprimary = alignments.scores(AS_function, XS_function,
+                                       bamprimary=True)
+        if len(bamprimary) == 1:
+            return bamprimary[0]
+    else:
+        bamprimary = [a for a in alignments
+                      if not is_flag(a,FLAGS['secondary'])]
     # We keep unmapped reads as this is an expected state in secondary species
     if len(bamprimary) == 1:
         AS = AS_function(bamprimary[0])
@@ -330,7 +1548,7 @@ def get_max_AS_XS(alignments: List[bytes],
 
     Parameters
     ----------
-    alignments : List[bytes]
+    alignments : List[bytes] or AlignBatch
         a list of binary format BAM alignments.
 
     AS_function : Callable[[bytes], int]
@@ -351,11 +1569,21 @@ def get_max_AS_XS(alignments: List[bytes],
         a tuple of the alignment score AS and suboptimal alignment score XS
     """
 
-    if not alignments:
-        return (default,default)
-    scores = sorted([(AS_function(a),XS_function(a)) for a in alignments],
-                    key=sort_key)
-    return scores[-1]
+    if isinstance(alignments, AlignBatch):
+        score = alignments.score
+        scores = ((score(i, AS_function), score(i, XS_function))
+                  for i in range(len(alignments)))
+    else:
+        scores = ((AS_function(a),XS_function(a)) for a in alignments)
+    # a single pass equivalent to sorted(scores, key=sort_key)[-1]
+    best = (default,default)
+    best_key = None
+    for item in scores:
+        item_key = item if sort_key is None else sort_key(item)
+        if best_key is None or item_key >= best_key:
+            best = item
+            best_key = item_key
+    return best
 
 
 def get_mapping_state(AS1: int,
@@ -455,408 +1683,4568 @@ class DummyFile(): #pragma: no cover
         pass
 
 
-class XenomapperOutputWriter():
-    """Container class grouping xenomapper output files & manipulating headers
+# uncompressed payload of a BGZF block as written by pylazybam BgzfWriter
+BGZF_BLOCK_SIZE: int = 65536
 
-    Updated headers are written to these files on initialization. The primary
-    BAM header is used for all files except secondary_specific and
-    secondary_multi.
-    A @PO line is added to the file indicating the id and program as xenomapper
-    with the version, a description field indicating the type of xenomapper
-    output in the file (eg primary_specific) and the command used to run it.
+
+class BufferedCategorySink():
+    """Buffer whole alignment batches for a BAM writer
+
+    Alignments are joined into a single buffer and passed to the writer
+    one BGZF block of data at a time, rather than as one write call per
+    alignment.
 
     Parameters
     ----------
-    primary_raw_header : bytes
-        the raw header from the primary species BAM file
-    primary_raw_refs : bytes
-        the raw reference sequence info from the primary species BAM file
-    secondary_raw_header : bytes
-        the raw header from the secondary species BAM file
-    secondary_raw_refs : bytes
-        the raw reference sequence info from the secondary species BAM file
-    primary_specific : str or Path or BinaryIO, optional
-        output file for uniquely mapping primary specific alignments
-        [ Default : None ]
-    primary_multi : str or Path or BinaryIO, optional
-        output file for multimapping primary specific alignments
-        [ Default : None ]
-    secondary_specific : str or Path or BinaryIO, optional
-        output file for uniquely mapping secondary specific alignments
-        [ Default : None ]
-    secondary_multi : str or Path or BinaryIO, optional
-        output file for multimapping secondary specific alignments
-        [ Default : None ]
-    unresolved : str or Path or BinaryIO, optional
-        output file for alignments where primary or secondary is ambiguous
-        [ Default : None ]
-    unassigned : str or Path or BinaryIO, optional
-        output file for reads that do not map sufficiently well in either BAM
-        [ Default : None ]
-    basename : str, optional
-        filename stem to derive all output filenames <basename>_<outfilename>
-        (eg basename='Foo' -> Foo_primary_specific, ... Foo_unassigned)
-        [ Default : None ]
-    cmdline : str, optional
-        The commandline to include in the output BAM header
-    compresslevel : int, optional
-        gzip compression level for output file
-        [ Default : 6 ]
+    fileobj : pylazybam.bam.FileWriter
+        the writer to buffer. Headers should already be written
+    block_size : int
+        bytes of data to pass to the writer in each call
+        [ Default : BGZF_BLOCK_SIZE ]
+
+    Notes
+    -----
+    Other attributes are looked up on the underlying writer, but tell()
+    does not include data held in the buffer until close().
+    """
+
+    def __init__(self, fileobj, block_size: int = BGZF_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self._buffer = bytearray()
+
+    def _write_blocks(self):
+        block_size = self.block_size
+        while len(self._buffer) >= block_size:
+            self.fileobj.write(bytes(self._buffer[:block_size]))
+            del self._buffer[:block_size]
+
+    def write(self, data: bytes):
+        self._buffer += data
+        if len(self._buffer) >= self.block_size:
+            self._write_blocks()
+
+    def write_alignbatch(self, alignments: List[bytes]):
+        """Write a batch of alignments from one template
+
+        Parameters
+        ----------
+        alignments : List[bytes]
+            a list of BAM alignments in raw binary format from one template
+        """
+        if isinstance(alignments, list):
+            self._buffer += b''.join(alignments)
+        else:
+            for align in alignments:
+                self._buffer += align
+                if len(self._buffer) >= self.block_size:
+                    self._write_blocks()
+        if len(self._buffer) >= self.block_size:
+            self._write_blocks()
+
+    def flush(self):
+        """Pass all buffered data to the underlying writer"""
+        self._write_blocks()
+        if self._buffer:
+            self.fileobj.write(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.fileobj.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def set_bgzf_compresslevel(fileobj, compresslevel: int) -> bool:
+    """Change the compression level of the blocks a BAM writer has yet to write
+
+    Parameters
+    ----------
+    fileobj : pylazybam.bam.FileWriter or BufferedCategorySink
+        a BAM writer. Other writers (eg FASTQ or DummyFile) are unchanged
+    compresslevel : int
+        zlib compression level for subsequent BGZF blocks
 
     Returns
     -------
-    A container class with __get_item__ , keys, close
+    bool
+        True if the writer compresses BGZF blocks and was changed
+    """
+    bgzf_file = getattr(fileobj, 'bgzf_file', None)
+    if not isinstance(bgzf_file, BgzfWriter):
+        return False
+    bgzf_file.compresslevel = compresslevel
+    return True
 
-    Examples
-    --------
 
-    >>> xow = XenomapperOutputWriter(phead,pref,shead,sref,basename='/foo')
-    >>> for key in xow.keys():
-    >>>     xow[key].write(data)
-    >>> xow.close()
+def get_bgzf_writers(fileobj) -> List[BgzfWriter]:
+    """The BGZF writers used by a BAM or FASTQ output
 
+    Parameters
+    ----------
+    fileobj : pylazybam.bam.FileWriter or BufferedCategorySink or FastqFileWriter
+        an output writer. Other writers (eg DummyFile) have no BGZF writers
+
+    Returns
+    -------
+    List[BgzfWriter]
     """
+    bgzf_files = [getattr(fileobj, name, None)
+                  for name in ('bgzf_file', 'forward_file', 'reverse_file')]
+    unique = []
+    for bgzf_file in bgzf_files:
+        if isinstance(bgzf_file, BgzfWriter) and bgzf_file not in unique:
+            unique.append(bgzf_file)
+    return unique
 
-    def __init__(self,
-                 primary_raw_header: bytes,
-                 primary_raw_refs: bytes,
-                 secondary_raw_header: bytes,
-                 secondary_raw_refs: bytes,
-                 primary_specific: Union[str, Path, BinaryIO, None] = None,
-                 primary_multi: Union[str, Path, BinaryIO, None] = None,
-                 secondary_specific: Union[str, Path, BinaryIO, None] = None,
-                 secondary_multi: Union[str, Path, BinaryIO, None] = None,
-                 unresolved: Union[str, Path, BinaryIO, None] = None,
-                 unassigned: Union[str, Path, BinaryIO, None] = None,
-                 basename: str = None,
-                 cmdline: str = '',
-                 compresslevel: int = 6,
-                 ):
-        #get only the 5th to 11th arguments to __init__
-        # This works python >=3.7 but not 3.6 as dict order issues
-        #file_arguments = dict(list(locals().items())[5:11])
 
-        file_arguments = {'primary_specific' : primary_specific,
-                          'primary_multi' : primary_multi,
-                          'secondary_specific' : secondary_specific,
-                          'secondary_multi' : secondary_multi,
-                          'unresolved' : unresolved,
-                          'unassigned' : unassigned,
-                          }
+def suspend_bgzf_writer(bgzf_file: BgzfWriter):
+    """Write buffered data and close the file without the BGZF EOF block
 
-        if basename == None:
-            self._fileobjects = {'primary_specific': DummyFile(),
-                                'primary_multi': DummyFile(),
-                                'secondary_specific': DummyFile(),
-                                'secondary_multi': DummyFile(),
-                                'unassigned': DummyFile(),
-                                'unresolved': DummyFile(),
-                                }
-            for key in file_arguments:
-                if file_arguments[key]:
-                    self._fileobjects[key] = bam.FileWriter(file_arguments[key],
-                                                    compresslevel=compresslevel)
-        else:
-            self._fileobjects = {}
-            for key in file_arguments:
-                self._fileobjects[key] = bam.FileWriter(f"{basename}_{key}.bam",
-                                                    compresslevel=compresslevel)
+    The file can be reopened to append with resume_bgzf_writer. Only
+    writers opened with a filename can be resumed.
 
-        self._write_headers(primary_raw_header,
-                             primary_raw_refs,
-                             secondary_raw_header,
-                             secondary_raw_refs,
-                             cmdline=cmdline)
+    Parameters
+    ----------
+    bgzf_file : BgzfWriter
+        an open BGZF writer
+    """
+    if bgzf_file._buffer:
+        bgzf_file.flush()
+    bgzf_file._handle.close()
 
 
-    def _write_headers(self, primary_raw_header,
-                             primary_raw_refs,
-                             secondary_raw_header,
-                             secondary_raw_refs,
-                             cmdline=''):
-        """A function for updating and writing headers to output file
+def resume_bgzf_writer(bgzf_file: BgzfWriter):
+    """Reopen a writer closed by suspend_bgzf_writer to append to the file
 
-        Parameters
-        ----------
-        primary_raw_header : bytes
-            the raw header from the primary species BAM file
-        primary_raw_refs : bytes
-            the raw reference sequence info from the primary species BAM file
-        secondary_raw_header : bytes
-            the raw header from the secondary species BAM file
-        secondary_raw_refs : bytes
-            the raw reference sequence info from the secondary species BAM file
-        cmdline : str, optional
-            The commandline to include in the output BAM header
-        """
-        # write out the correct species header to all of the files
-        # use primary for unresolved and unassigned
-        # add @PO and @CO fields to the header
-        for key in self._fileobjects:
-            if key in ['secondary_specific','secondary_multi']:
-                self._fileobjects[key].raw_header = secondary_raw_header
-                self._fileobjects[key].raw_refs = secondary_raw_refs
-            else:
-                self._fileobjects[key].raw_header = primary_raw_header
-                self._fileobjects[key].raw_refs = primary_raw_refs
-            self._fileobjects[key].update_header(id = 'xenomapper',
-                                                    program = 'xenomapper',
-                                                    version = __version__,
-                                                    description= key,
-                                                    command=cmdline,)
-            comment = f"@CO\tThis file contains alignments assigned as {key}\n"
-            self._fileobjects[key].raw_header += comment.encode('utf-8')
-            self._fileobjects[key].update_header_length()
-            self._fileobjects[key].write_header()
+    Parameters
+    ----------
+    bgzf_file : BgzfWriter
+        a suspended BGZF writer
+    """
+    bgzf_file._handle = open(bgzf_file._handle.name, 'ab')
 
 
-    def __getitem__(self, key):
-        return self._fileobjects[key]
+# deflate implementations in order of preference for get_codec('auto') with
+# the modules providing their zlib and gzip interfaces
+CODEC_MODULES = OrderedDict([('isal', ('isal.isal_zlib', 'isal.igzip')),
+                             ('zlib-ng', ('zlib_ng.zlib_ng',
+                                          'zlib_ng.gzip_ng')),
+                             ('zlib', ('zlib', 'gzip')),
+                             ])
 
-    def keys(self):
-        """return the keys for the file output objects
-        Returns
-        -------
-        Iterable[str]
-        """
-        return self._fileobjects.keys()
 
-    def __enter__(self):
-        return self
+class Codec():
+    """A deflate implementation for reading and writing BGZF files
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+    All codecs write standard BGZF blocks readable by any BAM reader.
 
-    def close(self):
-        for fileobj in self._fileobjects:
-            self._fileobjects[fileobj].close()
+    Parameters
+    ----------
+    name : str
+        a key of CODEC_MODULES [ Default : 'zlib' ]
 
+    Attributes
+    ----------
+    zlib : module
+        the zlib compatible module of the codec
+    gzip : module
+        the gzip compatible module of the codec
 
-def xenomap_states(primary_aligns: Iterable[bytes],
-                   secondary_aligns: Iterable[bytes],
-                   score_function: Callable = get_bamprimary_AS_XS,
-                   AS_function: Callable = get_AS,
-                   XS_function: Callable = get_XS,
-                   min_score: int = MIN32INT,
-                   ) -> Tuple[int,int]:
-    """Get the xenomapping state for the forward and reverse reads
+    Raises
+    ------
+    ValueError
+        if the codec is unknown or not installed
+    """
 
-    primary_aligns : List[bytes]
-        a list of binary format BAM alignments from the primary BAM.
+    def __init__(self, name: str = 'zlib'):
+        if name not in CODEC_MODULES:
+            raise ValueError(f"{name} is not a known codec. Choose from "
+                             f"{', '.join(CODEC_MODULES)}")
+        zlib_module, gzip_module = CODEC_MODULES[name]
+        try:
+            self.zlib = importlib.import_module(zlib_module)
+            self.gzip = importlib.import_module(gzip_module)
+        except ImportError:
+            raise ValueError(f"The {name} codec is not installed")
+        self.name = name
 
-    secondary_aligns : List[bytes]
-        a list of binary format BAM alignments from the primary BAM.
+    def __repr__(self):
+        return f"Codec({self.name!r})"
 
-    score_function : Callable
-        a xenomapper alignment batch calling function
-        get_bamprimary_AS_XS or get_max_AS_XS
+    def compresslevel(self, compresslevel: int) -> int:
+        """The codec level for a zlib compression level
 
-    AS_function : Callable[[bytes], int]
-        a function that accepts a BAM alignment bytestring and returns the AS
-        score (alignment score) as an integer
-        get_AS or get_cigar_based_score
+        isal has levels 0 (fastest) to 3 so zlib levels 0-2, 3-5, 6-8 and 9
+        are mapped to these.
+        """
+        if self.name == 'isal':
+            return min(compresslevel // 3, 3)
+        return compresslevel
 
-    XS_function : Callable[[bytes], int]
-        a function that accepts a BAM alignment bytestring and returns the XS
-        score as an integer
-        get_XS, get_ZS, always_zero, or always_very_negative
+    def compress(self, data: bytes, compresslevel: int = 6) -> bytes:
+        """Raw deflate compress data"""
+        compressor = self.zlib.compressobj(self.compresslevel(compresslevel),
+                                           self.zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
 
-    min_score : int [ Default : -2**31 ]
-        the score that matches must exceed in order to be
-        considered valid matches. Note scores equalling this
-        value will also be considered not valid matches.
+    def decompress(self, data: bytes) -> bytes:
+        """Decompress raw deflate data"""
+        return self.zlib.decompress(data, -15)
 
-    Returns
-    -------
-    Tuple[str,str]
-        the xenomapper state of the forward and reverse read
+    def open(self, filename: Union[str, Path], mode: str = 'rb'):
+        """Open a gzip or BGZF file for sequential reading"""
+        return self.gzip.open(filename, mode)
 
-    """
 
-    primary_name = get_raw_read_name(primary_aligns[0],
-                                     get_len_read_name(primary_aligns[0]))
-    secondary_name = get_raw_read_name(secondary_aligns[0],
-                                     get_len_read_name(secondary_aligns[0]))
-    if primary_name != secondary_name:
-        raise ValueError("Primary and secondary read names do not match: "
-                         f"{primary_name} != {secondary_name}")
-    prim_f_aligns, prim_r_aligns = split_forward_reverse(primary_aligns)
-    sec_f_aligns, sec_r_aligns = split_forward_reverse(secondary_aligns)
-    prim_f_AS, prim_f_XS = score_function(prim_f_aligns,
-                                          AS_function=AS_function,
-                                          XS_function=XS_function)
-    sec_f_AS, sec_f_XS = score_function(sec_f_aligns,
-                                        AS_function = AS_function,
-                                        XS_function = XS_function)
-    forward_state = get_mapping_state(prim_f_AS, prim_f_XS,
-                                      sec_f_AS, sec_f_XS,
-                                      min_score)
+def available_codecs() -> List[str]:
+    """The names of the installed codecs in order of preference
 
-    if not prim_r_aligns and not sec_r_aligns:
-        reverse_state = None
-    else:
-        prim_r_AS, prim_r_XS = score_function(prim_r_aligns,
-                                                AS_function = AS_function,
-                                                XS_function = XS_function)
-        sec_r_AS, sec_r_XS = score_function(sec_r_aligns,
-                                            AS_function = AS_function,
-                                            XS_function = XS_function)
-        reverse_state = get_mapping_state(prim_r_AS, prim_r_XS,
-                                          sec_r_AS, sec_r_XS,
-                                          min_score)
-    return forward_state, reverse_state
+    Returns
+    -------
+    List[str]
+    """
+    available = []
+    for name in CODEC_MODULES:
+        try:
+            Codec(name)
+        except ValueError:
+            continue
+        available.append(name)
+    return available
 
 
-def state_map(forward_state: str,
-              reverse_state: str) -> str:
-    # logic is directly copied from xenomapper 1.0
-    """State map for inferring the fragment state from forward & reverse
-    Reads where there is stronger but not contradictory evidence will be
-    assigned the more specific state.
+def get_codec(name: str = 'auto') -> Codec:
+    """Get a codec by name
 
     Parameters
     ----------
-    forward_state : str
-        a xenomapper state for the forward read
-        (primary_specific,primary_multi,secondary_specific,secondary_multi,
-        unassigned, unresolved)
-
-    reverse_state: str or None
-        a xenomapper state for the reverse read or None
-        (primary_specific,primary_multi,secondary_specific,secondary_multi,
-        unassigned, unresolved) or None
+    name : str
+        a codec name or 'auto' for the first installed codec of
+        CODEC_MODULES, falling back to zlib [ Default : 'auto' ]
 
     Returns
     -------
-    str
-        a xenomapper state for the fragment
-        (primary_specific,primary_multi,secondary_specific,secondary_multi,
-        unassigned, unresolved)
+    Codec
 
-    Notes
-    -----
+    Raises
+    ------
+    ValueError
+        if a named codec is unknown or not installed
+    """
+    if name == 'auto':
+        name = available_codecs()[0]
+    return Codec(name)
+
+
+class CodecBgzfWriter(BgzfWriter):
+    """A BgzfWriter compressing blocks with a Codec
+
+    Parameters
+    ----------
+    filename, mode, fileobj, compresslevel
+        as for BgzfWriter
+    codec : Codec, optional
+        [ Default : Codec('zlib') ]
+
+    Raises
+    ------
+    ValueError
+        when writing, if a block compresses to more than the 64KiB a BGZF
+        block can hold
+    """
+
+    def __init__(self, filename=None, mode="w", fileobj=None,
+                 compresslevel: int = 6, codec: Codec = None):
+        super().__init__(filename=filename, mode=mode, fileobj=fileobj,
+                         compresslevel=compresslevel)
+        self.codec = Codec('zlib') if codec is None else codec
+
+    def _write_block(self, block):
+        self._handle.write(compress_bgzf_block(block, self.compresslevel,
+                                               codec=self.codec))
+
+
+def set_bgzf_codec(fileobj, codec: Codec) -> bool:
+    """Compress the blocks a BAM or FASTQ writer has yet to write with a codec
+
+    Parameters
+    ----------
+    fileobj : pylazybam.bam.FileWriter or FastqFileWriter
+        an output writer. Other writers (eg DummyFile) are unchanged
+    codec : Codec
+        the codec for subsequent BGZF blocks
+
+    Returns
+    -------
+    bool
+        True if the writer compresses BGZF blocks and was changed
+    """
+    replaced = {}
+    for name in ('bgzf_file', 'forward_file', 'reverse_file'):
+        bgzf_file = getattr(fileobj, name, None)
+        if not isinstance(bgzf_file, BgzfWriter):
+            continue
+        if bgzf_file not in replaced:
+            writer = CodecBgzfWriter(fileobj=bgzf_file._handle,
+                                     compresslevel=bgzf_file.compresslevel,
+                                     codec=codec)
+            writer._text = bgzf_file._text
+            writer._buffer = bgzf_file._buffer
+            replaced[bgzf_file] = writer
+        setattr(fileobj, name, replaced[bgzf_file])
+    return bool(replaced)
+
+
+class BgzfFollower():
+    """A read only file decompressing a BGZF file that is still being written
+
+    Blocks are decompressed once they have been completely written, waiting
+    for the writer when the end of the file is reached. The file ends at a
+    BGZF EOF marker block that is the last data in the file, which BAM
+    writers (eg samtools and aligners) add when they close the file. As
+    some writers also put EOF blocks part way through a file (eg when
+    flushing), an EOF block is only treated as the end once nothing more
+    has been written for poll_interval seconds. A writer that pauses for
+    longer than that straight after an intermediate EOF block will end the
+    stream early, so use a longer poll_interval for such writers. The file
+    does not need to exist when the follower is created.
+
+    Parameters
+    ----------
+    file : str or Path
+        a BGZF file that may still be being written
+    timeout : float
+        seconds to wait for more data before giving up [ Default : 600 ]
+    poll_interval : float
+        seconds between checks for more data [ Default : 0.5 ]
+    codec : Codec, optional
+        codec to decompress blocks with [ Default : Codec('zlib') ]
+
+    Raises
+    ------
+    ValueError
+        when read, if no data is written for timeout seconds or the file is
+        not BGZF
+    """
+
+    def __init__(self, file: Union[str, Path], timeout: float = 600.0,
+                 poll_interval: float = 0.5, codec: Codec = None):
+        self.name = str(file)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.codec = Codec('zlib') if codec is None else codec
+        self._handle = None
+        self._offset = 0
+        self._chunk = b''
+        self._position = 0
+        self._eof = False
+
+    def _wait(self, since: float):
+        if time.time() - since > self.timeout:
+            raise ValueError(f"No data was written to {self.name} for "
+                             f"{self.timeout} seconds")
+        time.sleep(self.poll_interval)
+
+    def _next_block(self) -> bytes:
+        # the data of the next complete block or b'' at the end of the file
+        since = time.time()
+        while self._handle is None:
+            try:
+                self._handle = open(self.name, 'rb')
+            except FileNotFoundError:
+                self._wait(since)
+        while True:
+            self._handle.seek(self._offset)
+            header = self._handle.read(18)
+            if len(header) == 18:
+                if header[:4] != BGZF_MAGIC or header[10:16] != BGZF_EXTRA:
+                    raise ValueError(f"No BGZF block at offset {self._offset} "
+                                     f"of {self.name}")
+                block_size = struct.unpack_from('<H', header, 16)[0] + 1
+                block = header + self._handle.read(block_size - 18)
+                if len(block) == block_size:
+                    self._offset += block_size
+                    if block == BGZF_EOF and not self._handle.read(1):
+                        time.sleep(self.poll_interval)
+                        self._handle.seek(self._offset)
+                        if not self._handle.read(1):
+                            return b''
+                    data = self.codec.decompress(block[18:-8])
+                    if data:
+                        return data
+                    since = time.time()
+                    continue
+            self._wait(since)
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while not self._eof:
+            available = len(self._chunk) - self._position
+            if 0 <= size <= available:
+                parts.append(self._chunk[self._position:self._position + size])
+                self._position += size
+                break
+            parts.append(self._chunk[self._position:])
+            size -= available
+            self._chunk = self._next_block()
+            self._position = 0
+            if not self._chunk:
+                self._eof = True
+        return b''.join(parts)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+
+
+def benchmark_codecs(data: bytes,
+                     codecs: Iterable[str] = None,
+                     compresslevel: int = 6,
+                     ) -> Dict[str, Dict[str, float]]:
+    """Time BGZF block compression and decompression with each codec
+
+    Parameters
+    ----------
+    data : bytes
+        sample uncompressed data, eg the start of a decompressed BAM file
+    codecs : Iterable[str], optional
+        codec names [ Default : None (all installed codecs) ]
+    compresslevel : int
+        zlib compression level [ Default : 6 ]
+
+    Returns
+    -------
+    Dict[str, Dict[str, float]]
+        for each codec the 'compress' and 'decompress' throughput in bytes
+        per second, the 'ratio' of uncompressed to compressed size and the
+        'compress_speedup' and 'decompress_speedup' relative to zlib
+    """
+    clock = time.perf_counter
+    blocks = [data[i:i + BGZF_BLOCK_SIZE]
+              for i in range(0, len(data), BGZF_BLOCK_SIZE)]
+    names = list(codecs) if codecs is not None else available_codecs()
+    if 'zlib' not in names:
+        names.append('zlib')
+    results = {}
+    for name in names:
+        codec = Codec(name)
+        started = clock()
+        compressed = [codec.compress(block, compresslevel)
+                      for block in blocks]
+        compress_time = max(clock() - started, 1e-9)
+        started = clock()
+        for block in compressed:
+            codec.decompress(block)
+        decompress_time = max(clock() - started, 1e-9)
+        results[name] = {'compress': len(data) / compress_time,
+                         'decompress': len(data) / decompress_time,
+                         'ratio': len(data) / max(sum(map(len, compressed)),
+                                                  1),
+                         }
+    for name in names:
+        for step in ('compress', 'decompress'):
+            results[name][f'{step}_speedup'] = (results[name][step]
+                                                / results['zlib'][step])
+    return results
+
+
+def get_fastq_record(align: bytes,
+                     missing_quality: int = 1) -> bytes:
+    """Convert a raw BAM alignment to a FASTQ record
+
+    Sequences with the reverse complemented flag (0x10) set are reverse
+    complemented and their qualities reversed to recover the read as sequenced.
+
+    Parameters
+    ----------
+    align : bytes
+        A raw alignment from a BAM file
+    missing_quality : int
+        the phred score to use when the BAM record has no qualities
+        [ Default : 1 (as for samtools fastq) ]
+
+    Returns
+    -------
+    bytes
+        a four line FASTQ record
+    """
+    len_read_name = get_len_read_name(align)
+    number_cigar_operations = get_number_cigar_operations(align)
+    len_sequence = get_len_sequence(align)
+    name = get_raw_read_name(align, len_read_name)[:-1] #remove null
+    raw_seq = get_raw_sequence(align, len_read_name,
+                               number_cigar_operations, len_sequence)
+    raw_qual = get_raw_base_qual(align, len_read_name,
+                                 number_cigar_operations, len_sequence)
+    seq = b"".join([_BAM_BASE_PAIRS[x] for x in raw_seq])[:len_sequence]
+    if raw_qual[:1] == b"\xff":
+        qual = bytes([missing_quality + 33]) * len_sequence
+    else:
+        qual = raw_qual.translate(_PHRED33)
+    if is_flag(align, REVERSE_COMPLEMENTED):
+        seq = seq[::-1].translate(_COMPLEMENT)
+        qual = qual[::-1]
+    return b"@" + name + b"\n" + seq + b"\n+\n" + qual + b"\n"
+
+
+def get_fastq_pair_names(filename: Union[str, Path]) -> Tuple[str, str]:
+    """Derive R1 and R2 FASTQ filenames from a single output filename
+
+    Parameters
+    ----------
+    filename : str or Path
+        a filename such as foo.fastq.gz
+
+    Returns
+    -------
+    Tuple[str, str]
+        the filenames for R1 and R2 eg (foo_R1.fastq.gz, foo_R2.fastq.gz)
+    """
+    filename = str(filename)
+    match = re.search(r"(\.f(ast)?q)?(\.b?gz)?$", filename)
+    stem, suffix = filename[:match.start()], filename[match.start():]
+    return f"{stem}_R1{suffix}", f"{stem}_R2{suffix}"
+
+
+class FastqFileWriter(DummyFile):
+    """A gzip compressed FASTQ writer that looks like pylazybam.bam.FileWriter
+
+    FASTQ records are built from the primary alignment of each segment.
+    Output is BGZF compressed with the same writer used for BAM files,
+    so files can be read by any gzip reader.
+    Header methods are accepted for compatibility but do nothing.
+
+    Parameters
+    ----------
+    file : str or Path or BinaryIO
+        output file for forward (R1) reads, or all reads if interleaved
+    file2 : str or Path or BinaryIO, optional
+        output file for reverse (R2) reads. If not provided output is
+        interleaved into file.
+    compresslevel : int, optional
+        gzip compression level for output file
+        [ Default : 6 ]
+    """
+    def __init__(self,
+                 file: Union[str, Path, BinaryIO],
+                 file2: Union[str, Path, BinaryIO, None] = None,
+                 compresslevel: int = 6):
+        super().__init__()
+        self.forward_file = self._open(file, compresslevel)
+        self.name = self._name(file)
+        if file2:
+            self.reverse_file = self._open(file2, compresslevel)
+            self.name2 = self._name(file2)
+        else:
+            self.reverse_file = self.forward_file
+            self.name2 = self.name
+
+    @staticmethod
+    def _open(file, compresslevel):
+        if hasattr(file, 'write'):
+            return BgzfWriter(filename=None, fileobj=file,
+                              compresslevel=compresslevel)
+        return BgzfWriter(filename=Path(file), mode='wb',
+                          compresslevel=compresslevel)
+
+    @staticmethod
+    def _name(file):
+        return file.name if hasattr(file, 'write') else str(Path(file))
+
+    def __repr__(self):
+        return f"FastqFileWriter({self.name!r}, {self.name2!r})"
+
+    def write(self, data: bytes):
+        """Write a single raw BAM alignment as FASTQ
+
+        Secondary and supplementary alignments are skipped.
+
+        Parameters
+        ----------
+        data : bytes
+            a raw BAM alignment
+        """
+        if is_flag(data, FLAGS['secondary'] | FLAGS['supplementary']):
+            return
+        if is_flag(data, FLAGS['reverse']):
+            self.reverse_file.write(get_fastq_record(data))
+        else:
+            self.forward_file.write(get_fastq_record(data))
+
+    def write_alignbatch(self, alignments: List[bytes]):
+        """Write a batch of alignments from one template as FASTQ
+
+        Parameters
+        ----------
+        alignments : List[bytes]
+            a list of BAM alignments in raw binary format from one template
+        """
+        forward, reverse = split_forward_reverse(alignments)
+        for segment, outfile in ((forward, self.forward_file),
+                                 (reverse, self.reverse_file)):
+            for align in segment:
+                if not is_flag(align, FLAGS['secondary']
+                                      | FLAGS['supplementary']):
+                    outfile.write(get_fastq_record(align))
+
+    def close(self):
+        self.forward_file.close()
+        if self.reverse_file is not self.forward_file:
+            self.reverse_file.close()
+
+
+def reg2bin(beg: int, end: int) -> int:
+    """Calculate the BAI bin for a zero based half open interval [beg,end)
+
+    As specified in section 5.3 of the SAM specification
+    """
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+def get_reference_end(align: bytes) -> int:
+    """Get the zero based exclusive end of an alignment on the reference
+
+    Parameters
+    ----------
+    align : bytes
+        A raw alignment from a BAM file
+
+    Returns
+    -------
+    int
+        the position after the last reference base consumed by the cigar
+        (or position + 1 if no reference bases are consumed)
+    """
+    len_read_name = get_len_read_name(align)
+    number_cigar_operations = get_number_cigar_operations(align)
+    raw_cigar = get_raw_cigar(align, len_read_name, number_cigar_operations)
+    length = sum(x >> 4 for x in array('I', raw_cigar)
+                 if x & 0b1111 in (0, 2, 3, 7, 8)) # M D N = X
+    return struct.unpack('<i', align[8:12])[0] + max(length, 1)
+
+
+def coordinate_sort_key(align: bytes) -> Tuple[int, int, bool]:
+    """A sort key ordering BAM alignments as samtools sort
+
+    Reads with no reference (refID -1) are sorted last.
+    """
+    ref_index, pos = struct.unpack('<ii', align[4:12])
+    return (ref_index & 0xffffffff, pos, is_flag(align, REVERSE_COMPLEMENTED))
+
+
+def set_coordinate_sort_order(raw_header: bytes) -> bytes:
+    """Set the SO field of the @HD line of a raw BAM header to coordinate
+
+    Parameters
+    ----------
+    raw_header : bytes
+        a raw BAM header including the four byte length
+
+    Returns
+    -------
+    bytes
+        the raw header with SO:coordinate and an updated length
+    """
+    text = raw_header[4:]
+    if text.startswith(b'@HD'):
+        hd_line, newline, rest = text.partition(b'\n')
+        if re.search(b'\tSO:[^\t]*', hd_line):
+            hd_line = re.sub(b'\tSO:[^\t]*', b'\tSO:coordinate', hd_line)
+        else:
+            hd_line += b'\tSO:coordinate'
+        text = hd_line + newline + rest
+    else:
+        text = b'@HD\tVN:1.6\tSO:coordinate\n' + text
+    return struct.pack('<i', len(text)) + text
+
+
+class BaiIndexBuilder():
+    """Build a BAI index from alignments written in coordinate order
+
+    Parameters
+    ----------
+    n_ref : int
+        the number of reference sequences in the BAM header
+    """
+    def __init__(self, n_ref: int):
+        self.n_ref = n_ref
+        self._bins = [{} for i in range(n_ref)]
+        self._linear = [[] for i in range(n_ref)]
+        self._meta = [[None, None, 0, 0] for i in range(n_ref)]
+        self.n_no_coor = 0
+
+    def add(self, align: bytes, start_offset: int, end_offset: int):
+        """Add an alignment to the index
+
+        Parameters
+        ----------
+        align : bytes
+            A raw alignment from a BAM file
+        start_offset : int
+            BGZF virtual offset of the start of the alignment
+        end_offset : int
+            BGZF virtual offset of the end of the alignment
+        """
+        ref_index, beg = struct.unpack('<ii', align[4:12])
+        if ref_index < 0:
+            self.n_no_coor += 1
+            return
+        end = get_reference_end(align)
+        chunks = self._bins[ref_index].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+        linear = self._linear[ref_index]
+        last_window = (end - 1) >> 14
+        if len(linear) <= last_window:
+            linear.extend([0] * (last_window + 1 - len(linear)))
+        for window in range(beg >> 14, last_window + 1):
+            if not linear[window]:
+                linear[window] = start_offset
+        meta = self._meta[ref_index]
+        if meta[0] is None:
+            meta[0] = start_offset
+        meta[1] = end_offset
+        if is_flag(align, FLAGS['unmapped']):
+            meta[3] += 1
+        else:
+            meta[2] += 1
+
+    def write(self, outfile: BinaryIO):
+        """Write the index in BAI format
+
+        Parameters
+        ----------
+        outfile : BinaryIO
+            destination for the index
+        """
+        outfile.write(b'BAI\x01' + struct.pack('<i', self.n_ref))
+        for bins, linear, meta in zip(self._bins, self._linear, self._meta):
+            n_bin = len(bins) + (1 if meta[0] is not None else 0)
+            outfile.write(struct.pack('<i', n_bin))
+            for bin_id in sorted(bins):
+                chunks = bins[bin_id]
+                outfile.write(struct.pack('<Ii', bin_id, len(chunks)))
+                for chunk in chunks:
+                    outfile.write(struct.pack('<QQ', *chunk))
+            if meta[0] is not None:
+                # pseudo-bin with the offset range and mapped/unmapped counts
+                outfile.write(struct.pack('<IiQQQQ', 37450, 2, *meta))
+            for i in range(len(linear) - 2, -1, -1):
+                # fill empty windows with the offset of the next non-empty
+                # window; htslib fills from the previous window, but either
+                # gives a valid lower bound for region queries
+                linear[i] = linear[i] or linear[i + 1]
+            outfile.write(struct.pack(f'<i{len(linear)}Q',
+                                      len(linear), *linear))
+        outfile.write(struct.pack('<Q', self.n_no_coor))
+
+
+def _read_sorted_run(run_file: BinaryIO) -> Generator[bytes, None, None]:
+    run_file.seek(0)
+    while True:
+        raw_blocksize = run_file.read(4)
+        if not raw_blocksize:
+            break
+        yield raw_blocksize + run_file.read(
+                                    struct.unpack('<i', raw_blocksize)[0])
+    run_file.close()
+
+
+def _write_uint64s(outfile: BinaryIO, values: Iterable[int]):
+    # little endian uint64 in chunks so values can be an iterator
+    values = iter(values)
+    while True:
+        chunk = array('Q', islice(values, 2**16))
+        if not chunk:
+            break
+        if sys.byteorder == 'big': #pragma: no cover
+            chunk.byteswap()
+        chunk.tofile(outfile)
+
+
+def _read_uint64s(infile: BinaryIO) -> Generator[int, None, None]:
+    while True:
+        chunk = array('Q')
+        try:
+            chunk.fromfile(infile, 2**16)
+        except EOFError:
+            # the values read before the end of the file are still appended
+            pass
+        if not chunk:
+            break
+        if sys.byteorder == 'big': #pragma: no cover
+            chunk.byteswap()
+        yield from chunk
+
+
+def _read_uint64_run(run_file: BinaryIO) -> Generator[int, None, None]:
+    run_file.seek(0)
+    yield from _read_uint64s(run_file)
+    run_file.close()
+
+
+class _SortedUint64Runs():
+    # Unsigned 64 bit integers sorted with bounded memory. Values are held in
+    # an array until run_values have been added, then sorted and spilled to
+    # a temporary file. When max_runs runs have been spilled they are merged
+    # into one, as in SortedBamFileWriter. Iterating merges all runs in
+    # ascending order and empties the container.
+    def __init__(self, run_values: int = 2**20, max_runs: int = 64,
+                 tmpdir: str = None):
+        self.run_values = run_values
+        self.max_runs = max_runs
+        self.tmpdir = tmpdir
+        self._run = array('Q')
+        self._spilled_runs = []
+
+    def append(self, value: int):
+        self._run.append(value)
+        if len(self._run) >= self.run_values:
+            run = sorted(self._run)
+            self._run = array('Q')
+            self._spill(run)
+
+    def _spill(self, values: Iterable[int]):
+        run_file = tempfile.TemporaryFile(dir=self.tmpdir)
+        _write_uint64s(run_file, values)
+        self._spilled_runs.append(run_file)
+        if len(self._spilled_runs) >= self.max_runs:
+            runs = [_read_uint64_run(f) for f in self._spilled_runs]
+            self._spilled_runs = []
+            self._spill(heapq.merge(*runs))
+
+    def __iter__(self) -> Generator[int, None, None]:
+        runs = [_read_uint64_run(f) for f in self._spilled_runs]
+        runs.append(sorted(self._run))
+        self._spilled_runs = []
+        self._run = array('Q')
+        return heapq.merge(*runs)
+
+    def close(self):
+        for run_file in self._spilled_runs:
+            run_file.close()
+        self._spilled_runs = []
+        self._run = array('Q')
+
+
+class SortedBamFileWriter(bam.FileWriter):
+    """A BAM writer producing coordinate sorted and indexed output
+
+    Alignments are buffered in memory and sorted in runs. When the buffer
+    exceeds sort_memory the run is sorted and spilled to a temporary file.
+    When max_runs runs have been spilled they are merged into one temporary
+    file, so no more than max_runs temporary files are open at once. On
+    close all runs are merged into the output BAM and a BAI index is built
+    during the merge and written to <file>.bai
+
+    Parameters
+    ----------
+    file : str or Path or BinaryIO
+        output file. The index is only written if this is a filename.
+    compresslevel : int, optional
+        gzip compression level for output file
+        [ Default : 6 ]
+    sort_memory : int, optional
+        the number of bytes of alignments held in memory before spilling
+        a sorted run to disk [ Default : 256MB ]
+    tmpdir : str, optional
+        directory for temporary files [ Default : system temporary dir ]
+    max_runs : int, optional
+        the number of spilled runs that are merged into one [ Default : 64 ]
+    """
+    def __init__(self, file, compresslevel: int = 6,
+                 sort_memory: int = 2**28,
+                 tmpdir: str = None,
+                 max_runs: int = 64,
+                 **kwargs):
+        if max_runs < 2:
+            raise ValueError("max_runs must be at least 2")
+        super().__init__(file, compresslevel=compresslevel, **kwargs)
+        self.index_name = None if hasattr(file, 'write') else f"{self.name}.bai"
+        self.sort_memory = sort_memory
+        self.tmpdir = tmpdir
+        self.max_runs = max_runs
+        self._run = []
+        self._run_size = 0
+        self._spilled_runs = []
+
+    def write_header(self, *args, **kwargs):
+        self.raw_header = set_coordinate_sort_order(self.raw_header)
+        return super().write_header(*args, **kwargs)
+
+    def write(self, data: bytes):
+        """Buffer an alignment for sorting
+
+        Parameters
+        ----------
+        data : bytes
+            a raw BAM alignment
+        """
+        if not self.header_written:
+            # header data is written directly
+            return super().write(data)
+        self._run.append(data)
+        self._run_size += len(data)
+        if self._run_size >= self.sort_memory:
+            self._spill()
+
+    def _spill(self):
+        self._run.sort(key=coordinate_sort_key)
+        run_file = tempfile.TemporaryFile(dir=self.tmpdir)
+        run_file.write(b''.join(self._run))
+        self._spilled_runs.append(run_file)
+        self._run = []
+        self._run_size = 0
+        if len(self._spilled_runs) >= self.max_runs:
+            merged_file = tempfile.TemporaryFile(dir=self.tmpdir)
+            runs = [_read_sorted_run(f) for f in self._spilled_runs]
+            merged_file.writelines(heapq.merge(*runs,
+                                               key=coordinate_sort_key))
+            self._spilled_runs = [merged_file]
+
+    def close(self, *args, **kwargs):
+        """Merge sorted runs, write the BAM file and its index and close
+        """
+        self._run.sort(key=coordinate_sort_key)
+        runs = [_read_sorted_run(f) for f in self._spilled_runs] + [self._run]
+        n_ref = struct.unpack('<i', self.raw_refs[:4])[0] if self.raw_refs else 0
+        index = BaiIndexBuilder(n_ref)
+        tell = self.bgzf_file.tell
+        write = self.bgzf_file.write
+        for align in heapq.merge(*runs, key=coordinate_sort_key):
+            start_offset = tell()
+            write(align)
+            index.add(align, start_offset, tell())
+        self._run = []
+        self._spilled_runs = []
+        result = super().close(*args, **kwargs)
+        if self.index_name:
+            with open(self.index_name, 'wb') as index_file:
+                index.write(index_file)
+        return result
+
+
+class XenomapperOutputWriter():
+    """Container class grouping xenomapper output files & manipulating headers
+
+    Updated headers are written to these files on initialization. The primary
+    BAM header is used for all files except secondary_specific and
+    secondary_multi.
+    A @PO line is added to the file indicating the id and program as xenomapper
+    with the version, a description field indicating the type of xenomapper
+    output in the file (eg primary_specific) and the command used to run it.
+
+    Parameters
+    ----------
+    primary_raw_header : bytes
+        the raw header from the primary species BAM file
+    primary_raw_refs : bytes
+        the raw reference sequence info from the primary species BAM file
+    secondary_raw_header : bytes
+        the raw header from the secondary species BAM file
+    secondary_raw_refs : bytes
+        the raw reference sequence info from the secondary species BAM file
+    primary_specific : str or Path or BinaryIO, optional
+        output file for uniquely mapping primary specific alignments
+        [ Default : None ]
+    primary_multi : str or Path or BinaryIO, optional
+        output file for multimapping primary specific alignments
+        [ Default : None ]
+    secondary_specific : str or Path or BinaryIO, optional
+        output file for uniquely mapping secondary specific alignments
+        [ Default : None ]
+    secondary_multi : str or Path or BinaryIO, optional
+        output file for multimapping secondary specific alignments
+        [ Default : None ]
+    unresolved : str or Path or BinaryIO, optional
+        output file for alignments where primary or secondary is ambiguous
+        [ Default : None ]
+    unassigned : str or Path or BinaryIO, optional
+        output file for reads that do not map sufficiently well in either BAM
+        [ Default : None ]
+    basename : str, optional
+        filename stem to derive all output filenames <basename>_<outfilename>
+        (eg basename='Foo' -> Foo_primary_specific, ... Foo_unassigned)
+        [ Default : None ]
+    cmdline : str, optional
+        The commandline to include in the output BAM header
+    compresslevel : int, optional
+        gzip compression level for output file
+        [ Default : 6 ]
+    fastq : Iterable[str], optional
+        categories to write as gzipped FASTQ rather than BAM. Paired reads are
+        written to <name>_R1.fastq.gz and <name>_R2.fastq.gz
+        [ Default : () ]
+    interleaved : bool, optional
+        write FASTQ categories as a single interleaved file
+        [ Default : False ]
+    sort : bool, optional
+        write coordinate sorted and indexed BAM files
+        [ Default : False ]
+    sort_memory : int, optional
+        bytes of alignments to buffer per file before spilling to disk
+        when sorting. Each sorted file has its own buffer [ Default : 256MB ]
+    codec : Codec, optional
+        the deflate implementation for BGZF blocks of the outputs
+        [ Default : None (zlib) ]
+
+    Attributes
+    ----------
+    requested : Set[str]
+        the categories that have an output file
+
+    Notes
+    -----
+    Unsorted BAM outputs are wrapped in a BufferedCategorySink after the
+    headers are written, and write_alignbatch does nothing for categories
+    that are not requested.
+
+    Returns
+    -------
+    A container class with __get_item__ , keys, write_alignbatch, close
+
+    Examples
+    --------
+
+    >>> xow = XenomapperOutputWriter(phead,pref,shead,sref,basename='/foo')
+    >>> for key in xow.keys():
+    >>>     xow[key].write(data)
+    >>> xow.close()
+
+    """
+
+    def __init__(self,
+                 primary_raw_header: bytes,
+                 primary_raw_refs: bytes,
+                 secondary_raw_header: bytes,
+                 secondary_raw_refs: bytes,
+                 primary_specific: Union[str, Path, BinaryIO, None] = None,
+                 primary_multi: Union[str, Path, BinaryIO, None] = None,
+                 secondary_specific: Union[str, Path, BinaryIO, None] = None,
+                 secondary_multi: Union[str, Path, BinaryIO, None] = None,
+                 unresolved: Union[str, Path, BinaryIO, None] = None,
+                 unassigned: Union[str, Path, BinaryIO, None] = None,
+                 basename: str = None,
+                 cmdline: str = '',
+                 compresslevel: int = 6,
+                 fastq: Iterable[str] = (),
+                 interleaved: bool = False,
+                 sort: bool = False,
+                 sort_memory: int = 2**28,
+                 codec: Codec = None,
+                 ):
+        #get only the 5th to 11th arguments to __init__
+        # This works python >=3.7 but not 3.6 as dict order issues
+        #file_arguments = dict(list(locals().items())[5:11])
+
+        file_arguments = {'primary_specific' : primary_specific,
+                          'primary_multi' : primary_multi,
+                          'secondary_specific' : secondary_specific,
+                          'secondary_multi' : secondary_multi,
+                          'unresolved' : unresolved,
+                          'unassigned' : unassigned,
+                          }
+
+        for key in fastq:
+            if key not in file_arguments:
+                raise ValueError(f"{key} is not a xenomapper category")
+
+        if basename == None:
+            self.requested = {k for k in file_arguments if file_arguments[k]}
+        else:
+            self.requested = set(file_arguments)
+
+        if basename == None:
+            self._fileobjects = {'primary_specific': DummyFile(),
+                                'primary_multi': DummyFile(),
+                                'secondary_specific': DummyFile(),
+                                'secondary_multi': DummyFile(),
+                                'unassigned': DummyFile(),
+                                'unresolved': DummyFile(),
+                                }
+            for key in file_arguments:
+                if file_arguments[key] and key in fastq:
+                    self._fileobjects[key] = self._fastq_writer(
+                                                    file_arguments[key],
+                                                    interleaved,
+                                                    compresslevel, codec)
+                elif file_arguments[key]:
+                    self._fileobjects[key] = self._bam_writer(
+                                                    file_arguments[key],
+                                                    compresslevel,
+                                                    sort, sort_memory, codec)
+        else:
+            self._fileobjects = {}
+            for key in file_arguments:
+                if key in fastq:
+                    self._fileobjects[key] = self._fastq_writer(
+                                                    f"{basename}_{key}.fastq.gz",
+                                                    interleaved,
+                                                    compresslevel, codec)
+                else:
+                    self._fileobjects[key] = self._bam_writer(
+                                                    f"{basename}_{key}.bam",
+                                                    compresslevel,
+                                                    sort, sort_memory, codec)
+
+        self._write_headers(primary_raw_header,
+                             primary_raw_refs,
+                             secondary_raw_header,
+                             secondary_raw_refs,
+                             cmdline=cmdline)
+
+        for key in self.requested:
+            if type(self._fileobjects[key]) is bam.FileWriter:
+                self._fileobjects[key] = BufferedCategorySink(
+                                                    self._fileobjects[key])
+        self._requested_fileobjects = {key: self._fileobjects[key]
+                                       for key in self.requested}
+
+    @staticmethod
+    def _bam_writer(file, compresslevel, sort, sort_memory, codec=None):
+        if sort:
+            writer = SortedBamFileWriter(file, compresslevel=compresslevel,
+                                         sort_memory=sort_memory)
+        else:
+            writer = bam.FileWriter(file, compresslevel=compresslevel)
+        if codec is not None:
+            set_bgzf_codec(writer, codec)
+        return writer
+
+    @staticmethod
+    def _fastq_writer(file, interleaved, compresslevel, codec=None):
+        if interleaved:
+            writer = FastqFileWriter(file, compresslevel=compresslevel)
+        elif hasattr(file, 'write'):
+            raise ValueError("Paired FASTQ output requires a filename "
+                             "not a file object unless interleaved")
+        else:
+            writer = FastqFileWriter(*get_fastq_pair_names(file),
+                                     compresslevel=compresslevel)
+        if codec is not None:
+            set_bgzf_codec(writer, codec)
+        return writer
+
+    def _write_headers(self, primary_raw_header,
+                             primary_raw_refs,
+                             secondary_raw_header,
+                             secondary_raw_refs,
+                             cmdline=''):
+        """A function for updating and writing headers to output file
+
+        Parameters
+        ----------
+        primary_raw_header : bytes
+            the raw header from the primary species BAM file
+        primary_raw_refs : bytes
+            the raw reference sequence info from the primary species BAM file
+        secondary_raw_header : bytes
+            the raw header from the secondary species BAM file
+        secondary_raw_refs : bytes
+            the raw reference sequence info from the secondary species BAM file
+        cmdline : str, optional
+            The commandline to include in the output BAM header
+        """
+        # write out the correct species header to all of the files
+        # use primary for unresolved and unassigned
+        # add @PO and @CO fields to the header
+        for key in self._fileobjects:
+            if key in ['secondary_specific','secondary_multi']:
+                self._fileobjects[key].raw_header = secondary_raw_header
+                self._fileobjects[key].raw_refs = secondary_raw_refs
+            else:
+                self._fileobjects[key].raw_header = primary_raw_header
+                self._fileobjects[key].raw_refs = primary_raw_refs
+            self._fileobjects[key].update_header(id = 'xenomapper',
+                                                    program = 'xenomapper',
+                                                    version = __version__,
+                                                    description= key,
+                                                    command=cmdline,)
+            comment = f"@CO\tThis file contains alignments assigned as {key}\n"
+            self._fileobjects[key].raw_header += comment.encode('utf-8')
+            self._fileobjects[key].update_header_length()
+            self._fileobjects[key].write_header()
+
+
+    def __getitem__(self, key):
+        return self._fileobjects[key]
+
+    def write_alignbatch(self, category: str, alignments: List[bytes]):
+        """Write all alignments from one template to a category output
+
+        Parameters
+        ----------
+        category : str
+            the xenomapper category of the template
+        alignments : List[bytes]
+            a list of BAM alignments in raw binary format from one template
+        """
+        fileobj = self._requested_fileobjects.get(category)
+        if fileobj is None:
+            return
+        if hasattr(fileobj, 'write_alignbatch'):
+            fileobj.write_alignbatch(alignments)
+        else:
+            for align in alignments:
+                fileobj.write(align)
+
+    def set_compresslevel(self, compresslevel: int):
+        """Change the compression level of requested BAM outputs
+
+        Blocks already written are unchanged. FASTQ outputs keep the level
+        they were opened with.
+
+        Parameters
+        ----------
+        compresslevel : int
+            zlib compression level for subsequent BGZF blocks
+        """
+        for fileobj in self._requested_fileobjects.values():
+            set_bgzf_compresslevel(fileobj, compresslevel)
+
+    def suspend(self):
+        """Close the output files without ending them to release file handles
+
+        Buffered alignments are written first. Call resume() before writing
+        again. Only outputs opened with a filename can be resumed.
+        """
+        for fileobj in self._requested_fileobjects.values():
+            if isinstance(fileobj, BufferedCategorySink):
+                fileobj.flush()
+            for bgzf_file in get_bgzf_writers(fileobj):
+                suspend_bgzf_writer(bgzf_file)
+
+    def resume(self):
+        """Reopen output files closed by suspend() to append to them"""
+        for fileobj in self._requested_fileobjects.values():
+            for bgzf_file in get_bgzf_writers(fileobj):
+                resume_bgzf_writer(bgzf_file)
+
+    def keys(self):
+        """return the keys for the file output objects
+        Returns
+        -------
+        Iterable[str]
+        """
+        return self._fileobjects.keys()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for fileobj in self._fileobjects:
+            self._fileobjects[fileobj].close()
+
+
+# the value size of fixed width aux tag types and B array subtypes
+_AUX_VALUE_SIZES = {b'A': 1, b'c': 1, b'C': 1, b's': 2, b'S': 2,
+                    b'i': 4, b'I': 4, b'f': 4}
+
+
+def _remove_aux_tag(align: bytes, name: bytes) -> bytes:
+    # the alignment without any aux tags called name. The block size is
+    # not updated. Only alignments containing name after the start of the
+    # aux data are parsed
+    n_cigar_op, flag, l_seq = struct.unpack_from('<HHi', align, 16)
+    position = 36 + align[12] + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+    if align.find(name, position) < 0:
+        return align
+    kept = [align[:position]]
+    while position < len(align):
+        start = position
+        value_type = align[position + 2:position + 3]
+        position += 3
+        if value_type in (b'Z', b'H'):
+            position = align.index(b'\x00', position) + 1
+        elif value_type == b'B':
+            subtype = align[position:position + 1]
+            count = struct.unpack_from('<i', align, position + 1)[0]
+            position += 5 + count * _AUX_VALUE_SIZES[subtype]
+        else:
+            position += _AUX_VALUE_SIZES[value_type]
+        if align[start:start + 2] != name:
+            kept.append(align[start:position])
+    return b''.join(kept)
+
+
+def add_category_tag(alignments: Iterable[bytes], tag: bytes) -> bytes:
+    """Append a raw aux tag to BAM alignments and update their block sizes
+
+    Any tag with the same name already on an alignment is removed first, as
+    the SAM specification allows a tag only once per record and aligners
+    can use the same name (eg BWA writes XC:i).
+
+    Parameters
+    ----------
+    alignments : Iterable[bytes]
+        BAM alignments in raw binary format
+    tag : bytes
+        a complete raw aux tag eg b'XCZprimary_specific\\x00'
+
+    Returns
+    -------
+    bytes
+        the joined alignments with the tag appended to each
+    """
+    pack = struct.Struct('<i').pack
+    name = tag[:2]
+    alignments = [_remove_aux_tag(align, name) for align in alignments]
+    return b''.join([pack(len(align) - 4 + len(tag)) + align[4:] + tag
+                     for align in alignments])
+
+
+class TaggedOutputWriter():
+    """Output writer for one BAM file per genome with a category tag
+
+    Instead of a file per category, every alignment written carries a
+    string aux tag (XC:Z:primary_specific by default) recording the category
+    of its template. Secondary specific and secondary multi templates are
+    written to the secondary file with the secondary BAM header and all
+    other categories to the primary file. Downstream tools can then select
+    categories by tag (eg samtools view -d XC:primary_specific).
+
+    Parameters
+    ----------
+    primary_raw_header : bytes
+        the raw header from the primary species BAM file
+    primary_raw_refs : bytes
+        the raw reference sequence info from the primary species BAM file
+    secondary_raw_header : bytes
+        the raw header from the secondary species BAM file
+    secondary_raw_refs : bytes
+        the raw reference sequence info from the secondary species BAM file
+    primary : str or Path or BinaryIO, optional
+        output file for primary_specific, primary_multi, unresolved and
+        unassigned alignments [ Default : None ]
+    secondary : str or Path or BinaryIO, optional
+        output file for secondary_specific and secondary_multi alignments
+        [ Default : None ]
+    basename : str, optional
+        filename stem for <basename>_primary.bam and <basename>_secondary.bam
+        [ Default : None ]
+    cmdline : str, optional
+        The commandline to include in the output BAM header
+    compresslevel : int, optional
+        gzip compression level for output file [ Default : 6 ]
+    sort : bool, optional
+        write coordinate sorted and indexed BAM files [ Default : False ]
+    sort_memory : int, optional
+        bytes of alignments to buffer per file before spilling to disk
+        when sorting. Each sorted file has its own buffer [ Default : 256MB ]
+    tag : bytes, optional
+        the two character tag name [ Default : b'XC' ]
+    codec : Codec, optional
+        the deflate implementation for BGZF blocks [ Default : None (zlib) ]
+
+    Attributes
+    ----------
+    requested : Set[str]
+        the categories that have an output file
+    """
+    PRIMARY_CATEGORIES = ('primary_specific', 'primary_multi',
+                          'unresolved', 'unassigned')
+    SECONDARY_CATEGORIES = ('secondary_specific', 'secondary_multi')
+
+    def __init__(self,
+                 primary_raw_header: bytes,
+                 primary_raw_refs: bytes,
+                 secondary_raw_header: bytes,
+                 secondary_raw_refs: bytes,
+                 primary: Union[str, Path, BinaryIO, None] = None,
+                 secondary: Union[str, Path, BinaryIO, None] = None,
+                 basename: str = None,
+                 cmdline: str = '',
+                 compresslevel: int = 6,
+                 sort: bool = False,
+                 sort_memory: int = 2**28,
+                 tag: bytes = b'XC',
+                 codec: Codec = None,
+                 ):
+        if basename is not None:
+            primary = f"{basename}_primary.bam"
+            secondary = f"{basename}_secondary.bam"
+        self._tags = {category: tag + b'Z' + category.encode() + b'\x00'
+                      for category in CATEGORIES}
+        self._fileobjects = {}
+        self.requested = set()
+        for genome, file, categories, raw_header, raw_refs in (
+                ('primary', primary, self.PRIMARY_CATEGORIES,
+                 primary_raw_header, primary_raw_refs),
+                ('secondary', secondary, self.SECONDARY_CATEGORIES,
+                 secondary_raw_header, secondary_raw_refs)):
+            if not file:
+                continue
+            writer = XenomapperOutputWriter._bam_writer(file, compresslevel,
+                                                        sort, sort_memory,
+                                                        codec)
+            writer.raw_header = raw_header
+            writer.raw_refs = raw_refs
+            writer.update_header(id='xenomapper',
+                                 program='xenomapper',
+                                 version=__version__,
+                                 description=f'{genome} tagged',
+                                 command=cmdline,)
+            comment = (f"@CO\tThis file contains alignments with the "
+                       f"{tag.decode()}:Z tag set to one of "
+                       f"{','.join(categories)}\n")
+            writer.raw_header += comment.encode('utf-8')
+            writer.update_header_length()
+            writer.write_header()
+            if type(writer) is bam.FileWriter:
+                writer = BufferedCategorySink(writer)
+            for category in categories:
+                self._fileobjects[category] = writer
+                self.requested.add(category)
+
+    def __getitem__(self, key):
+        return self._fileobjects.get(key, DummyFile())
+
+    def write_alignbatch(self, category: str, alignments: List[bytes]):
+        """Write all alignments from one template with the category tag
+
+        Parameters
+        ----------
+        category : str
+            the xenomapper category of the template
+        alignments : List[bytes]
+            a list of BAM alignments in raw binary format from one template
+        """
+        fileobj = self._fileobjects.get(category)
+        if fileobj is None:
+            return
+        tag = self._tags[category]
+        if (isinstance(fileobj, BufferedCategorySink)
+                and isinstance(alignments, list)):
+            fileobj.write(add_category_tag(alignments, tag))
+        else:
+            for align in alignments:
+                fileobj.write(add_category_tag((align,), tag))
+
+    def set_compresslevel(self, compresslevel: int):
+        """Change the compression level of both BAM outputs
+
+        Blocks already written are unchanged.
+
+        Parameters
+        ----------
+        compresslevel : int
+            zlib compression level for subsequent BGZF blocks
+        """
+        for fileobj in set(self._fileobjects.values()):
+            set_bgzf_compresslevel(fileobj, compresslevel)
+
+    def keys(self):
+        """return the categories with output files
+        Returns
+        -------
+        Iterable[str]
+        """
+        return self._fileobjects.keys()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for fileobj in set(self._fileobjects.values()):
+            fileobj.close()
+
+
+# read group name used for templates without an RG tag
+NO_READ_GROUP: str = 'no_read_group'
+
+
+class ReadGroupOutputWriter():
+    """Output writer with a set of category outputs for each read group
+
+    Each template is written to the XenomapperOutputWriter for the read
+    group in the RG tag of the first primary genome alignment (passed as
+    route_aligns by OutputWriterSink), creating files named
+    <basename>_<read group>_<category>.bam when the read group is first
+    seen. Characters other than letters, digits, '.', '_' and '-' in read
+    groups are replaced by '_' and if this gives the name of an earlier read
+    group a hash of the read group is appended. To limit open files for
+    large multiplexes only max_open read groups are held open. The least
+    recently used read group is suspended and its files are reopened to
+    append when it is seen again.
+
+    Parameters
+    ----------
+    primary_raw_header : bytes
+        the raw header from the primary species BAM file
+    primary_raw_refs : bytes
+        the raw reference sequence info from the primary species BAM file
+    secondary_raw_header : bytes
+        the raw header from the secondary species BAM file
+    secondary_raw_refs : bytes
+        the raw reference sequence info from the secondary species BAM file
+    basename : str
+        filename stem for all output files
+    cmdline : str, optional
+        The commandline to include in the output BAM header
+    compresslevel : int, optional
+        gzip compression level for output files [ Default : 6 ]
+    fastq : Iterable[str], optional
+        categories to write as gzipped FASTQ rather than BAM [ Default : () ]
+    interleaved : bool, optional
+        write FASTQ categories as a single interleaved file
+        [ Default : False ]
+    max_open : int, optional
+        the number of read groups with open files [ Default : 16 ]
+    tag : bytes, optional
+        the read group tag [ Default : b'RG' ]
+    codec : Codec, optional
+        the deflate implementation for BGZF blocks [ Default : None (zlib) ]
+
+    Attributes
+    ----------
+    counts : Dict[str, Dict[str, int]]
+        the number of templates in each category for each read group
+    names : Dict[str, str]
+        the part of the output filenames for each read group
+    """
+    def __init__(self,
+                 primary_raw_header: bytes,
+                 primary_raw_refs: bytes,
+                 secondary_raw_header: bytes,
+                 secondary_raw_refs: bytes,
+                 basename: str,
+                 cmdline: str = '',
+                 compresslevel: int = 6,
+                 fastq: Iterable[str] = (),
+                 interleaved: bool = False,
+                 max_open: int = 16,
+                 tag: bytes = b'RG',
+                 codec: Codec = None,
+                 ):
+        if max_open < 1:
+            raise ValueError("max_open must be at least 1")
+        self._headers = (primary_raw_header, primary_raw_refs,
+                         secondary_raw_header, secondary_raw_refs)
+        self.basename = basename
+        self.cmdline = cmdline
+        self.compresslevel = compresslevel
+        self.fastq = tuple(fastq)
+        self.interleaved = interleaved
+        self.max_open = max_open
+        self.tag = tag
+        self.codec = codec
+        self.requested = set(CATEGORIES)
+        self.counts = {}
+        self.names = {}
+        self._open_writers = OrderedDict()
+        self._suspended_writers = {}
+
+    def _file_name(self, read_group: str) -> str:
+        # a filename safe name for a read group distinct from all others
+        name = re.sub(r'[^A-Za-z0-9._-]', '_', read_group)
+        used = set(self.names.values())
+        if name in used:
+            digest = hashlib.blake2b(read_group.encode(),
+                                     digest_size=4).hexdigest()
+            name = unique_name = f"{name}_{digest}"
+            ordinal = 1
+            while unique_name in used: #pragma: no cover
+                ordinal += 1
+                unique_name = f"{name}_{ordinal}"
+            name = unique_name
+        return name
+
+    def _read_group(self, alignments: List[bytes]) -> str:
+        read_group = get_str_tag(get_tag_bytes(alignments[0]), self.tag)
+        return read_group or NO_READ_GROUP
+
+    def _get_writer(self, read_group: str) -> XenomapperOutputWriter:
+        writer = self._open_writers.get(read_group)
+        if writer is not None:
+            self._open_writers.move_to_end(read_group)
+            return writer
+        writer = self._suspended_writers.pop(read_group, None)
+        if writer is None:
+            self.names[read_group] = self._file_name(read_group)
+            basename = f"{self.basename}_{self.names[read_group]}"
+            writer = XenomapperOutputWriter(*self._headers,
+                                            basename=basename,
+                                            cmdline=self.cmdline,
+                                            compresslevel=self.compresslevel,
+                                            fastq=self.fastq,
+                                            interleaved=self.interleaved,
+                                            codec=self.codec)
+            self.counts[read_group] = dict.fromkeys(CATEGORIES, 0)
+        else:
+            writer.resume()
+            writer.set_compresslevel(self.compresslevel)
+        self._open_writers[read_group] = writer
+        if len(self._open_writers) > self.max_open:
+            evicted, evicted_writer = self._open_writers.popitem(last=False)
+            evicted_writer.suspend()
+            self._suspended_writers[evicted] = evicted_writer
+        return writer
+
+    def write_alignbatch(self, category: str, alignments: List[bytes],
+                         route_aligns: List[bytes] = None):
+        """Write all alignments from one template to its read group outputs
+
+        Parameters
+        ----------
+        category : str
+            the xenomapper category of the template
+        alignments : List[bytes]
+            a list of BAM alignments in raw binary format from one template
+        route_aligns : List[bytes], optional
+            the primary genome alignments of the template, whose read group
+            is used so templates written from the secondary genome go to
+            the same outputs as their primary records
+            [ Default : None (the read group of alignments) ]
+        """
+        if not len(alignments):
+            return
+        if route_aligns is None or not len(route_aligns):
+            route_aligns = alignments
+        read_group = self._read_group(route_aligns)
+        self._get_writer(read_group).write_alignbatch(category, alignments)
+        self.counts[read_group][category] += 1
+
+    def set_compresslevel(self, compresslevel: int):
+        """Change the compression level of BAM outputs
+
+        Parameters
+        ----------
+        compresslevel : int
+            zlib compression level for subsequent BGZF blocks
+        """
+        self.compresslevel = compresslevel
+        for writer in self._open_writers.values():
+            writer.set_compresslevel(compresslevel)
+
+    def write_table(self, outfile: TextIO):
+        """Write a tab separated table of category counts by read group
+
+        The name column is the read group part of the output filenames.
+
+        Parameters
+        ----------
+        outfile : TextIO
+            an open text file
+        """
+        print('read_group', 'name', *CATEGORIES, sep='\t', file=outfile)
+        for read_group, counts in self.counts.items():
+            print(read_group, self.names[read_group],
+                  *(counts[category] for category in CATEGORIES),
+                  sep='\t', file=outfile)
+
+    def keys(self):
+        """return the read groups with output files
+        Returns
+        -------
+        Iterable[str]
+        """
+        return self.counts.keys()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for writer in self._suspended_writers.values():
+            writer.resume()
+            writer.close()
+        self._suspended_writers = {}
+        for writer in self._open_writers.values():
+            writer.close()
+        self._open_writers = OrderedDict()
+
+
+def xenomap_scores(primary_aligns: Iterable[bytes],
+                   secondary_aligns: Iterable[bytes],
+                   score_function: Callable = get_bamprimary_AS_XS,
+                   AS_function: Callable = get_AS,
+                   XS_function: Callable = get_XS,
+                   ) -> Tuple[Tuple[int, int, int, int],
+                              Union[Tuple[int, int, int, int], None]]:
+    """Get the AS and XS scores in both genomes for the forward and reverse reads
+
+    primary_aligns : List[bytes] or AlignBatch
+        a list of binary format BAM alignments from the primary BAM.
+
+    secondary_aligns : List[bytes] or AlignBatch
+        a list of binary format BAM alignments from the secondary BAM.
+
+    score_function : Callable
+        a xenomapper alignment batch calling function
+        get_bamprimary_AS_XS or get_max_AS_XS
+
+    AS_function : Callable[[bytes], int]
+        get_AS or get_cigar_based_score
+
+    XS_function : Callable[[bytes], int]
+        get_XS, get_ZS, always_zero, or always_very_negative
+
+    Returns
+    -------
+    Tuple[Tuple[int,int,int,int], Tuple[int,int,int,int]]
+        the primary AS, primary XS, secondary AS and secondary XS of the
+        forward read and of the reverse read (None if there is no reverse)
+
+    Raises
+    ------
+    ValueError
+        if the primary and secondary read names do not match
+    """
+
+    if isinstance(primary_aligns, (AlignBatch, SpilledAlignBatch)):
+        primary_name = primary_aligns.name
+    else:
+        primary_name = get_raw_read_name(primary_aligns[0],
+                                         get_len_read_name(primary_aligns[0]))
+    if isinstance(secondary_aligns, (AlignBatch, SpilledAlignBatch)):
+        secondary_name = secondary_aligns.name
+    else:
+        secondary_name = get_raw_read_name(secondary_aligns[0],
+                                         get_len_read_name(secondary_aligns[0]))
+    if primary_name != secondary_name:
+        raise ValueError("Primary and secondary read names do not match: "
+                         f"{primary_name} != {secondary_name}")
+    prim_f_aligns, prim_r_aligns = split_forward_reverse(primary_aligns)
+    sec_f_aligns, sec_r_aligns = split_forward_reverse(secondary_aligns)
+    forward_scores = (score_function(prim_f_aligns,
+                                     AS_function=AS_function,
+                                     XS_function=XS_function)
+                      + score_function(sec_f_aligns,
+                                       AS_function=AS_function,
+                                       XS_function=XS_function))
+    if not prim_r_aligns and not sec_r_aligns:
+        reverse_scores = None
+    else:
+        reverse_scores = (score_function(prim_r_aligns,
+                                         AS_function=AS_function,
+                                         XS_function=XS_function)
+                          + score_function(sec_r_aligns,
+                                           AS_function=AS_function,
+                                           XS_function=XS_function))
+    return forward_scores, reverse_scores
+
+
+def xenomap_states(primary_aligns: Iterable[bytes],
+                   secondary_aligns: Iterable[bytes],
+                   score_function: Callable = get_bamprimary_AS_XS,
+                   AS_function: Callable = get_AS,
+                   XS_function: Callable = get_XS,
+                   min_score: int = MIN32INT,
+                   ) -> Tuple[int,int]:
+    """Get the xenomapping state for the forward and reverse reads
+
+    primary_aligns : List[bytes] or AlignBatch
+        a list of binary format BAM alignments from the primary BAM.
+
+    secondary_aligns : List[bytes] or AlignBatch
+        a list of binary format BAM alignments from the secondary BAM.
+
+    score_function : Callable
+        a xenomapper alignment batch calling function
+        get_bamprimary_AS_XS or get_max_AS_XS
+
+    AS_function : Callable[[bytes], int]
+        a function that accepts a BAM alignment bytestring and returns the AS
+        score (alignment score) as an integer
+        get_AS or get_cigar_based_score
+
+    XS_function : Callable[[bytes], int]
+        a function that accepts a BAM alignment bytestring and returns the XS
+        score as an integer
+        get_XS, get_ZS, always_zero, or always_very_negative
+
+    min_score : int [ Default : -2**31 ]
+        the score that matches must exceed in order to be
+        considered valid matches. Note scores equalling this
+        value will also be considered not valid matches.
+
+    Returns
+    -------
+    Tuple[str,str]
+        the xenomapper state of the forward and reverse read
+
+    """
+    forward_scores, reverse_scores = xenomap_scores(primary_aligns,
+                                                    secondary_aligns,
+                                                    score_function,
+                                                    AS_function=AS_function,
+                                                    XS_function=XS_function)
+    forward_state = get_mapping_state(*forward_scores, min_score)
+    if reverse_scores is None:
+        reverse_state = None
+    else:
+        reverse_state = get_mapping_state(*reverse_scores, min_score)
+    return forward_state, reverse_state
+
+
+def state_map(forward_state: str,
+              reverse_state: str) -> str:
+    # logic is directly copied from xenomapper 1.0
+    """State map for inferring the fragment state from forward & reverse
+    Reads where there is stronger but not contradictory evidence will be
+    assigned the more specific state.
+
+    Parameters
+    ----------
+    forward_state : str
+        a xenomapper state for the forward read
+        (primary_specific,primary_multi,secondary_specific,secondary_multi,
+        unassigned, unresolved)
+
+    reverse_state: str or None
+        a xenomapper state for the reverse read or None
+        (primary_specific,primary_multi,secondary_specific,secondary_multi,
+        unassigned, unresolved) or None
+
+    Returns
+    -------
+    str
+        a xenomapper state for the fragment
+        (primary_specific,primary_multi,secondary_specific,secondary_multi,
+        unassigned, unresolved)
+
+    Notes
+    -----
+    In future these will be of type PEP586 Literal
+
+    """
+    if reverse_state == None:
+        return forward_state
+    elif forward_state == 'primary_specific' or reverse_state == 'primary_specific':
+        return 'primary_specific'
+    elif forward_state == 'secondary_specific' or reverse_state == 'secondary_specific':
+        return 'secondary_specific'
+    elif forward_state == 'primary_multi' or reverse_state == 'primary_multi':
+        return 'primary_multi'
+    elif forward_state == 'secondary_multi' or reverse_state == 'secondary_multi':
+        return 'secondary_multi'
+    elif forward_state == 'unresolved' or reverse_state == 'unresolved':
+        return 'unresolved'
+    elif forward_state == 'unassigned' or reverse_state == 'unassigned':
+        return 'unassigned'
+    else:
+        raise ValueError(f'Unexpected states forward:{forward_state}'
+                         f'reverse:{reverse_state}')
+
+def conservative_state_map(forward_state, reverse_state):
+    # logic is directly copied from xenomapper 1.0
+    """Conservative tate map for inferring fragment state from forward & reverse
+    Reads where there is ambiguous evidence will be assigned the least specific
+    state.
+
+    Parameters
+    ----------
+    forward_state : str
+        a xenomapper state for the forward read
+        (primary_specific,primary_multi,secondary_specific,secondary_multi,
+        unassigned, unresolved)
+
+    reverse_state: str or None
+        a xenomapper state for the reverse read or None
+        (primary_specific,primary_multi,secondary_specific,secondary_multi,
+        unassigned, unresolved) or None
+
+    Returns
+    -------
+    str
+        a xenomapper state for the fragment
+        (primary_specific,primary_multi,secondary_specific,secondary_multi,
+        unassigned, unresolved)
+
+    Notes
+    -----
     In future these will be of type PEP586 Literal
 
     """
-    if reverse_state == None:
-        return forward_state
-    elif forward_state == 'primary_specific' or reverse_state == 'primary_specific':
-        return 'primary_specific'
-    elif forward_state == 'secondary_specific' or reverse_state == 'secondary_specific':
-        return 'secondary_specific'
-    elif forward_state == 'primary_multi' or reverse_state == 'primary_multi':
-        return 'primary_multi'
-    elif forward_state == 'secondary_multi' or reverse_state == 'secondary_multi':
-        return 'secondary_multi'
-    elif forward_state == 'unresolved' or reverse_state == 'unresolved':
-        return 'unresolved'
-    elif forward_state == 'unassigned' or reverse_state == 'unassigned':
-        return 'unassigned'
+
+    if reverse_state == None:
+        return forward_state
+    elif forward_state == 'unassigned' or reverse_state == 'unassigned':
+        return 'unassigned'
+    elif forward_state == 'unresolved' or reverse_state == 'unresolved' \
+            or (forward_state in ['primary_specific', 'primary_multi'] and \
+                reverse_state in ['secondary_specific', 'secondary_multi']) \
+            or (forward_state in ['secondary_specific', 'secondary_multi'] and \
+                reverse_state in ['primary_specific', 'primary_multi']):
+        return 'unresolved'
+    elif forward_state == 'primary_specific' or reverse_state == 'primary_specific':
+        return 'primary_specific'
+    elif forward_state == 'secondary_specific' or reverse_state == 'secondary_specific':
+        return 'secondary_specific'
+    elif forward_state == 'primary_multi' or reverse_state == 'primary_multi':
+        return 'primary_multi'
+    elif forward_state == 'secondary_multi' or reverse_state == 'secondary_multi':
+        return 'secondary_multi'
+    else:
+        raise ValueError(f'Unexpected states forward:{forward_state} '
+                         f'reverse:{reverse_state}')  # pragma: no cover
+
+def get_tag_bytes(align: bytes) -> bytes:
+    """Get the raw tag bytestring of a BAM alignment
+
+    Parameters
+    ----------
+    align : bytes
+        A raw alignment from a BAM file
+
+    Returns
+    -------
+    bytes
+        the tag section of the alignment
+    """
+    return get_tag_bytestring(align,
+                              get_len_read_name(align),
+                              get_number_cigar_operations(align),
+                              get_len_sequence(align))
+
+
+_UMI_DIGITS = str.maketrans('ACGT', '0123')
+
+
+def _pack_umi(umi: str) -> int:
+    # UMIs of up to 15 ACGT bases are packed 2 bits per base after a leading
+    # 1 bit so UMIs of different lengths differ. Other UMIs are a 31 bit CRC
+    # with the top bit set, so may rarely collide with another such UMI
+    if umi and len(umi) <= 15 and not umi.strip('ACGT'):
+        return (1 << 2 * len(umi)) | int(umi.translate(_UMI_DIGITS), 4)
+    return 0x80000000 | (zlib.crc32(umi.encode('latin-1')) & 0x7fffffff)
+
+
+class BarcodeCategoryCounter():
+    """Per cell barcode counts of xenomapper categories for single cell data
+
+    Barcodes are stored once in a dictionary mapping to a row number, and
+    counts are held in a single flat unsigned integer array of
+    rows x categories so that memory scales to millions of barcodes.
+    With a UMI tag each template adds a 64 bit key of its barcode row and
+    category and its UMI packed 2 bits per base (UMIs of more than 15 bases
+    or with other characters are hashed). Keys are sorted in runs spilled to
+    temporary files and the distinct keys counted when counts are read, so
+    memory does not grow with the number of UMIs.
+
+    Parameters
+    ----------
+    barcode_tag : bytes
+        the two byte tag holding the cell barcode [ Default : b'CB' ]
+    umi_tag : bytes, optional
+        the two byte tag holding the UMI. If provided each barcode, UMI and
+        category combination is only counted once, and templates without a
+        UMI are counted in missing_umi instead. [ Default : None ]
+    call_threshold : float
+        the fraction of species specific templates required to call a
+        barcode as primary or secondary [ Default : 0.9 ]
+    tmpdir : str, optional
+        directory for temporary files of UMI keys
+        [ Default : system temporary dir ]
+
+    Attributes
+    ----------
+    missing : int
+        the number of templates without a barcode tag
+    missing_umi : int
+        the number of templates with a barcode but no UMI tag
+
+    Examples
+    --------
+    >>> counter = BarcodeCategoryCounter(b'CB', b'UB')
+    >>> counter.add('primary_specific', primary_aligns)
+    >>> counter.write_matrix(open('barcodes.tsv','w'))
+    """
+    def __init__(self,
+                 barcode_tag: bytes = b'CB',
+                 umi_tag: bytes = None,
+                 call_threshold: float = 0.9,
+                 tmpdir: str = None,
+                 ):
+        self.barcode_tag = barcode_tag
+        self.umi_tag = umi_tag
+        self.call_threshold = call_threshold
+        self.tmpdir = tmpdir
+        self.missing = 0
+        self.missing_umi = 0
+        self._rows = {}
+        self._barcodes = []
+        self._counts = array('I')
+        # barcode row and category column << 32 | packed UMI of each template
+        self._umi_keys = _SortedUint64Runs(tmpdir=tmpdir)
+        self._umi_keys_added = False
+        self._category_index = {c: i for i, c in enumerate(CATEGORIES)}
+
+    def __len__(self):
+        return len(self._barcodes)
+
+    def add_template(self, template: ClassifiedTemplate):
+        """Count a classified template (the xenomap sink protocol)"""
+        self.add(template.category, template.primary_aligns)
+
+    def add(self, category: str, alignments: List[bytes]):
+        """Count a template for the barcode on its first alignment
+
+        Parameters
+        ----------
+        category : str
+            the xenomapper category of the template
+        alignments : List[bytes]
+            a list of BAM alignments in raw binary format from one template
+        """
+        tag_bytes = get_tag_bytes(alignments[0])
+        barcode = get_str_tag(tag_bytes, self.barcode_tag)
+        if barcode is None:
+            self.missing += 1
+            return
+        if self.umi_tag:
+            umi = get_str_tag(tag_bytes, self.umi_tag)
+            if umi is None:
+                self.missing_umi += 1
+                return
+        row = self._rows.get(barcode)
+        if row is None:
+            row = len(self._barcodes)
+            self._rows[barcode] = row
+            self._barcodes.append(barcode)
+            self._counts.extend((0,) * len(CATEGORIES))
+        cell = row * len(CATEGORIES) + self._category_index[category]
+        if self.umi_tag:
+            self._umi_keys.append(cell << 32 | _pack_umi(umi))
+            self._umi_keys_added = True
+            return
+        self._counts[cell] += 1
+
+    def _count_umis(self):
+        # recount the distinct keys when UMIs have been added. The distinct
+        # keys are kept so later templates are still deduplicated
+        if not self._umi_keys_added:
+            return
+        keys = self._umi_keys
+        self._umi_keys = _SortedUint64Runs(tmpdir=self.tmpdir)
+        counts = array('I', bytes(self._counts.itemsize * len(self._counts)))
+        previous = None
+        for key in keys:
+            if key != previous:
+                counts[key >> 32] += 1
+                self._umi_keys.append(key)
+                previous = key
+        self._counts = counts
+        self._umi_keys_added = False
+
+    def counts(self, barcode: str) -> dict:
+        """Get the category counts for a barcode
+
+        Parameters
+        ----------
+        barcode : str
+            a cell barcode
+
+        Returns
+        -------
+        Dict[str, int]
+            counts for each xenomapper category
+        """
+        self._count_umis()
+        start = self._rows[barcode] * len(CATEGORIES)
+        return dict(zip(CATEGORIES,
+                        self._counts[start:start + len(CATEGORIES)]))
+
+    def species_call(self, barcode: str) -> str:
+        """Call the species of origin of a barcode
+
+        Parameters
+        ----------
+        barcode : str
+            a cell barcode
+
+        Returns
+        -------
+        str
+            primary, secondary, mixed or unassigned
+        """
+        counts = self.counts(barcode)
+        primary = counts['primary_specific'] + counts['primary_multi']
+        secondary = counts['secondary_specific'] + counts['secondary_multi']
+        if not primary + secondary:
+            return 'unassigned'
+        elif primary / (primary + secondary) >= self.call_threshold:
+            return 'primary'
+        elif secondary / (primary + secondary) >= self.call_threshold:
+            return 'secondary'
+        else:
+            return 'mixed'
+
+    def write_matrix(self, outfile: TextIO):
+        """Write a tab separated barcode by category matrix with species calls
+
+        Parameters
+        ----------
+        outfile : TextIO
+            destination for the matrix
+        """
+        print('barcode', *CATEGORIES, 'call', sep='\t', file=outfile)
+        for barcode in self._barcodes:
+            counts = self.counts(barcode)
+            print(barcode, *[counts[c] for c in CATEGORIES],
+                  self.species_call(barcode), sep='\t', file=outfile)
+
+
+class ContigCategoryCounter():
+    """Per reference sequence counts of xenomapper categories
+
+    Each primary (not secondary or supplementary) alignment is counted
+    against the reference it is placed on in its own genome, so counts
+    for every category are available for the references of both genomes.
+    Counts are held in a flat unsigned integer array per genome indexed by
+    reference ID x category, with a final row for unplaced reads.
+
+    Parameters
+    ----------
+    primary_refs : Dict[str, int]
+        the reference names and lengths of the primary BAM
+        (eg AlignbatchFileReader.refs)
+    secondary_refs : Dict[str, int]
+        the reference names and lengths of the secondary BAM
+
+    Examples
+    --------
+    >>> counter = ContigCategoryCounter(primary_bam.refs, secondary_bam.refs)
+    >>> counter.add('primary_specific', primary_aligns, secondary_aligns)
+    >>> counter.write_table(open('contigs.tsv','w'))
+    """
+    def __init__(self,
+                 primary_refs: dict,
+                 secondary_refs: dict,
+                 ):
+        self.primary_refs = primary_refs
+        self.secondary_refs = secondary_refs
+        self._category_index = {c: i for i, c in enumerate(CATEGORIES)}
+        self._primary_counts = array('I', (0,) * ((len(primary_refs) + 1)
+                                                 * len(CATEGORIES)))
+        self._secondary_counts = array('I', (0,) * ((len(secondary_refs) + 1)
+                                                   * len(CATEGORIES)))
+
+    @staticmethod
+    def _count(counts: array, n_ref: int, column: int,
+               alignments: List[bytes]):
+        if isinstance(alignments, AlignBatch):
+            flags = alignments.flags
+        else:
+            flags = [get_flag(align) for align in alignments]
+        for align, flag in zip(alignments, flags):
+            if flag & 0x900:
+                continue
+            ref_index = struct.unpack_from('<i', align, 4)[0]
+            if ref_index < 0:
+                ref_index = n_ref
+            counts[ref_index * len(CATEGORIES) + column] += 1
+
+    def add_template(self, template: ClassifiedTemplate):
+        """Count a classified template (the xenomap sink protocol)"""
+        self.add(template.category, template.primary_aligns,
+                 template.secondary_aligns)
+
+    def add(self, category: str,
+            primary_aligns: List[bytes],
+            secondary_aligns: List[bytes]):
+        """Count the primary alignments of a template in both genomes
+
+        Parameters
+        ----------
+        category : str
+            the xenomapper category of the template
+        primary_aligns : List[bytes]
+            the alignments of the template in the primary BAM
+        secondary_aligns : List[bytes]
+            the alignments of the template in the secondary BAM
+        """
+        column = self._category_index[category]
+        self._count(self._primary_counts, len(self.primary_refs),
+                    column, primary_aligns)
+        self._count(self._secondary_counts, len(self.secondary_refs),
+                    column, secondary_aligns)
+
+    def counts(self, genome: str, reference: str) -> dict:
+        """Get the category counts for a reference
+
+        Parameters
+        ----------
+        genome : str
+            primary or secondary
+        reference : str
+            a reference name or '*' for unplaced reads
+
+        Returns
+        -------
+        Dict[str, int]
+            counts for each xenomapper category
+        """
+        if genome == 'primary':
+            refs, counts = self.primary_refs, self._primary_counts
+        elif genome == 'secondary':
+            refs, counts = self.secondary_refs, self._secondary_counts
+        else:
+            raise ValueError(f"{genome} is not primary or secondary")
+        if reference == '*':
+            row = len(refs)
+        else:
+            row = list(refs).index(reference)
+        start = row * len(CATEGORIES)
+        return dict(zip(CATEGORIES, counts[start:start + len(CATEGORIES)]))
+
+    def write_table(self, outfile: TextIO):
+        """Write a tab separated table of category counts per reference
+
+        The genome, reference name and length columns are followed by a
+        count column for each category. Unplaced reads are reported with the
+        reference name * and length 0 as in samtools idxstats.
+
+        Parameters
+        ----------
+        outfile : TextIO
+            destination for the table
+        """
+        print('genome', 'reference', 'length', *CATEGORIES,
+              sep='\t', file=outfile)
+        for genome, refs, counts in (
+                ('primary', self.primary_refs, self._primary_counts),
+                ('secondary', self.secondary_refs, self._secondary_counts)):
+            rows = list(refs.items()) + [('*', 0)]
+            for row, (reference, length) in enumerate(rows):
+                start = row * len(CATEGORIES)
+                print(genome, reference, length,
+                      *counts[start:start + len(CATEGORIES)],
+                      sep='\t', file=outfile)
+
+
+class ScoreHistogram():
+    """Histograms of alignment scores and score margins by category
+
+    For each of the forward and reverse reads of a template the following
+    measures are counted in a histogram for the final category of the
+    template.
+
+    ================  ================================================
+    AS_delta          primary genome AS - secondary genome AS
+    primary_margin    primary genome AS - primary genome XS
+    secondary_margin  secondary genome AS - secondary genome XS
+    primary_AS        primary genome AS
+    secondary_AS      secondary genome AS
+    ================  ================================================
+
+    Values are clipped to the range of the histogram. Measures involving a
+    missing score (-2**31, eg no XS or an unmapped read) are counted
+    separately as None. All histograms are held in a single flat array.
+
+    Parameters
+    ----------
+    min_value : int
+        the lowest bin of the histograms [ Default : -256 ]
+    max_value : int
+        the highest bin of the histograms [ Default : 255 ]
+
+    Examples
+    --------
+    >>> histogram = ScoreHistogram()
+    >>> histogram.add('primary_specific', (-2, -20, -30, -30), None)
+    >>> histogram.write_tsv(open('histograms.tsv','w'))
+    """
+    # xenomap sinks with needs_scores are given templates with scores
+    needs_scores: bool = True
+    MEASURES: Tuple[str, ...] = ('AS_delta', 'primary_margin',
+                                 'secondary_margin', 'primary_AS',
+                                 'secondary_AS')
+    SEGMENTS: Tuple[str, ...] = ('forward', 'reverse')
+
+    def __init__(self, min_value: int = -256, max_value: int = 255):
+        self.min_value = min_value
+        self.max_value = max_value
+        # the final bin of each histogram counts missing values
+        self._n_bins = max_value - min_value + 2
+        self._counts = array('Q', (0,) * (self._n_bins
+                                          * len(self.MEASURES)
+                                          * len(self.SEGMENTS)
+                                          * len(CATEGORIES)))
+        self._category_index = {c: i for i, c in enumerate(CATEGORIES)}
+
+    def _bin(self, value: int) -> int:
+        if value is None:
+            return self._n_bins - 1
+        return min(max(value, self.min_value), self.max_value) - self.min_value
+
+    def _add_segment(self, category_index: int, segment_index: int,
+                     scores: Tuple[int, int, int, int]):
+        primary_AS, primary_XS, secondary_AS, secondary_XS = scores
+        values = (
+            primary_AS - secondary_AS
+            if MIN32INT not in (primary_AS, secondary_AS) else None,
+            primary_AS - primary_XS
+            if MIN32INT not in (primary_AS, primary_XS) else None,
+            secondary_AS - secondary_XS
+            if MIN32INT not in (secondary_AS, secondary_XS) else None,
+            primary_AS if primary_AS != MIN32INT else None,
+            secondary_AS if secondary_AS != MIN32INT else None,
+            )
+        for measure_index, value in enumerate(values):
+            histogram = ((measure_index * len(self.SEGMENTS) + segment_index)
+                         * len(CATEGORIES) + category_index)
+            self._counts[histogram * self._n_bins + self._bin(value)] += 1
+
+    def add_template(self, template: ClassifiedTemplate):
+        """Count a classified template (the xenomap sink protocol)"""
+        self.add(template.category, template.forward_scores,
+                 template.reverse_scores)
+
+    def add(self, category: str,
+            forward_scores: Tuple[int, int, int, int],
+            reverse_scores: Union[Tuple[int, int, int, int], None]):
+        """Count the scores of a template
+
+        Parameters
+        ----------
+        category : str
+            the xenomapper category of the template
+        forward_scores : Tuple[int, int, int, int]
+            primary AS, primary XS, secondary AS and secondary XS of the
+            forward read as returned by xenomap_scores
+        reverse_scores : Tuple[int, int, int, int] or None
+            the scores of the reverse read
+        """
+        category_index = self._category_index[category]
+        self._add_segment(category_index, 0, forward_scores)
+        if reverse_scores is not None:
+            self._add_segment(category_index, 1, reverse_scores)
+
+    def histogram(self, measure: str, segment: str, category: str) -> dict:
+        """Get the non zero counts of one histogram
+
+        Parameters
+        ----------
+        measure : str
+            one of ScoreHistogram.MEASURES
+        segment : str
+            forward or reverse
+        category : str
+            a xenomapper category
+
+        Returns
+        -------
+        Dict[Union[int, None], int]
+            counts for each value, with None for missing values
+        """
+        histogram = ((self.MEASURES.index(measure) * len(self.SEGMENTS)
+                      + self.SEGMENTS.index(segment))
+                     * len(CATEGORIES) + self._category_index[category])
+        start = histogram * self._n_bins
+        counts = {}
+        for bin_index, count in enumerate(
+                self._counts[start:start + self._n_bins]):
+            if count:
+                if bin_index == self._n_bins - 1:
+                    counts[None] = count
+                else:
+                    counts[bin_index + self.min_value] = count
+        return counts
+
+    def _rows(self):
+        for measure in self.MEASURES:
+            for segment in self.SEGMENTS:
+                for category in CATEGORIES:
+                    for value, count in self.histogram(measure, segment,
+                                                       category).items():
+                        yield measure, segment, category, value, count
+
+    def write_tsv(self, outfile: TextIO):
+        """Write non zero histogram counts as a tab separated table
+
+        Values at the limits of the histogram include all clipped values
+        and missing values are written as NA.
+
+        Parameters
+        ----------
+        outfile : TextIO
+            destination for the table
+        """
+        print('measure', 'segment', 'category', 'value', 'count',
+              sep='\t', file=outfile)
+        for measure, segment, category, value, count in self._rows():
+            print(measure, segment, category,
+                  'NA' if value is None else value, count,
+                  sep='\t', file=outfile)
+
+    def write_json(self, outfile: TextIO):
+        """Write non zero histogram counts as JSON
+
+        The JSON object contains the histogram range and nested objects of
+        measure, segment, category and value to count, with missing values
+        under the key NA.
+
+        Parameters
+        ----------
+        outfile : TextIO
+            destination for the JSON
+        """
+        histograms = {}
+        for measure, segment, category, value, count in self._rows():
+            (histograms.setdefault(measure, {})
+                       .setdefault(segment, {})
+                       .setdefault(category, {}))[
+                            'NA' if value is None else str(value)] = count
+        json.dump({'min_value': self.min_value,
+                   'max_value': self.max_value,
+                   'histograms': histograms}, outfile, indent=1)
+
+
+SCORE_TABLE_MAGIC = b"XMSCORE\x01"
+SCORE_TABLE_COLUMNS: Tuple[str, ...] = (
+    ('primary_offset', 'secondary_offset')
+    + tuple(f"{genome}_{segment}_{score}"
+            for genome in ('primary', 'secondary')
+            for segment in ('forward', 'reverse')
+            for score in ('AS', 'XS', 'max_AS', 'max_XS'))
+    + ('flags',))
+# little endian uint64 x 2, int32 x 16, uint32 flags
+SCORE_TABLE_RECORD = struct.Struct('<QQ16iI')
+# flags bits 0-3 record which segments are present for
+# primary forward, primary reverse, secondary forward, secondary reverse
+# bits 4-7 record where get_bamprimary_AS_XS raised ValueError
+SEGMENT_PRESENT_FLAGS = (0x1, 0x2, 0x4, 0x8)
+BAMPRIMARY_INVALID_FLAGS = (0x10, 0x20, 0x40, 0x80)
+
+
+class ScoreTableWriter():
+    """Writer for a compact binary table of per template scores
+
+    For each template the bamprimary and maximum AS and XS of forward and
+    reverse reads in both species are recorded along with the offset of the
+    template in each input BAM. This allows templates to be reclassified with
+    a different min_score, score function or state map with
+    xenomap_from_scores without reading the BAM files.
+
+    The file is a header of SCORE_TABLE_MAGIC, a little endian uint32 length
+    and JSON metadata, followed by fixed width SCORE_TABLE_RECORD records.
+    It can be memory mapped, for example with numpy:
+
+    >>> dtype = numpy.dtype([(c, '<u8') for c in SCORE_TABLE_COLUMNS[:2]] +
+    >>>                     [(c, '<i4') for c in SCORE_TABLE_COLUMNS[2:-1]] +
+    >>>                     [('flags', '<u4')])
+    >>> numpy.memmap(filename, dtype, mode='r', offset=metadata_length)
+
+    Parameters
+    ----------
+    file : str or Path
+        filename for the score table
+    AS_function : Callable[[bytes], int]
+        the function used to get AS scores [ Default : get_AS ]
+    XS_function : Callable[[bytes], int]
+        the function used to get XS scores [ Default : get_XS ]
+    """
+    def __init__(self,
+                 file: Union[str, Path],
+                 AS_function: Callable = get_AS,
+                 XS_function: Callable = get_XS,
+                 ):
+        self.AS_function = AS_function
+        self.XS_function = XS_function
+        self._file = open(file, 'wb')
+        self._buffer = bytearray()
+        metadata = json.dumps({'version': __version__,
+                               'AS_function': AS_function.__name__,
+                               'XS_function': XS_function.__name__,
+                               'columns': SCORE_TABLE_COLUMNS,
+                               'record_format': SCORE_TABLE_RECORD.format,
+                               }).encode('utf-8')
+        self._file.write(SCORE_TABLE_MAGIC
+                         + struct.pack('<I', len(metadata))
+                         + metadata)
+
+    def _segment_scores(self, alignments, invalid_flag):
+        flags = SEGMENT_PRESENT_FLAGS[invalid_flag] if alignments else 0
+        try:
+            scores = get_bamprimary_AS_XS(alignments,
+                                          AS_function=self.AS_function,
+                                          XS_function=self.XS_function)
+        except ValueError:
+            scores = (MIN32INT, MIN32INT)
+            flags |= BAMPRIMARY_INVALID_FLAGS[invalid_flag]
+        scores += get_max_AS_XS(alignments,
+                                AS_function=self.AS_function,
+                                XS_function=self.XS_function)
+        return scores, flags
+
+    def add(self,
+            primary_aligns: List[bytes],
+            secondary_aligns: List[bytes],
+            primary_offset: int,
+            secondary_offset: int):
+        """Add the scores of a template to the table
+
+        Parameters
+        ----------
+        primary_aligns : List[bytes]
+            the alignments of the template in the primary BAM
+        secondary_aligns : List[bytes]
+            the alignments of the template in the secondary BAM
+        primary_offset : int
+            offset of the template in the primary BAM
+        secondary_offset : int
+            offset of the template in the secondary BAM
+        """
+        scores = ()
+        flags = 0
+        segments = (split_forward_reverse(primary_aligns)
+                    + split_forward_reverse(secondary_aligns))
+        for i, segment in enumerate(segments):
+            segment_scores, segment_flags = self._segment_scores(segment, i)
+            scores += segment_scores
+            flags |= segment_flags
+        self._buffer += SCORE_TABLE_RECORD.pack(primary_offset,
+                                                secondary_offset,
+                                                *scores, flags)
+        if len(self._buffer) >= 2**20:
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+
+    def close(self):
+        self._file.write(self._buffer)
+        self._buffer = bytearray()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_score_table(file: Union[str, Path]
+                     ) -> Tuple[dict, Iterable[Tuple[int, ...]]]:
+    """Memory map a score table written by ScoreTableWriter
+
+    Parameters
+    ----------
+    file : str or Path
+        filename of the score table
+
+    Returns
+    -------
+    dict
+        the metadata from the table header
+    Iterable[Tuple[int, ...]]
+        an iterator of records with fields in SCORE_TABLE_COLUMNS order
+
+    Raises
+    ------
+    ValueError
+        if the file is not a xenomapper score table
+    """
+    with open(file, 'rb') as infile:
+        if infile.read(len(SCORE_TABLE_MAGIC)) != SCORE_TABLE_MAGIC:
+            raise ValueError(f"{file} is not a xenomapper score table")
+        metadata_length = struct.unpack('<I', infile.read(4))[0]
+        metadata = json.loads(infile.read(metadata_length).decode('utf-8'))
+        start = len(SCORE_TABLE_MAGIC) + 4 + metadata_length
+        infile.seek(0, 2)
+        if infile.tell() == start:
+            return metadata, iter(())
+        mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    return metadata, SCORE_TABLE_RECORD.iter_unpack(memoryview(mapped)[start:])
+
+
+NAME_INDEX_SUFFIX = '.xni'
+NAME_INDEX_MAGIC = b"XMNAMES\x01"
+NAME_INDEX_VERSION = 1
+# little endian uint64 of the name CRC32 << 32 | the interval holding it
+NAME_INDEX_RECORD = struct.Struct('<Q')
+
+_DIGIT_RUNS = re.compile(rb'(\d+)')
+
+
+def natural_name_key(name: bytes) -> tuple:
+    """A sort key ordering read names as samtools sort -n does
+
+    Runs of digits are compared as numbers, so b'read9' sorts before
+    b'read10'.
+
+    Parameters
+    ----------
+    name : bytes
+        a read name
+
+    Returns
+    -------
+    tuple
+        alternating runs of non-digit bytes and integers
+    """
+    parts = _DIGIT_RUNS.split(name)
+    parts[1::2] = [int(digits) for digits in parts[1::2]]
+    return tuple(parts)
+
+
+class NameIndexWriter():
+    """Build a sampled read name index for a name ordered BAM file
+
+    The name and offset of every nth template are recorded. If the names of
+    all templates are in byte order, or in the natural order of samtools
+    sort -n, a template can be found by a binary search of the sampled names
+    followed by reading at most `every` templates. For files in any other
+    order the index holds a record of the 32 bit CRC of the name of each
+    template and the interval of `every` templates that holds it, sorted by
+    CRC, so a template is found by a binary search of the records and
+    reading at most `every` templates (more only for colliding CRCs).
+    Records are sorted in runs spilled to temporary files, so memory does
+    not grow with the number of templates.
+
+    The file is a header of NAME_INDEX_MAGIC, a little endian uint32 length
+    and JSON metadata holding the sampled names front coded (the length of
+    the prefix shared with the previous sampled name and the remaining
+    suffix), followed by the offset of each interval as a little endian
+    uint64 and, for unsorted files, the fixed width NAME_INDEX_RECORD
+    records. NameIndex searches the records through a memory map.
+
+    Parameters
+    ----------
+    every : int
+        sample the name of every nth template [ Default : 1024 ]
+    tmpdir : str, optional
+        directory for temporary files [ Default : system temporary dir ]
+
+    Attributes
+    ----------
+    templates : int
+        the number of templates added
+    order : str
+        'bytes', 'natural' or 'unsorted'
+    """
+
+    def __init__(self, every: int = 1024, tmpdir: str = None):
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        self.every = every
+        self.templates = 0
+        self.offsets = array('Q')
+        self.names = []
+        self._records = _SortedUint64Runs(tmpdir=tmpdir)
+        self._bytes_sorted = True
+        self._natural_sorted = True
+        self._previous = None
+        self._previous_key = None
+
+    @property
+    def order(self) -> str:
+        if self._bytes_sorted:
+            return 'bytes'
+        if self._natural_sorted:
+            return 'natural'
+        return 'unsorted'
+
+    def add(self, name: bytes, offset: int):
+        """Add the next template in file order
+
+        Parameters
+        ----------
+        name : bytes
+            the read name without a null terminator
+        offset : int
+            the offset of the template (a virtual offset for BGZF files)
+        """
+        interval, position = divmod(self.templates, self.every)
+        if not position:
+            self.offsets.append(offset)
+            self.names.append(name)
+        self.templates += 1
+        self._records.append(zlib.crc32(name) << 32 | interval)
+        if self._natural_sorted:
+            key = natural_name_key(name)
+            if self._previous_key is not None and key <= self._previous_key:
+                self._natural_sorted = False
+            self._previous_key = key
+        if self._bytes_sorted:
+            if self._previous is not None and name <= self._previous:
+                self._bytes_sorted = False
+            self._previous = name
+
+    def write(self, file: Union[str, Path], offsets: Iterable[int] = None):
+        """Write the index
+
+        Parameters
+        ----------
+        file : str or Path
+            filename for the index, conventionally the BAM filename with
+            NAME_INDEX_SUFFIX appended
+        offsets : Iterable[int], optional
+            offsets to write in place of those added, eg virtual offsets
+            resolved from uncompressed offsets by bgzf_virtual_offsets
+        """
+        order = self.order
+        offsets = self.offsets if offsets is None else array('Q', offsets)
+        coded = []
+        previous = b''
+        for name in self.names if order != 'unsorted' else ():
+            shared = 0
+            for a, b in zip(previous, name):
+                if a != b:
+                    break
+                shared += 1
+            coded.append([shared, name[shared:].decode('latin-1')])
+            previous = name
+        metadata = json.dumps({'version': NAME_INDEX_VERSION,
+                               'every': self.every,
+                               'templates': self.templates,
+                               'order': order,
+                               'intervals': len(offsets),
+                               'names': coded,
+                               }, separators=(',', ':')).encode('utf-8')
+        try:
+            with open(file, 'wb') as outfile:
+                outfile.write(NAME_INDEX_MAGIC
+                              + struct.pack('<I', len(metadata))
+                              + metadata)
+                _write_uint64s(outfile, offsets)
+                if order == 'unsorted':
+                    _write_uint64s(outfile, self._records)
+        finally:
+            self._records.close()
+
+
+class NameIndex():
+    """A read name index written by NameIndexWriter
+
+    Parameters
+    ----------
+    file : str or Path
+        filename of the index
+
+    Attributes
+    ----------
+    hashed : int
+        the number of name CRC records (0 unless the file is unsorted)
+
+    Raises
+    ------
+    ValueError
+        if the file is not a xenomapper name index
+    """
+
+    def __init__(self, file: Union[str, Path]):
+        with open(file, 'rb') as infile:
+            try:
+                if infile.read(len(NAME_INDEX_MAGIC)) != NAME_INDEX_MAGIC:
+                    raise ValueError
+                metadata_length = struct.unpack('<I', infile.read(4))[0]
+                index = json.loads(infile.read(metadata_length)
+                                   .decode('utf-8'))
+            except (struct.error, ValueError):
+                raise ValueError(f"{file} is not a xenomapper name index")
+            if index.get('version') != NAME_INDEX_VERSION:
+                raise ValueError(f"{file} is a version {index.get('version')} "
+                                 f"name index, not version "
+                                 f"{NAME_INDEX_VERSION}")
+            self.every = index['every']
+            self.templates = index['templates']
+            self.order = index['order']
+            self.offsets = array('Q', _read_uint64s(
+                                        io.BytesIO(infile.read(
+                                            index['intervals'] * 8))))
+            self._start = infile.tell()
+            infile.seek(0, 2)
+            self.hashed = ((infile.tell() - self._start)
+                           // NAME_INDEX_RECORD.size)
+            self._mapped = (mmap.mmap(infile.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                            if self.hashed else None)
+        self.names = []
+        previous = b''
+        for shared, suffix in index['names']:
+            previous = previous[:shared] + suffix.encode('latin-1')
+            self.names.append(previous)
+
+    def close(self):
+        """Close the memory map of the records"""
+        if self._mapped is not None:
+            self._mapped.close()
+            self._mapped = None
+
+    def _first_record(self, value: int) -> int:
+        # the position of the first record not less than value
+        unpack_from = NAME_INDEX_RECORD.unpack_from
+        low, high = 0, self.hashed
+        while low < high:
+            middle = (low + high) // 2
+            offset = self._start + middle * NAME_INDEX_RECORD.size
+            if unpack_from(self._mapped, offset)[0] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def search(self, name: bytes) -> List[Tuple[int, int]]:
+        """The ranges of templates that could hold a read name
+
+        Parameters
+        ----------
+        name : bytes
+            the read name without a null terminator
+
+        Returns
+        -------
+        List[Tuple[int, int]]
+            the offset of the first template of each range and the number of
+            templates to read
+        """
+        if not self.offsets:
+            return []
+        if self.order == 'unsorted':
+            if not self.hashed:
+                return []
+            crc = zlib.crc32(name)
+            low = self._first_record(crc << 32)
+            high = self._first_record((crc + 1) << 32)
+            intervals = [NAME_INDEX_RECORD.unpack_from(
+                            self._mapped,
+                            self._start + record * NAME_INDEX_RECORD.size
+                            )[0] & 0xffffffff
+                         for record in range(low, high)]
+            return [(self.offsets[interval], self.every)
+                    for interval in sorted(set(intervals))]
+        key = natural_name_key if self.order == 'natural' else bytes
+        target = key(name)
+        # the last sampled name not after name
+        low, high = 0, len(self.names)
+        while low < high:
+            middle = (low + high) // 2
+            if target < key(self.names[middle]):
+                high = middle
+            else:
+                low = middle + 1
+        if not low:
+            return []
+        return [(self.offsets[low - 1], self.every)]
+
+
+def bgzf_virtual_offsets(file: Union[str, Path],
+                         offsets: Iterable[int]) -> List[int]:
+    """Convert offsets counted from the first alignment of a BAM to virtual
+
+    Parameters
+    ----------
+    file : str or Path
+        a BAM file
+    offsets : Iterable[int]
+        offsets in the uncompressed alignment data, eg the total length of
+        the alignments written before a template
+
+    Returns
+    -------
+    List[int]
+        BGZF virtual offsets
+    """
+    offsets = list(offsets)
+    if not offsets:
+        return []
+    with open(file, 'rb') as handle:
+        blocks = [(raw_start, data_start) for (raw_start, raw_length,
+                                               data_start, data_length)
+                  in BgzfBlocks(handle) if data_length]
+    raw_starts = {raw_start: data_start for raw_start, data_start in blocks}
+    data_starts = [data_start for raw_start, data_start in blocks]
+    handle = BgzfReader(file, 'rb')
+    try:
+        first = AlignbatchFileReader(handle, track_offsets=True)._ubam.tell()
+    finally:
+        handle.close()
+    first = raw_starts[first >> 16] + (first & 0xffff)
+    virtual_offsets = []
+    for offset in offsets:
+        offset += first
+        block = bisect.bisect_right(data_starts, offset) - 1
+        raw_start, data_start = blocks[block]
+        virtual_offsets.append((raw_start << 16) | (offset - data_start))
+    return virtual_offsets
+
+
+def find_indexed_template(bam_file: Union[str, Path],
+                          name: Union[str, bytes],
+                          index_file: Union[str, Path] = None,
+                          ) -> Union[AlignBatch, None]:
+    """Read the alignments of one template using a read name index
+
+    Parameters
+    ----------
+    bam_file : str or Path
+        a BAM file indexed with NameIndexWriter
+    name : str or bytes
+        the read name
+    index_file : str or Path, optional
+        the index [ Default : bam_file with NAME_INDEX_SUFFIX appended ]
+
+    Returns
+    -------
+    AlignBatch or None
+        the alignments of the template or None if the name is not in the file
+    """
+    if isinstance(name, str):
+        name = name.encode('latin-1')
+    index = NameIndex(index_file or f"{bam_file}{NAME_INDEX_SUFFIX}")
+    try:
+        ranges = index.search(name)
+    finally:
+        index.close()
+    raw_name = name + b'\x00'
+    handle = BgzfReader(str(bam_file), 'rb')
+    try:
+        reader = AlignbatchFileReader(handle, track_offsets=True)
+        for start, count in ranges:
+            batches = reader.iter_alignbatches_at(start)
+            for batch_offset, alignbatch in islice(batches, count):
+                if alignbatch.name == raw_name:
+                    return alignbatch
+    finally:
+        handle.close()
+    return None
+
+
+def explain_template(primary_bam: Union[str, Path],
+                     secondary_bam: Union[str, Path],
+                     name: Union[str, bytes],
+                     score_function: Callable = get_bamprimary_AS_XS,
+                     AS_function: Callable = get_AS,
+                     XS_function: Callable = get_XS,
+                     min_score: int = MIN32INT,
+                     conservative: bool = False,
+                     ) -> Union[ClassifiedTemplate, None]:
+    """Classify one template found with the name indexes of both BAMs
+
+    Parameters
+    ----------
+    primary_bam : str or Path
+        the primary BAM, indexed during a xenomapper2 --name-index run
+    secondary_bam : str or Path
+        the secondary BAM, indexed during the same run
+    name : str or bytes
+        the read name
+    score_function, AS_function, XS_function, min_score, conservative
+        as for xenomap
+
+    Returns
+    -------
+    ClassifiedTemplate or None
+        the template with scores or None if the name is not in both BAMs
+    """
+    primary_aligns = find_indexed_template(primary_bam, name)
+    secondary_aligns = find_indexed_template(secondary_bam, name)
+    if primary_aligns is None or secondary_aligns is None:
+        return None
+    return next(classify_alignbatches([(primary_aligns, secondary_aligns)],
+                                      score_function=score_function,
+                                      AS_function=AS_function,
+                                      XS_function=XS_function,
+                                      min_score=min_score,
+                                      conservative=conservative,
+                                      scores=True))
+
+
+class AdaptiveTuner():
+    """Choose the output compression level from the throughput of a run
+
+    Compression runs on the same thread as reading and classification so it
+    always adds to the run time. The tuner bounds how much. While the first
+    sample_seconds of a run are timed the outputs are written at the lowest
+    level, and the alignments actually written (the output genome of each
+    template in a requested category) are kept as a sample. BGZF sized
+    blocks of the sample are trial compressed at each level. The run time
+    per template without compression is estimated as the measured time per
+    template less the time to compress the bytes written per template at the
+    lowest level. The highest level that compresses the bytes written per
+    template in at most max_overhead of that time is applied to the output
+    writer. Only the compression level is tuned. Thread counts and chunk
+    sizes (--threads, chunk_templates and the reader chunk_size) keep their
+    given values. Runs without an output writer are not tuned.
+
+    The tuner is a xenomap sink, started by xenomap when given as tuner.
+
+    Parameters
+    ----------
+    sample_seconds : float
+        seconds of the run to time before choosing a level [ Default : 2.0 ]
+    levels : Iterable[int]
+        the zlib compression levels to consider [ Default : 1 to 9 ]
+    sample_size : int
+        the maximum bytes of alignments kept for trial compression
+        [ Default : 1MB ]
+    codec : Codec, optional
+        the codec of the output writer [ Default : None (zlib) ]
+    max_overhead : float
+        the fraction of the run time without compression that compression
+        may add [ Default : 0.25 ]
+
+    Attributes
+    ----------
+    settings : dict
+        the chosen compresslevel, the number of templates timed
+        (timed_templates), written (written_templates) and kept for trial
+        compression (compressed_templates), the templates_per_second and
+        bytes_per_template written while timing, the
+        compress_bytes_per_second of the chosen level and its estimated
+        compress_share of the run time. None if the run has no output
+        writer or finished before tuning
+
+    Examples
+    --------
+    >>> tuner = AdaptiveTuner()
+    >>> xenomap(primary_bam, secondary_bam, output_writer, tuner=tuner)
+    >>> tuner.settings['compresslevel']
+    """
+
+    def __init__(self, sample_seconds: float = 2.0,
+                 levels: Iterable[int] = range(1, 10),
+                 sample_size: int = 2**20,
+                 codec: Codec = None,
+                 max_overhead: float = 0.25):
+        self.sample_seconds = sample_seconds
+        self.levels = tuple(sorted(levels))
+        self.sample_size = sample_size
+        self.codec = Codec('zlib') if codec is None else codec
+        self.max_overhead = max_overhead
+        self.settings = None
+        self._output_writer = None
+
+    def start(self, output_writer) -> bool:
+        """Start timing a run writing to output_writer
+
+        Parameters
+        ----------
+        output_writer : XenomapperOutputWriter or TaggedOutputWriter
+            the writer to set the compression level of
+
+        Returns
+        -------
+        bool
+            False if there is no output to tune and the tuner is idle
+        """
+        if output_writer is None or not output_writer.requested:
+            return False
+        output_writer.set_compresslevel(self.levels[0])
+        self._output_writer = output_writer
+        self._requested = set(output_writer.requested)
+        self._sample = bytearray()
+        self._templates = self._written_templates = 0
+        self._sampled_templates = 0
+        self._started = time.perf_counter()
+        return True
+
+    def add_template(self, template: ClassifiedTemplate):
+        """Time and sample a template (the xenomap sink protocol)"""
+        if self._output_writer is None or self.settings is not None:
+            return
+        self._templates += 1
+        if template.category in self._requested:
+            self._written_templates += 1
+            if len(self._sample) < self.sample_size:
+                self._sample += b''.join(template.output_aligns)
+                self._sampled_templates += 1
+        elapsed = time.perf_counter() - self._started
+        if elapsed >= self.sample_seconds:
+            self._choose(self._output_writer, bytes(self._sample),
+                         self._sampled_templates, self._written_templates,
+                         self._templates, elapsed)
+            self._sample = None
+
+    def _compress_rates(self, sample: bytes) -> Dict[int, float]:
+        # the trial compression throughput of each level in bytes per second
+        clock = time.perf_counter
+        blocks = [sample[i:i + BGZF_BLOCK_SIZE]
+                  for i in range(0, len(sample), BGZF_BLOCK_SIZE)]
+        compress = self.codec.compress
+        compress_rates = {}
+        for level in self.levels:
+            started = clock()
+            for block in blocks:
+                compress(block, level)
+            # guard against an empty sample
+            compress_rates[level] = len(sample) / max(clock() - started, 1e-9)
+        return compress_rates
+
+    def _choose(self, output_writer, sample: bytes, sampled_templates: int,
+                written_templates: int, templates: int, elapsed: float,
+                compress_rates: Dict[int, float] = None):
+        if compress_rates is None:
+            compress_rates = self._compress_rates(sample)
+        bytes_per_template = (len(sample) / max(sampled_templates, 1)
+                              * written_templates / templates)
+        # the outputs were written at the lowest level while timing
+        uncompressed_time = max(elapsed / templates
+                                - bytes_per_template
+                                / compress_rates[self.levels[0]], 0.0)
+        compresslevel = self.levels[0]
+        for level in self.levels:
+            if (bytes_per_template / compress_rates[level]
+                    <= self.max_overhead * uncompressed_time):
+                compresslevel = level
+        compress_time = bytes_per_template / compress_rates[compresslevel]
+        if output_writer is not None:
+            output_writer.set_compresslevel(compresslevel)
+        self.settings = {
+            'compresslevel': compresslevel,
+            'timed_templates': templates,
+            'written_templates': written_templates,
+            'compressed_templates': sampled_templates,
+            'templates_per_second': templates / max(elapsed, 1e-9),
+            'bytes_per_template': bytes_per_template,
+            'compress_bytes_per_second': compress_rates[compresslevel],
+            'compress_share': (compress_time
+                               / max(uncompressed_time + compress_time,
+                                     1e-9)),
+            }
+
+    def summary(self) -> str:
+        """Describe the chosen settings for the run summary
+
+        Returns
+        -------
+        str
+        """
+        if self._output_writer is None:
+            return "No BAM output to auto-tune"
+        if self.settings is None:
+            return "Input finished before auto-tuning"
+        settings = self.settings
+        return (f"Auto-tuned output compresslevel {settings['compresslevel']}"
+                f" from {settings['timed_templates']} templates "
+                f"({settings['templates_per_second']:.0f} templates/s "
+                f"writing {settings['bytes_per_template']:.0f} bytes per "
+                f"template, compressing "
+                f"{settings['compress_bytes_per_second'] / 2**20:.1f} MB/s "
+                f"with {self.codec.name}, an estimated "
+                f"{settings['compress_share']:.0%} of the run time)")
+
+
+class CategoryCounter():
+    """A xenomap sink counting the categories and state pairs of templates
+
+    Attributes
+    ----------
+    pair_counts : Counter
+        the number of templates with each (forward_state, reverse_state)
+    counts : Dict[str, int]
+        the number of templates in each category
+    """
+
+    def __init__(self):
+        self.pair_counts = Counter()
+        self.counts = { 'primary_specific' : 0,
+                        'secondary_specific' : 0,
+                        'primary_multi' : 0,
+                        'secondary_multi' : 0,
+                        'unresolved' : 0,
+                        'unassigned' : 0,
+                        }
+
+    def add_template(self, template: ClassifiedTemplate):
+        """Count a classified template"""
+        self.pair_counts[(template.forward_state, template.reverse_state)] += 1
+        self.counts[template.category] += 1
+
+
+class OutputWriterSink():
+    """A xenomap sink writing templates to an output writer
+
+    Parameters
+    ----------
+    output_writer : XenomapperOutputWriter
+        or any writer with write_alignbatch(category, alignments) such as
+        TaggedOutputWriter or ReadGroupOutputWriter. Use the fastq option of
+        XenomapperOutputWriter for FASTQ output
+    """
+
+    def __init__(self, output_writer):
+        self.output_writer = output_writer
+        self._write_alignbatch = output_writer.write_alignbatch
+        # read groups are routed by the primary genome records
+        self._route = isinstance(output_writer, ReadGroupOutputWriter)
+
+    def add_template(self, template: ClassifiedTemplate):
+        """Write the alignments of a template to its category output"""
+        if self._route:
+            self._write_alignbatch(template.category, template.output_aligns,
+                                   route_aligns=template.primary_aligns)
+        else:
+            self._write_alignbatch(template.category, template.output_aligns)
+
+
+class CallbackSink():
+    """A xenomap sink calling a function with each classified template
+
+    Parameters
+    ----------
+    function : Callable[[ClassifiedTemplate], Any]
+        called with each template in file order
+    needs_scores : bool
+        give the function templates with scores [ Default : False ]
+
+    Examples
+    --------
+    >>> names = []
+    >>> sink = CallbackSink(lambda t: names.append(t.primary_aligns.name))
+    >>> xenomap(primary_bam, secondary_bam, None, sinks=[sink])
+    """
+
+    def __init__(self, function: Callable, needs_scores: bool = False):
+        self.add_template = function
+        self.needs_scores = needs_scores
+
+
+class NameIndexSink():
+    """A xenomap sink building read name indexes of the inputs and outputs
+
+    Indexes are built for both input BAMs, which must be read with
+    track_offsets=True from BGZF readers, and for each unsorted BAM category
+    output of a XenomapperOutputWriter opened with a filename. Other outputs
+    (FASTQ, sorted, tagged or read group outputs) are not indexed.
+
+    Parameters
+    ----------
+    primary_bam : AlignbatchFileReader
+        the primary BAM reader
+    secondary_bam : AlignbatchFileReader
+        the secondary BAM reader
+    primary_file : str or Path
+        the primary BAM filename
+    secondary_file : str or Path
+        the secondary BAM filename
+    output_writer : XenomapperOutputWriter, optional
+        the output writer of the run [ Default : None ]
+    every : int
+        sample the name of every nth template [ Default : 1024 ]
+
+    Attributes
+    ----------
+    filenames : List[str]
+        the indexed BAM filenames
+    """
+    needs_offsets = True
+
+    def __init__(self,
+                 primary_bam: AlignbatchFileReader,
+                 secondary_bam: AlignbatchFileReader,
+                 primary_file: Union[str, Path],
+                 secondary_file: Union[str, Path],
+                 output_writer: XenomapperOutputWriter = None,
+                 every: int = 1024,
+                 ):
+        self.primary_bam = primary_bam
+        self.secondary_bam = secondary_bam
+        self.primary_index = NameIndexWriter(every)
+        self.secondary_index = NameIndexWriter(every)
+        self.filenames = [str(primary_file), str(secondary_file)]
+        self._outputs = {}
+        if isinstance(output_writer, XenomapperOutputWriter):
+            for category in sorted(output_writer.requested):
+                fileobj = output_writer[category]
+                if not isinstance(fileobj, BufferedCategorySink):
+                    continue
+                filename = getattr(fileobj.bgzf_file._handle, 'name', None)
+                if isinstance(filename, str):
+                    # the index and the length of data written before
+                    self._outputs[category] = [NameIndexWriter(every), 0,
+                                               filename]
+
+    def add_template(self, template: ClassifiedTemplate):
+        """Add a template to the indexes of both inputs and its output"""
+        name = None
+        if template.primary_aligns is not None:
+            name = template.primary_aligns.name[:-1]
+            self.primary_index.add(name, self.primary_bam.batch_offset)
+        if template.secondary_aligns is not None:
+            name = template.secondary_aligns.name[:-1]
+            self.secondary_index.add(name, self.secondary_bam.batch_offset)
+        output = self._outputs.get(template.category)
+        if output is not None and name is not None:
+            output[0].add(name, output[1])
+            output[1] += sum(len(align) for align in template.output_aligns)
+
+    def write(self):
+        """Write the indexes after the output writer has been closed"""
+        self.primary_index.write(f"{self.filenames[0]}{NAME_INDEX_SUFFIX}")
+        self.secondary_index.write(f"{self.filenames[1]}{NAME_INDEX_SUFFIX}")
+        for index, length, filename in self._outputs.values():
+            index.write(f"{filename}{NAME_INDEX_SUFFIX}",
+                        offsets=bgzf_virtual_offsets(filename, index.offsets))
+            self.filenames.append(filename)
+
+
+def check_name_ordered(alignbatch_reader: AlignbatchFileReader):
+    """Raise a ValueError if a BAM file is coordinate sorted
+
+    Parameters
+    ----------
+    alignbatch_reader : AlignbatchFileReader
+        a reader of a BAM file
+
+    Raises
+    ------
+    ValueError
+        if the header sort order is coordinate
+    """
+    if alignbatch_reader.sort_order == 'coordinate':
+        name = getattr(alignbatch_reader._ubam, 'name', 'BAM file')
+        raise ValueError(f"{name} is coordinate sorted. "
+                         "BAM files must be ordered by readname for xenomapper")
+
+
+def gil_enabled() -> bool:
+    """Whether the global interpreter lock is enabled in this interpreter
+
+    Returns
+    -------
+    bool
+        False only on free-threaded CPython builds running without the GIL
+    """
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    if is_gil_enabled is None:
+        return True
+    return is_gil_enabled()
+
+
+def classify_alignbatches(batches: Iterable[Tuple[AlignBatch, AlignBatch]],
+                          score_function: Callable = get_bamprimary_AS_XS,
+                          AS_function: Callable = get_AS,
+                          XS_function: Callable = get_XS,
+                          min_score: int = MIN32INT,
+                          conservative: bool = False,
+                          scores: bool = False,
+                          ) -> Generator[ClassifiedTemplate, None, None]:
+    """Classify pairs of primary and secondary alignment batches
+
+    Parameters
+    ----------
+    batches : Iterable[Tuple[AlignBatch, AlignBatch]]
+        pairs of primary and secondary alignment batches from one template
+    score_function : Callable
+        get_bamprimary_AS_XS or get_max_AS_XS
+    AS_function : Callable[[bytes], int]
+        a function returning the AS score of an alignment
+    XS_function : Callable[[bytes], int]
+        a function returning the XS score of an alignment
+    min_score : int
+        the score that matches must exceed [ Default : -2**31 ]
+    conservative : bool
+        use conservative_state_map to combine forward and reverse states
+    scores : bool
+        also return the scores of the forward and reverse reads
+
+    Yields
+    ------
+    ClassifiedTemplate
+        the category, states and alignments of each template. The scores
+        are None unless scores is True
+    """
+    category_map = conservative_state_map if conservative else state_map
+    new_template = ClassifiedTemplate._make
+    forward_scores = reverse_scores = None
+    for primary_aligns, secondary_aligns in batches:
+        if not scores:
+            forward_state, reverse_state = xenomap_states(primary_aligns,
+                                                  secondary_aligns,
+                                                  score_function,
+                                                  AS_function=AS_function,
+                                                  XS_function=XS_function,
+                                                  min_score = min_score)
+        else:
+            forward_scores, reverse_scores = xenomap_scores(primary_aligns,
+                                                  secondary_aligns,
+                                                  score_function,
+                                                  AS_function=AS_function,
+                                                  XS_function=XS_function)
+            forward_state = get_mapping_state(*forward_scores, min_score)
+            reverse_state = (None if reverse_scores is None else
+                             get_mapping_state(*reverse_scores, min_score))
+        yield new_template((category_map(forward_state, reverse_state),
+                            forward_state, reverse_state,
+                            primary_aligns, secondary_aligns,
+                            forward_scores, reverse_scores))
+
+
+def _classify_chunk(chunk, kwargs):
+    return list(classify_alignbatches(chunk, **kwargs))
+
+
+def classify_alignbatches_threaded(batches: Iterable[Tuple[AlignBatch,
+                                                           AlignBatch]],
+                                   threads: int,
+                                   chunk_templates: int = 1024,
+                                   **kwargs
+                                   ) -> Generator[ClassifiedTemplate, None, None]:
+    """Classify pairs of alignment batches in chunks on a pool of threads
+
+    Batches are read in the calling thread and classified in chunks of
+    chunk_templates by classify_alignbatches. Results are yielded in the
+    order of batches, so counting and output remain in the calling thread
+    and no counter is shared between threads. At most 2 * threads chunks
+    are held waiting. Only free-threaded CPython builds (see gil_enabled)
+    classify in parallel; with the GIL the result is the same but slower
+    than classify_alignbatches.
+
+    Parameters
+    ----------
+    batches : Iterable[Tuple[AlignBatch, AlignBatch]]
+        pairs of primary and secondary alignment batches from one template
+    threads : int
+        the number of classification threads
+    chunk_templates : int
+        the number of templates classified by a thread at a time
+        [ Default : 1024 ]
+    **kwargs
+        keyword arguments for classify_alignbatches
+
+    Yields
+    ------
+    ClassifiedTemplate
+        as classify_alignbatches
+    """
+    batches = iter(batches)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            chunk = list(islice(batches, chunk_templates))
+            if chunk:
+                pending.append(pool.submit(_classify_chunk, chunk, kwargs))
+            while pending and (not chunk or len(pending) > 2 * threads):
+                yield from pending.popleft().result()
+            if not chunk:
+                break
+
+
+def benchmark_threads(batches: List[Tuple[AlignBatch, AlignBatch]],
+                      thread_counts: Iterable[int] = (1, 2, 4),
+                      chunk_templates: int = 1024,
+                      **kwargs
+                      ) -> Dict[int, Dict[str, float]]:
+    """Time classify_alignbatches_threaded against classify_alignbatches
+
+    The speedup of threaded classification is only expected on free-threaded
+    CPython builds (see gil_enabled). With the GIL no speedup is expected.
+
+    Parameters
+    ----------
+    batches : List[Tuple[AlignBatch, AlignBatch]]
+        pairs of primary and secondary alignment batches held in memory so
+        reading is not timed
+    thread_counts : Iterable[int]
+        the numbers of threads to time [ Default : (1, 2, 4) ]
+    chunk_templates : int
+        as for classify_alignbatches_threaded [ Default : 1024 ]
+    **kwargs
+        keyword arguments for classify_alignbatches
+
+    Returns
+    -------
+    Dict[int, Dict[str, float]]
+        for 0 (serial classify_alignbatches) and each thread count the
+        'templates_per_second' and the 'speedup' relative to serial
+    """
+    clock = time.perf_counter
+    started = clock()
+    for template in classify_alignbatches(batches, **kwargs):
+        pass
+    serial = len(batches) / max(clock() - started, 1e-9)
+    results = {0: {'templates_per_second': serial, 'speedup': 1.0}}
+    for threads in thread_counts:
+        started = clock()
+        for template in classify_alignbatches_threaded(
+                            batches, threads,
+                            chunk_templates=chunk_templates, **kwargs):
+            pass
+        rate = len(batches) / max(clock() - started, 1e-9)
+        results[threads] = {'templates_per_second': rate,
+                            'speedup': rate / serial}
+    return results
+
+
+def iter_classified(primary_bam: AlignbatchFileReader,
+                    secondary_bam: AlignbatchFileReader,
+                    score_function: Callable = get_bamprimary_AS_XS,
+                    AS_function: Callable = get_AS,
+                    XS_function: Callable = get_XS,
+                    min_score: int = MIN32INT,
+                    conservative: bool = False,
+                    scores: bool = False,
+                    threads: int = 1,
+                    ) -> Generator[ClassifiedTemplate, None, None]:
+    """Lazily classify the templates of a pair of BAM files
+
+    For using xenomapper2 from Python without writing output files.
+    Arguments are as for xenomap.
+
+    Parameters
+    ----------
+    primary_bam : AlignbatchFileReader
+        An interable that yields iterables of primary BAM alignments
+    secondary_bam : AlignbatchFileReader
+        An interable that yields iterables of secondary BAM alignments
+    scores : bool
+        include the scores of the forward and reverse reads
+    threads : int
+        classify on this many threads on free-threaded builds
+        [ Default : 1 ]
+
+    Yields
+    ------
+    ClassifiedTemplate
+        the category, states and alignments of each template in file order
+
+    Raises
+    ------
+    ValueError
+        if either BAM file is coordinate sorted
+
+    Examples
+    --------
+    >>> for template in iter_classified(primary_bam, secondary_bam):
+    ...     if template.category == 'primary_specific':
+    ...         process(template.primary_aligns)
+    """
+    check_name_ordered(primary_bam)
+    check_name_ordered(secondary_bam)
+    return _classify(zip_longest(primary_bam, secondary_bam, fillvalue=None),
+                     threads=threads,
+                     score_function=score_function,
+                     AS_function=AS_function,
+                     XS_function=XS_function,
+                     min_score=min_score,
+                     conservative=conservative,
+                     scores=scores)
+
+
+def _classify(batches, threads: int = 1, **kwargs):
+    if threads > 1 and not gil_enabled():
+        return classify_alignbatches_threaded(batches, threads, **kwargs)
+    return classify_alignbatches(batches, **kwargs)
+
+
+def xenomap(primary_bam: AlignbatchFileReader,
+            secondary_bam: AlignbatchFileReader,
+            output_writer: XenomapperOutputWriter,
+            score_function: Callable = get_bamprimary_AS_XS,
+            AS_function: Callable = get_AS,
+            XS_function: Callable = get_XS,
+            min_score: int = MIN32INT,
+            conservative: bool = False,
+            barcode_counter: BarcodeCategoryCounter = None,
+            score_table: ScoreTableWriter = None,
+            contig_counter: ContigCategoryCounter = None,
+            score_histogram: ScoreHistogram = None,
+            tuner: AdaptiveTuner = None,
+            threads: int = 1,
+            sinks: Iterable = (),
+            ):
+    """core method to coordinate the xenomapping of BAMS
+
+    Each classified template is passed to a set of sinks in turn: a
+    CategoryCounter, the optional counters, the score table and an
+    OutputWriterSink for output_writer. A sink is any object with an
+    add_template(template: ClassifiedTemplate) method, and receives
+    templates with scores if it has a true needs_scores attribute. Sinks
+    with a true needs_offsets attribute read the batch_offset of the readers
+    (eg NameIndexSink) so templates are then classified serially.
+
+    Parameters
+    ----------
+    primary_bam : AlignbatchFileReader
+        An interable that yields iterables of primary BAM alignments
+
+    secondary_bam : AlignbatchFileReader
+        An interable that yields iterables of secondary BAM alignments
+
+    output_writer : XenomapperOutputWriter
+        output writer that holds output files of type bam.FileWriter
+        or None to only count categories
+
+    score_function : Callable
+        a xenomapper alignment batch calling function
+        get_bamprimary_AS_XS or get_max_AS_XS
+
+    AS_function : Callable[[bytes], int]
+        a function that accepts a BAM alignment bytestring and returns the AS
+        score (alignment score) as an integer
+        get_AS or get_cigar_based_score
+
+    XS_function : Callable[[bytes], int]
+        a function that accepts a BAM alignment bytestring and returns the XS
+        score as an integer
+        get_XS, get_ZS, always_zero, or always_very_negative
+
+    min_score : int
+        the score that matches must exceed in order to be
+        considered valid matches. Note scores equalling this
+        value will also be considered not valid matches.
+        [ Default : -2**31 ]
+    conservative
+
+    barcode_counter : BarcodeCategoryCounter, optional
+        accumulates per cell barcode category counts from the primary BAM
+
+    score_table : ScoreTableWriter, optional
+        records per template scores for xenomap_from_scores.
+        Both BAMs must be read with track_offsets=True
+
+    contig_counter : ContigCategoryCounter, optional
+        accumulates per reference category counts for both genomes
+
+    score_histogram : ScoreHistogram, optional
+        accumulates histograms of scores and score margins by category
+
+    tuner : AdaptiveTuner, optional
+        times the start of the run and sets the output compression level.
+        Not used without an output_writer
+
+    threads : int
+        classify templates on this many threads with
+        classify_alignbatches_threaded. Only used on free-threaded builds
+        (see gil_enabled) and without a score_table, sinks needing offsets
+        or readers with spill_records, otherwise templates are classified
+        serially. [ Default : 1 ]
+
+    sinks : Iterable, optional
+        additional sinks given each template after the counters and before
+        output_writer eg CallbackSink
+
+    Returns
+    -------
+    Tuple[Counter, Counter, XenomapperOutputWriter]
+    """
+
+    check_name_ordered(primary_bam)
+    check_name_ordered(secondary_bam)
+
+    counter = CategoryCounter()
+    sinks = [sink for sink in (counter, score_histogram, barcode_counter,
+                               contig_counter, *sinks)
+             if sink is not None]
+    if score_table is not None:
+        sinks.append(CallbackSink(lambda template: score_table.add(
+                                        template.primary_aligns,
+                                        template.secondary_aligns,
+                                        primary_bam.batch_offset,
+                                        secondary_bam.batch_offset)))
+    if output_writer is not None:
+        sinks.append(OutputWriterSink(output_writer))
+    if score_table is not None or any(getattr(sink, 'needs_offsets', False)
+                                      for sink in sinks):
+        # the reader offsets of the batch being counted are needed so can
+        # not be used with the read ahead of the threaded classifier
+        threads = 1
+    if any(getattr(reader, 'spill_records', None) is not None
+           for reader in (primary_bam, secondary_bam)):
+        # spilled batches are closed when the reader moves on so can not be
+        # held by the read ahead of the threaded classifier either
+        threads = 1
+
+    if tuner is not None and tuner.start(output_writer):
+        sinks.append(tuner)
+
+    batches = zip_longest(primary_bam, secondary_bam, fillvalue = None)
+
+    # TODO This code probably does not do what I think it should
+    # Need to work out how to properly test for uneven file lengths
+    #if primary_aligns == None or secondary_aligns == None:
+    #    raise ValueError("BAM files are unequal lengths")
+    classified = _classify(batches,
+                           threads=threads,
+                           score_function=score_function,
+                           AS_function=AS_function,
+                           XS_function=XS_function,
+                           min_score=min_score,
+                           conservative=conservative,
+                           scores=any(getattr(sink, 'needs_scores', False)
+                                      for sink in sinks))
+    add_functions = [sink.add_template for sink in sinks]
+    for template in classified:
+        for add_template in add_functions:
+            add_template(template)
+
+    return counter.pair_counts, counter.counts, output_writer
+
+
+def xenomap_from_scores(score_table: Union[str, Path],
+                        output_writer: XenomapperOutputWriter = None,
+                        primary_bam: AlignbatchFileReader = None,
+                        secondary_bam: AlignbatchFileReader = None,
+                        use_max: bool = False,
+                        min_score: int = MIN32INT,
+                        conservative: bool = False,
+                        ):
+    """Reclassify templates from a score table written during a xenomap run
+
+    Alignments are only read from the BAM files for templates in categories
+    requested in the output_writer, by seeking to the recorded offsets.
+
+    Parameters
+    ----------
+    score_table : str or Path
+        filename of a table written by ScoreTableWriter
+
+    output_writer : XenomapperOutputWriter, optional
+        output writer that holds output files of type bam.FileWriter
+
+    primary_bam : AlignbatchFileReader, optional
+        a seekable reader of the primary BAM. Required for output
+
+    secondary_bam : AlignbatchFileReader, optional
+        a seekable reader of the secondary BAM. Required for output
+
+    use_max : bool
+        use the maximum scores (as get_max_AS_XS) rather than the scores of
+        the bam primary alignment (as get_bamprimary_AS_XS)
+
+    min_score : int
+        the score that matches must exceed in order to be
+        considered valid matches.
+        [ Default : -2**31 ]
+
+    conservative : bool
+        use conservative_state_map to combine forward and reverse states
+
+    Returns
+    -------
+    Tuple[Counter, Counter, XenomapperOutputWriter]
+
+    Raises
+    ------
+    ValueError
+        if use_max is False and a template did not have exactly one bam
+        primary alignment for a segment (as get_bamprimary_AS_XS)
+    """
+    score_index = 2 if use_max else 0
+    metadata, records = read_score_table(score_table)
+
+    def templates():
+        for record in records:
+            flags = record[-1]
+            scores = [record[2 + i * 4 + score_index:4 + i * 4 + score_index]
+                      for i in range(4)]
+            has_reverse = flags & (SEGMENT_PRESENT_FLAGS[1]
+                                   | SEGMENT_PRESENT_FLAGS[3])
+            if not use_max:
+                segments = (0, 1, 2, 3) if has_reverse else (0, 2)
+                for i in segments:
+                    if flags & BAMPRIMARY_INVALID_FLAGS[i]:
+                        raise ValueError("Template at offset "
+                                         f"{record[0]} does not have exactly "
+                                         "one primary alignment")
+            yield (record[0], record[1],
+                   (*scores[0], *scores[2]),
+                   (*scores[1], *scores[3]) if has_reverse else None)
+
+    return _xenomap_scored(templates(), output_writer, primary_bam,
+                           secondary_bam, min_score, conservative)
+
+
+def _xenomap_scored(templates: Iterable[Tuple[int, int, Tuple[int, ...],
+                                              Union[Tuple[int, ...], None]]],
+                    output_writer: XenomapperOutputWriter,
+                    primary_bam: AlignbatchFileReader,
+                    secondary_bam: AlignbatchFileReader,
+                    min_score: int,
+                    conservative: bool):
+    # classify templates of primary offset, secondary offset and the forward
+    # and reverse (None if absent) scores (AS1, XS1, AS2, XS2) as xenomap
+    category_pair_counts = Counter()
+    category_counts = { 'primary_specific' : 0,
+                        'secondary_specific' : 0,
+                        'primary_multi' : 0,
+                        'secondary_multi' : 0,
+                        'unresolved' : 0,
+                        'unassigned' : 0,
+                        }
+    requested = output_writer.requested if output_writer else set()
+    if requested and (primary_bam is None or secondary_bam is None):
+        raise ValueError("BAM files are required to write output")
+    for primary_offset, secondary_offset, forward, reverse in templates:
+        forward_state = get_mapping_state(*forward, min_score)
+        if reverse is not None:
+            reverse_state = get_mapping_state(*reverse, min_score)
+        else:
+            reverse_state = None
+        category_pair_counts[(forward_state, reverse_state)] += 1
+        if conservative:
+            category = conservative_state_map(forward_state, reverse_state)
+        else:
+            category = state_map(forward_state, reverse_state)
+        category_counts[category] += 1
+        if category in requested:
+            if category in ['secondary_specific', 'secondary_multi']:
+                aligns = secondary_bam.get_alignbatch_at(secondary_offset)
+            else:
+                aligns = primary_bam.get_alignbatch_at(primary_offset)
+            output_writer.write_alignbatch(category, aligns)
+
+    return category_pair_counts, category_counts, output_writer
+
+
+GENOME_SCORES_MAGIC = b"XMGSCOR\x01"
+# scores of each segment: the AS, XS, ZS and cigar based score of the bam
+# primary alignment and the maxima as get_max_AS_XS with each XS function
+GENOME_SCORE_NAMES: Tuple[str, ...] = ('AS', 'XS', 'ZS', 'cigar',
+                                       'max_AS', 'max_XS', 'max_ZS',
+                                       'max_cigar')
+GENOME_SCORES_COLUMNS: Tuple[str, ...] = (
+    ('name_hash', 'offset')
+    + tuple(f"{segment}_{score}"
+            for segment in ('forward', 'reverse')
+            for score in GENOME_SCORE_NAMES)
+    + ('flags',))
+# array typecodes of the columns, written little endian
+GENOME_SCORES_TYPES: Tuple[str, ...] = ('Q', 'Q') + ('i',) * 16 + ('I',)
+
+
+def name_hash(name: bytes) -> int:
+    """A 64 bit hash of a read name that is stable between runs
+
+    Parameters
+    ----------
+    name : bytes
+        the read name
+
+    Returns
+    -------
+    int
+    """
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(),
+                          'little')
+
+
+def _genome_segment_scores(alignments) -> Tuple[Tuple[int, ...], bool]:
+    # the GENOME_SCORE_NAMES scores of one segment and whether
+    # get_bamprimary_AS_XS raised ValueError
+    try:
+        AS, XS = get_bamprimary_AS_XS(alignments, get_AS, get_XS)
+        ZS = get_bamprimary_AS_XS(alignments, always_very_negative,
+                                  get_ZS)[1]
+        cigar = get_bamprimary_AS_XS(alignments, get_cigar_based_score,
+                                     always_very_negative)[0]
+        invalid = False
+    except ValueError:
+        AS = XS = ZS = cigar = MIN32INT
+        invalid = True
+    max_AS, max_XS = get_max_AS_XS(alignments, get_AS, get_XS)
+    max_ZS = get_max_AS_XS(alignments, get_AS, get_ZS)[1]
+    max_cigar = get_max_AS_XS(alignments, get_cigar_based_score,
+                              always_very_negative)[0]
+    return (AS, XS, ZS, cigar, max_AS, max_XS, max_ZS, max_cigar), invalid
+
+
+class GenomeScoresWriter():
+    """Writer for the per template scores of one genome's BAM file
+
+    Unlike a ScoreTableWriter table, which holds the scores of one pairing
+    of genomes, a genome scores file is extracted once from each BAM and any
+    two can be paired with xenomap_from_genome_scores. Every score used by
+    the --zs, --cigar and --max options is recorded so the files can be
+    classified with any of them.
+
+    The file is GENOME_SCORES_MAGIC followed by chunks of templates. Each
+    chunk is a little endian uint32 template count followed by one array per
+    column of GENOME_SCORES_COLUMNS (with GENOME_SCORES_TYPES) so a reader
+    only needs to decode the columns it uses. Templates are numbered by
+    their position in the file. Flags record present segments and invalid
+    bam primary scores as SEGMENT_PRESENT_FLAGS[:2] and
+    BAMPRIMARY_INVALID_FLAGS[:2].
+
+    Parameters
+    ----------
+    file : str or Path
+        filename for the genome scores
+    chunk_templates : int
+        templates per chunk [ Default : 65536 ]
+    """
+
+    def __init__(self, file: Union[str, Path], chunk_templates: int = 65536):
+        self.chunk_templates = chunk_templates
+        self.templates = 0
+        self._file = open(file, 'wb')
+        self._file.write(GENOME_SCORES_MAGIC)
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self._columns = [array(typecode) for typecode in GENOME_SCORES_TYPES]
+
+    def add(self, alignments: List[bytes], offset: int = 0):
+        """Add the scores of a template
+
+        Parameters
+        ----------
+        alignments : List[bytes] or AlignBatch
+            the alignments of the template
+        offset : int
+            offset of the template in the BAM (a virtual offset for BGZF
+            readers) [ Default : 0 ]
+        """
+        if isinstance(alignments, (AlignBatch, SpilledAlignBatch)):
+            name = alignments.name
+        else:
+            name = get_raw_read_name(alignments[0],
+                                     get_len_read_name(alignments[0]))
+        values = [name_hash(name), offset]
+        flags = 0
+        for i, segment in enumerate(split_forward_reverse(alignments)):
+            scores, invalid = _genome_segment_scores(segment)
+            values.extend(scores)
+            if segment:
+                flags |= SEGMENT_PRESENT_FLAGS[i]
+            if invalid:
+                flags |= BAMPRIMARY_INVALID_FLAGS[i]
+        values.append(flags)
+        for column, value in zip(self._columns, values):
+            column.append(value)
+        self.templates += 1
+        if len(self._columns[0]) >= self.chunk_templates:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        count = len(self._columns[0])
+        if not count:
+            return
+        self._file.write(struct.pack('<I', count))
+        for column in self._columns:
+            if sys.byteorder == 'big': #pragma: no cover
+                column.byteswap()
+            self._file.write(column.tobytes())
+        self._new_chunk()
+
+    def close(self):
+        self._write_chunk()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def extract_genome_scores(alignbatch_reader: AlignbatchFileReader,
+                          file: Union[str, Path],
+                          chunk_templates: int = 65536) -> int:
+    """Write the scores of every template of a BAM file to a genome scores file
+
+    Parameters
+    ----------
+    alignbatch_reader : AlignbatchFileReader
+        a reader of a name ordered BAM file. Read with track_offsets=True
+        from a BgzfReader to record offsets for writing output
+    file : str or Path
+        filename for the genome scores
+    chunk_templates : int
+        templates per chunk [ Default : 65536 ]
+
+    Returns
+    -------
+    int
+        the number of templates
+    """
+    check_name_ordered(alignbatch_reader)
+    with GenomeScoresWriter(file, chunk_templates) as writer:
+        for alignbatch in alignbatch_reader:
+            writer.add(alignbatch, alignbatch_reader.batch_offset or 0)
+    return writer.templates
+
+
+def read_genome_scores(file: Union[str, Path],
+                       columns: Iterable[str] = GENOME_SCORES_COLUMNS,
+                       ) -> Generator[List[array], None, None]:
+    """Read chunks of columns from a genome scores file
+
+    Parameters
+    ----------
+    file : str or Path
+        a file written by GenomeScoresWriter
+    columns : Iterable[str]
+        the columns to decode [ Default : GENOME_SCORES_COLUMNS ]
+
+    Yields
+    ------
+    List[array]
+        an array for each of columns for each chunk
+
+    Raises
+    ------
+    ValueError
+        if the file is not a genome scores file
+    """
+    indexes = [GENOME_SCORES_COLUMNS.index(column) for column in columns]
+    sizes = [array(typecode).itemsize for typecode in GENOME_SCORES_TYPES]
+    with open(file, 'rb') as infile:
+        if infile.read(len(GENOME_SCORES_MAGIC)) != GENOME_SCORES_MAGIC:
+            raise ValueError(f"{file} is not a xenomapper genome scores file")
+        while True:
+            count = infile.read(4)
+            if not count:
+                break
+            count = struct.unpack('<I', count)[0]
+            start = infile.tell()
+            chunk = []
+            for index in indexes:
+                infile.seek(start + count * sum(sizes[:index]))
+                column = array(GENOME_SCORES_TYPES[index])
+                column.frombytes(infile.read(count * sizes[index]))
+                if sys.byteorder == 'big': #pragma: no cover
+                    column.byteswap()
+                chunk.append(column)
+            infile.seek(start + count * sum(sizes))
+            yield chunk
+
+
+def _genome_score_rows(file: Union[str, Path], columns: Iterable[str]):
+    for chunk in read_genome_scores(file, columns):
+        yield from zip(*chunk)
+
+
+def xenomap_from_genome_scores(primary_scores: Union[str, Path],
+                               secondary_scores: Union[str, Path],
+                               output_writer: XenomapperOutputWriter = None,
+                               primary_bam: AlignbatchFileReader = None,
+                               secondary_bam: AlignbatchFileReader = None,
+                               use_max: bool = False,
+                               score_type: str = 'XS',
+                               min_score: int = MIN32INT,
+                               conservative: bool = False,
+                               ):
+    """Classify templates by pairing the genome scores files of two BAMs
+
+    Parameters
+    ----------
+    primary_scores : str or Path
+        genome scores of the primary BAM written by extract_genome_scores
+
+    secondary_scores : str or Path
+        genome scores of the secondary BAM
+
+    output_writer : XenomapperOutputWriter, optional
+        output writer that holds output files of type bam.FileWriter
+
+    primary_bam : AlignbatchFileReader, optional
+        a seekable reader of the primary BAM. Required for output
+
+    secondary_bam : AlignbatchFileReader, optional
+        a seekable reader of the secondary BAM. Required for output
+
+    use_max : bool
+        use the maximum scores (as get_max_AS_XS) rather than the scores of
+        the bam primary alignment (as get_bamprimary_AS_XS)
+
+    score_type : str
+        'XS' (get_AS and get_XS), 'ZS' (get_AS and get_ZS) or 'cigar'
+        (get_cigar_based_score and always_very_negative) [ Default : 'XS' ]
+
+    min_score : int
+        the score that matches must exceed in order to be
+        considered valid matches.
+        [ Default : -2**31 ]
+
+    conservative : bool
+        use conservative_state_map to combine forward and reverse states
+
+    Returns
+    -------
+    Tuple[Counter, Counter, XenomapperOutputWriter]
+
+    Raises
+    ------
+    ValueError
+        if the files do not have the same templates in the same order, or
+        if use_max is False and a template did not have exactly one bam
+        primary alignment for a segment (as get_bamprimary_AS_XS)
+    """
+    if score_type not in ('XS', 'ZS', 'cigar'):
+        raise ValueError(f"{score_type} is not a score type. "
+                         "Use XS, ZS or cigar")
+    prefix = 'max_' if use_max else ''
+    if score_type == 'cigar':
+        names = (f'{prefix}cigar',)
     else:
-        raise ValueError(f'Unexpected states forward:{forward_state}'
-                         f'reverse:{reverse_state}')
+        names = (f'{prefix}AS', f'{prefix}{score_type}')
+    columns = (('name_hash', 'offset', 'flags')
+               + tuple(f'{segment}_{name}' for segment in ('forward',
+                                                           'reverse')
+                       for name in names))
+    # AS and XS of each segment padding XS for cigar scores
+    if len(names) == 1:
+        split = lambda row: ((row[3], MIN32INT), (row[4], MIN32INT))
+    else:
+        split = lambda row: (row[3:5], row[5:7])
+
+    def templates():
+        for ordinal, (primary, secondary) in enumerate(zip_longest(
+                _genome_score_rows(primary_scores, columns),
+                _genome_score_rows(secondary_scores, columns))):
+            if (primary is None or secondary is None
+                    or primary[0] != secondary[0]):
+                raise ValueError("Genome scores files do not have the same "
+                                 f"templates (at template {ordinal})")
+            flags = primary[2] | secondary[2]
+            has_reverse = flags & SEGMENT_PRESENT_FLAGS[1]
+            if not use_max and flags & (BAMPRIMARY_INVALID_FLAGS[0]
+                                        | (BAMPRIMARY_INVALID_FLAGS[1]
+                                           if has_reverse else 0)):
+                raise ValueError(f"Template {ordinal} does not have "
+                                 "exactly one primary alignment")
+            primary_forward, primary_reverse = split(primary)
+            secondary_forward, secondary_reverse = split(secondary)
+            yield (primary[1], secondary[1],
+                   (*primary_forward, *secondary_forward),
+                   (*primary_reverse, *secondary_reverse)
+                   if has_reverse else None)
+
+    return _xenomap_scored(templates(), output_writer, primary_bam,
+                           secondary_bam, min_score, conservative)
+
+
+# gzip magic, deflate method and FEXTRA flag that start every BGZF block
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+# XLEN of 6 followed by the BC subfield of length 2 holding BSIZE
+BGZF_EXTRA = b"\x06\x00BC\x02\x00"
+# valid SAM read name characters [!-?A-~]
+_QNAME_CHARACTERS = frozenset(range(0x21, 0x7f)) - {0x40}
+
+
+def read_bgzf_block(handle: BinaryIO, coffset: int) -> Tuple[bytes, int]:
+    """Read and decompress the BGZF block starting at a file offset
+
+    Parameters
+    ----------
+    handle : BinaryIO
+        a BGZF file opened in binary mode (not decompressed)
+    coffset : int
+        the offset of the start of the block in the compressed file
+
+    Returns
+    -------
+    (bytes, int)
+        the decompressed data and the compressed size of the block.
+        (b'', 0) at the end of the file.
+
+    Raises
+    ------
+    ValueError
+        if there is not a BGZF block at coffset
+    """
+    handle.seek(coffset)
+    header = handle.read(18)
+    if not header:
+        return b'', 0
+    if header[:4] != BGZF_MAGIC or header[10:16] != BGZF_EXTRA:
+        raise ValueError(f"No BGZF block at offset {coffset}")
+    block_size = struct.unpack_from('<H', header, 16)[0] + 1
+    payload = handle.read(block_size - 18)
+    return zlib.decompress(payload[:-8], -15), block_size
+
+
+def find_bgzf_block(handle: BinaryIO, offset: int) -> int:
+    """Find the first BGZF block starting at or after a file offset
+
+    Candidate blocks are confirmed by a second block header, or the end of
+    the file, immediately following the candidate.
+
+    Parameters
+    ----------
+    handle : BinaryIO
+        a BGZF file opened in binary mode (not decompressed)
+    offset : int
+        the offset in the compressed file to search from
+
+    Returns
+    -------
+    int
+        the offset of the block or -1 if no block was found
+    """
+    handle.seek(offset)
+    # a block is at most 64KiB so a complete block follows any start
+    data = handle.read(3 * 2**16)
+    at_end = len(data) < 3 * 2**16
+    start = data.find(BGZF_MAGIC)
+    while start >= 0:
+        if data[start + 10:start + 16] == BGZF_EXTRA:
+            block_end = (start + 1
+                         + struct.unpack_from('<H', data, start + 16)[0])
+            if ((at_end and block_end == len(data))
+                    or data[block_end:block_end + 4] == BGZF_MAGIC):
+                return offset + start
+        start = data.find(BGZF_MAGIC, start + 1)
+    return -1
+
+
+def _is_alignment_start(data: bytes, start: int, n_ref: int) -> bool:
+    if len(data) < start + 36:
+        return False
+    (block_size, ref_index, pos, len_read_name, _, _, number_cigar_operations,
+     _, len_sequence) = BAM_CORE.unpack_from(data, start)
+    next_ref_index, next_pos = struct.unpack_from('<ii', data, start + 24)
+    if not (-1 <= ref_index < n_ref and -1 <= next_ref_index < n_ref
+            and pos >= -1 and next_pos >= -1
+            and len_read_name >= 2 and len_sequence >= 0
+            and 32 + len_read_name + 4 * number_cigar_operations
+                + (len_sequence + 1) // 2 + len_sequence
+                <= block_size < 2**24):
+        return False
+    name = data[start + 36:start + 35 + len_read_name]
+    terminator = data[start + 35 + len_read_name:start + 36 + len_read_name]
+    return (terminator in (b'\x00', b'')
+            and all(c in _QNAME_CHARACTERS for c in name))
+
+
+def find_alignment_start(data: bytes, n_ref: int, start: int = 0,
+                         n_check: int = 3) -> int:
+    """Find the first plausible BAM alignment record in decompressed data
+
+    Used to resynchronise to the alignment records after seeking to an
+    arbitrary BGZF block. A record is accepted if its fixed fields and read
+    name are valid and the following n_check - 1 records (where present in
+    data) are also valid.
+
+    Parameters
+    ----------
+    data : bytes
+        decompressed BAM alignment data
+    n_ref : int
+        the number of reference sequences in the BAM header
+    start : int
+        the offset in data to start searching from
+    n_check : int
+        the number of consecutive records that must be valid
+
+    Returns
+    -------
+    int
+        the offset of the alignment or -1 if none was found
+    """
+    for candidate in range(start, len(data) - 35):
+        record = candidate
+        checked = 0
+        while checked < n_check and record + 36 <= len(data):
+            if not _is_alignment_start(data, record, n_ref):
+                break
+            checked += 1
+            record += 4 + struct.unpack_from('<i', data, record)[0]
+        else:
+            return candidate
+    return -1
 
-def conservative_state_map(forward_state, reverse_state):
-    # logic is directly copied from xenomapper 1.0
-    """Conservative tate map for inferring fragment state from forward & reverse
-    Reads where there is ambiguous evidence will be assigned the least specific
-    state.
+
+class BamTemplateSampler():
+    """Random access to whole templates in a name grouped BGZF BAM file
 
     Parameters
     ----------
-    forward_state : str
-        a xenomapper state for the forward read
-        (primary_specific,primary_multi,secondary_specific,secondary_multi,
-        unassigned, unresolved)
+    file : str or Path
+        a BGZF compressed BAM file with alignments grouped by read name
 
-    reverse_state: str or None
-        a xenomapper state for the reverse read or None
-        (primary_specific,primary_multi,secondary_specific,secondary_multi,
-        unassigned, unresolved) or None
+    Attributes
+    ----------
+    reader : AlignbatchFileReader
+        reader used to read templates at virtual offsets
+    size : int
+        the size of the compressed file
+    """
 
-    Returns
-    -------
-    str
-        a xenomapper state for the fragment
-        (primary_specific,primary_multi,secondary_specific,secondary_multi,
-        unassigned, unresolved)
+    def __init__(self, file: Union[str, Path]):
+        self.reader = AlignbatchFileReader(BgzfReader(file, 'rb'),
+                                           track_offsets=True)
+        self.first_offset = self.reader._start_of_alignments
+        self._handle = open(file, 'rb')
+        self._handle.seek(0, 2)
+        self.size = self._handle.tell()
+        self._templates = {}
+
+    def _block_templates(self, block: int) -> List[int]:
+        # virtual offsets of the templates starting in a block
+        block = max(block, self.first_offset >> 16)
+        if block in self._templates:
+            return self._templates[block]
+        data, block_size = read_bgzf_block(self._handle, block)
+        block_length = len(data)
+        # records and templates may continue into the next block
+        data += read_bgzf_block(self._handle, block + block_size)[0]
+        if block == self.first_offset >> 16:
+            align_start = self.first_offset & 0xffff
+            previous_name = None
+        else:
+            align_start = find_alignment_start(data, self.reader.n_ref)
+            # the first record found may be part way through a template
+            previous_name = (data[align_start + 36:
+                                  align_start + 36 + data[align_start + 12]]
+                             if align_start >= 0 else None)
+        starts = []
+        record = align_start
+        while 0 <= record < block_length and len(data) >= record + 36:
+            name = data[record + 36:record + 36 + data[record + 12]]
+            if name != previous_name:
+                starts.append((block << 16) | record)
+            previous_name = name
+            record += 4 + struct.unpack_from('<i', data, record)[0]
+        self._templates[block] = starts
+        return starts
 
-    Notes
-    -----
-    In future these will be of type PEP586 Literal
+    def template_at(self, offset: int,
+                    random_generator: random.Random = None,
+                    ) -> Union[Tuple[int, AlignBatch], None]:
+        """Get a template starting in the first BGZF block after an offset
 
-    """
+        Parameters
+        ----------
+        offset : int
+            an offset in the compressed file
+        random_generator : random.Random, optional
+            choose a random template starting in the block rather than the
+            first template
 
-    if reverse_state == None:
-        return forward_state
-    elif forward_state == 'unassigned' or reverse_state == 'unassigned':
-        return 'unassigned'
-    elif forward_state == 'unresolved' or reverse_state == 'unresolved' \
-            or (forward_state in ['primary_specific', 'primary_multi'] and \
-                reverse_state in ['secondary_specific', 'secondary_multi']) \
-            or (forward_state in ['secondary_specific', 'secondary_multi'] and \
-                reverse_state in ['primary_specific', 'primary_multi']):
-        return 'unresolved'
-    elif forward_state == 'primary_specific' or reverse_state == 'primary_specific':
-        return 'primary_specific'
-    elif forward_state == 'secondary_specific' or reverse_state == 'secondary_specific':
-        return 'secondary_specific'
-    elif forward_state == 'primary_multi' or reverse_state == 'primary_multi':
-        return 'primary_multi'
-    elif forward_state == 'secondary_multi' or reverse_state == 'secondary_multi':
-        return 'secondary_multi'
-    else:
-        raise ValueError(f'Unexpected states forward:{forward_state} '
-                         f'reverse:{reverse_state}')  # pragma: no cover
+        Returns
+        -------
+        (int, AlignBatch) or None
+            the virtual offset and alignments of the template, or None if
+            no template starts in the block
+        """
+        block = find_bgzf_block(self._handle, offset)
+        if block < 0:
+            return None
+        starts = self._block_templates(block)
+        if not starts:
+            return None
+        if random_generator is None:
+            virtual_offset = starts[0]
+        else:
+            virtual_offset = random_generator.choice(starts)
+        return virtual_offset, self.reader.get_alignbatch_at(virtual_offset)
+
+    def _containing_block(self, offset: int) -> Tuple[int, int]:
+        # the start and compressed size of the block containing an offset
+        block = find_bgzf_block(self._handle, max(0, offset - 2**16 + 1))
+        while True:
+            self._handle.seek(block)
+            header = self._handle.read(18)
+            if len(header) < 18:
+                return -1, 0
+            block_size = struct.unpack_from('<H', header, 16)[0] + 1
+            if block + block_size > offset:
+                return block, block_size
+            block += block_size
+
+    def random_template(self, random_generator: random.Random,
+                        ) -> Union[Tuple[int, AlignBatch, float], None]:
+        """Get a random template from the block containing a random offset
+
+        A block is chosen with probability proportional to its compressed
+        size and a template starting in it uniformly, so a template is
+        chosen with probability proportional to the compressed size of its
+        block divided by the number of templates starting in the block.
+        Accepting a template with probability proportional to the returned
+        density (templates per compressed byte of its block) makes every
+        template equally likely.
 
-def xenomap(primary_bam: AlignbatchFileReader,
-            secondary_bam: AlignbatchFileReader,
-            output_writer: XenomapperOutputWriter,
-            score_function: Callable = get_bamprimary_AS_XS,
-            AS_function: Callable = get_AS,
-            XS_function: Callable = get_XS,
-            min_score: int = MIN32INT,
-            conservative: bool = False,
-            ):
-    """core method to coordinate the xenomapping of BAMS
+        Parameters
+        ----------
+        random_generator : random.Random
 
-    Parameters
-    ----------
-    primary_bam : AlignbatchFileReader
-        An interable that yields iterables of primary BAM alignments
+        Returns
+        -------
+        (int, AlignBatch, float) or None
+            the virtual offset and alignments of the template and the
+            template density of its block, or None if no template starts in
+            the block
+        """
+        block, block_size = self._containing_block(
+                                random_generator.randrange(self.size))
+        if block < 0:
+            return None
+        starts = self._block_templates(block)
+        if not starts or starts[0] >> 16 != block:
+            return None
+        virtual_offset = random_generator.choice(starts)
+        return (virtual_offset,
+                self.reader.get_alignbatch_at(virtual_offset),
+                len(starts) / block_size)
+
+    def find_template(self, name: bytes, offset: int,
+                      window: int = 2**16,
+                      max_window: int = None,
+                      ) -> Union[Tuple[int, AlignBatch], None]:
+        """Find a template by read name near a compressed file offset
+
+        Templates are read forward from offset - window until one passes
+        offset + window, doubling the window until the template is found.
 
-    secondary_bam : AlignbatchFileReader
-        An interable that yields iterables of secondary BAM alignments
+        Parameters
+        ----------
+        name : bytes
+            the raw read name including the null terminator
+        offset : int
+            the expected offset of the template in the compressed file
+        window : int
+            the initial distance either side of offset to search
+        max_window : int, optional
+            the largest distance either side of offset to search
+            [ Default : None (search the whole file) ]
 
-    output_writer : XenomapperOutputWriter
-        output writer that holds output files of type bam.FileWriter
+        Returns
+        -------
+        (int, AlignBatch) or None
+            the virtual offset and alignments of the template, or None if it
+            is not in the file (or within max_window of offset)
+        """
+        while True:
+            start = max(0, offset - window)
+            if start == 0:
+                start_offset = self.first_offset
+            else:
+                found = self.template_at(start)
+                start_offset = found[0] if found else self.first_offset
+            for batch_offset, alignbatch in self.reader.iter_alignbatches_at(
+                                                                start_offset):
+                if alignbatch.name == name:
+                    return batch_offset, alignbatch
+                if batch_offset >> 16 > offset + window:
+                    break
+            if start == 0 and offset + window >= self.size:
+                return None
+            if max_window is not None and window >= max_window:
+                return None
+            window *= 2
 
-    score_function : Callable
-        a xenomapper alignment batch calling function
-        get_bamprimary_AS_XS or get_max_AS_XS
+    def close(self):
+        self.reader.close()
+        self._handle.close()
 
-    AS_function : Callable[[bytes], int]
-        a function that accepts a BAM alignment bytestring and returns the AS
-        score (alignment score) as an integer
-        get_AS or get_cigar_based_score
 
-    XS_function : Callable[[bytes], int]
-        a function that accepts a BAM alignment bytestring and returns the XS
-        score as an integer
-        get_XS, get_ZS, always_zero, or always_very_negative
+def _normal_quantile(probability: float) -> float:
+    # inverse of the standard normal distribution function by bisection
+    low, high = -10.0, 10.0
+    for i in range(100):
+        middle = (low + high) / 2
+        if (1 + math.erf(middle / math.sqrt(2))) / 2 < probability:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
 
-    min_score : int
-        the score that matches must exceed in order to be
-        considered valid matches. Note scores equalling this
-        value will also be considered not valid matches.
-        [ Default : -2**31 ]
-    conservative
+
+def wilson_interval(count: int, total: int,
+                    confidence: float = 0.95) -> Tuple[float, float]:
+    """The Wilson score confidence interval for a binomial proportion
+
+    Parameters
+    ----------
+    count : int
+        the number of successes
+    total : int
+        the number of trials
+    confidence : float
+        the confidence level of the interval [ Default : 0.95 ]
 
     Returns
     -------
-    Tuple[Counter, Counter, XenomapperOutputWriter]
+    (float, float)
+        the lower and upper bounds of the interval
     """
+    if not total:
+        return (0.0, 1.0)
+    z = _normal_quantile(1 - (1 - confidence) / 2)
+    proportion = count / total
+    denominator = 1 + z * z / total
+    centre = (proportion + z * z / (2 * total)) / denominator
+    half_width = (z * math.sqrt(proportion * (1 - proportion) / total
+                                + z * z / (4 * total * total))
+                  / denominator)
+    return (max(0.0, centre - half_width), min(1.0, centre + half_width))
+
+
+def xenomap_estimate(primary_file: Union[str, Path],
+                     secondary_file: Union[str, Path],
+                     score_function: Callable = get_bamprimary_AS_XS,
+                     AS_function: Callable = get_AS,
+                     XS_function: Callable = get_XS,
+                     min_score: int = MIN32INT,
+                     conservative: bool = False,
+                     confidence: float = 0.95,
+                     margin: float = 0.01,
+                     min_samples: int = 100,
+                     max_samples: int = 100000,
+                     seed: int = None,
+                     ):
+    """Estimate category proportions from randomly sampled templates
+
+    Templates are sampled without replacement by seeking to random positions
+    in the primary BAM, resynchronising to the template boundaries in the
+    BGZF block containing the position and choosing one of the templates
+    starting in the block (see BamTemplateSampler.random_template). As
+    blocks of small or highly compressible records hold more templates, a
+    template is accepted with probability proportional to the template
+    density of its block so all templates are equally likely to be sampled.
+    The largest density is learnt while sampling and when it increases
+    earlier samples are kept with the ratio of the old and new densities,
+    which leaves them accepted with the same probability as later samples.
+    The template with the same name is found in the secondary BAM by
+    searching near the proportional position, and the template classified
+    as in xenomap. Sampling stops when the confidence interval of every
+    category proportion is within margin of the estimate, or after
+    max_samples templates.
+
+    Parameters
+    ----------
+    primary_file : str or Path
+        name grouped BGZF BAM file of primary species alignments
+    secondary_file : str or Path
+        BGZF BAM file of secondary species alignments in the same order
+    score_function, AS_function, XS_function, min_score, conservative
+        as for xenomap
+    confidence : float
+        the confidence level of the intervals [ Default : 0.95 ]
+    margin : float
+        the largest acceptable half width of the confidence intervals
+        [ Default : 0.01 ]
+    min_samples : int
+        the number of templates to sample before testing the intervals
+    max_samples : int
+        the largest number of templates to sample
+    seed : int, optional
+        seed for the random number generator
+
+    Returns
+    -------
+    Tuple[Counter, Dict[str, int], Dict[str, Tuple[float, float]]]
+        counts of sampled template states, counts of sampled template
+        categories and the confidence interval of each category proportion
 
+    Raises
+    ------
+    ValueError
+        if a sampled template is not in the secondary BAM
+    """
     category_pair_counts = Counter()
     category_counts = { 'primary_specific' : 0,
                         'secondary_specific' : 0,
@@ -865,46 +6253,759 @@ def xenomap(primary_bam: AlignbatchFileReader,
                         'unresolved' : 0,
                         'unassigned' : 0,
                         }
-    if primary_bam.sort_order == 'coordinate':
-        raise ValueError(f"{primary_bam._ubam.name} is coordinate sorted"
-                         "BAM files must be ordered by readname for xenomapper")
-
-    if secondary_bam.sort_order == 'coordinate':
-        raise ValueError(f"{secondary_bam._ubam.name} is coordinate sorted"
-                         "BAM files must be ordered by readname for xenomapper")
-
-
-    for primary_aligns, secondary_aligns in zip_longest(primary_bam,
-                                                        secondary_bam,
-                                                        fillvalue = None):
-        # TODO This code probably does not do what I think it should
-        # Need to work out how to properly test for uneven file lengths
-        #if primary_aligns == None or secondary_aligns == None:
-        #    raise ValueError("BAM files are unequal lengths")
+    intervals = {}
+    primary = BamTemplateSampler(primary_file)
+    secondary = BamTemplateSampler(secondary_file)
+    random_generator = random.Random(seed)
+    # the states and category of each accepted template by virtual offset
+    sampled = {}
+    max_density = 0.0
+    failed_attempts = 0
+    # stop if the file appears to have no more unsampled templates
+    while len(sampled) < max_samples and failed_attempts < 1000:
+        found = primary.random_template(random_generator)
+        if found is None or found[0] in sampled:
+            failed_attempts += 1
+            continue
+        failed_attempts = 0
+        virtual_offset, primary_aligns, density = found
+        if density > max_density:
+            for offset in list(sampled):
+                if random_generator.random() * density >= max_density:
+                    states, category = sampled.pop(offset)
+                    category_pair_counts[states] -= 1
+                    category_counts[category] -= 1
+            max_density = density
+        elif random_generator.random() * max_density >= density:
+            continue
+        found = secondary.find_template(primary_aligns.name,
+                                        (virtual_offset >> 16)
+                                        * secondary.size // primary.size)
+        if found is None:
+            raise ValueError(f"{primary_aligns.name} is not in "
+                             f"{secondary_file}")
+        secondary_aligns = found[1]
         forward_state, reverse_state = xenomap_states(primary_aligns,
-                                                  secondary_aligns,
-                                                  score_function,
-                                                  AS_function=AS_function,
-                                                  XS_function=XS_function,
-                                                  min_score = min_score)
+                                                      secondary_aligns,
+                                                      score_function,
+                                                      AS_function=AS_function,
+                                                      XS_function=XS_function,
+                                                      min_score=min_score)
         category_pair_counts[(forward_state, reverse_state)] += 1
         if conservative:
             category = conservative_state_map(forward_state, reverse_state)
         else:
             category = state_map(forward_state, reverse_state)
         category_counts[category] += 1
-        if category in ['secondary_specific', 'secondary_multi']:
-            for align in secondary_aligns:
-                output_writer[category].write(align)
-        else:
-            for align in primary_aligns:
-                output_writer[category].write(align)
+        sampled[virtual_offset] = ((forward_state, reverse_state), category)
+        if len(sampled) >= min_samples:
+            intervals = {key: wilson_interval(category_counts[key],
+                                              len(sampled), confidence)
+                         for key in category_counts}
+            if all((high - low) / 2 <= margin
+                   for low, high in intervals.values()):
+                break
+    intervals = {key: wilson_interval(category_counts[key],
+                                      len(sampled), confidence)
+                 for key in category_counts}
+    primary.close()
+    secondary.close()
+    return +category_pair_counts, category_counts, intervals
+
+
+PREFLIGHT_TAGS: Tuple[str, ...] = ('AS', 'XS', 'ZS', 'NM')
+
+
+def get_header_fields(raw_header: bytes) -> Dict[str, str]:
+    """The fields of the @HD line of a raw BAM header
+
+    Parameters
+    ----------
+    raw_header : bytes
+        a raw BAM header including the four byte length
+
+    Returns
+    -------
+    Dict[str, str]
+        the value of each field (eg 'SO', 'GO', 'SS') of the @HD line
+    """
+    for line in raw_header[4:].split(b'\n'):
+        if line.startswith(b'@HD\t'):
+            return dict(field.decode().split(':', 1)
+                        for field in line.split(b'\t')[1:] if b':' in field)
+    return {}
+
+
+class PreflightReport():
+    """The results of preflight_check
+
+    Attributes
+    ----------
+    files : Tuple[str, str]
+        the primary and secondary filenames
+    headers : Tuple[Dict[str, str], Dict[str, str]]
+        the @HD fields of each file
+    estimated_templates, estimated_records : Tuple[int, int]
+        the numbers of templates and alignment records in each file
+        extrapolated from the sampled BGZF blocks
+    tags : Tuple[Dict[str, float], Dict[str, float]]
+        the fraction of sampled mapped alignments with each of
+        PREFLIGHT_TAGS readable by xenomapper
+    mapped : Tuple[int, int]
+        the number of sampled mapped alignments in each file
+    sampled : int
+        the number of primary templates sampled
+    matched : int
+        the number of sampled templates found in the secondary file
+    problems : List[str]
+        conditions that will make xenomapper fail or give wrong results
+    warnings : List[str]
+        conditions that may need different options
+    seconds : float
+        the time taken
+    """
+
+    def __init__(self, primary_file, secondary_file):
+        self.files = (str(primary_file), str(secondary_file))
+        self.headers = ({}, {})
+        self.estimated_templates = (0, 0)
+        self.estimated_records = (0, 0)
+        self.tags = ({}, {})
+        self.mapped = (0, 0)
+        self.sampled = 0
+        self.matched = 0
+        self.problems = []
+        self.warnings = []
+        self.seconds = 0.0
+
+    @property
+    def ok(self) -> bool:
+        """True if no problems were found"""
+        return not self.problems
+
+    def write(self, outfile: TextIO = sys.stderr):
+        """Print the report as a table followed by problems and warnings
+
+        Parameters
+        ----------
+        outfile : TextIO
+        """
+        row = '|  {0:30s}|{1:>20s}  |{2:>20s}  |'
+        print('-' * 80, file=outfile)
+        print(file=outfile)
+        print('Preflight Check', file=outfile)
+        print(file=outfile)
+        print(row.format('', 'Primary', 'Secondary'), file=outfile)
+        print('|:', '-' * 30, ':|:', '-' * 20, ':|:', '-' * 20, ':|',
+              sep='', file=outfile)
+        for field, name in (('SO', 'Sort order (SO)'),
+                            ('GO', 'Group order (GO)'),
+                            ('SS', 'Sub-sort order (SS)')):
+            print(row.format(name, *[header.get(field, '-')
+                                     for header in self.headers]),
+                  file=outfile)
+        print(row.format('Estimated templates',
+                         *map(str, self.estimated_templates)), file=outfile)
+        print(row.format('Estimated records',
+                         *map(str, self.estimated_records)), file=outfile)
+        for tag in PREFLIGHT_TAGS:
+            print(row.format(f'{tag} tags (mapped alignments)',
+                             *[f'{tags.get(tag, 0.0):.0%}'
+                               for tags in self.tags]),
+                  file=outfile)
+        print(file=outfile)
+        print(f'{self.matched} of {self.sampled} sampled primary templates '
+              f'found in the secondary file in {self.seconds:.2f}s',
+              file=outfile)
+        for title, messages in (('Problems', self.problems),
+                                ('Warnings', self.warnings)):
+            if messages:
+                print(f'\n{title}:', file=outfile)
+                for message in messages:
+                    print(f'  - {message}', file=outfile)
+        if self.ok:
+            print('\nNo problems found', file=outfile)
+        print(file=outfile)
+
+
+def _sample_spread_templates(sampler: BamTemplateSampler, samples: int):
+    # the first template starting in BGZF blocks spread evenly through the
+    # file, with the template and compressed byte counts of the blocks
+    first_block = sampler.first_offset >> 16
+    templates = []
+    block_templates = block_bytes = 0
+    seen = set()
+    for i in range(samples):
+        block = find_bgzf_block(sampler._handle,
+                                first_block + i * (sampler.size - first_block)
+                                // samples)
+        if block < 0 or block in seen:
+            continue
+        seen.add(block)
+        starts = sampler._block_templates(block)
+        block_size = read_bgzf_block(sampler._handle, block)[1]
+        if block_size <= 28: # the empty end of file block
+            continue
+        block_templates += len(starts)
+        block_bytes += block_size
+        if starts:
+            templates.append((starts[0],
+                              sampler.reader.get_alignbatch_at(starts[0])))
+    if block_bytes:
+        estimate = (block_templates * (sampler.size - first_block)
+                    // block_bytes)
+    else:
+        estimate = 0
+    return templates, estimate
+
+
+def _tag_fractions(templates) -> Tuple[Dict[str, float], int]:
+    # fraction of mapped alignments with each tag readable by xenomapper
+    # and the number of mapped alignments
+    getters = {'AS': get_AS, 'XS': get_XS, 'ZS': get_ZS,
+               'NM': lambda align: get_int_tag(align, b'NM')}
+    counts = Counter()
+    mapped = 0
+    for virtual_offset, alignbatch in templates:
+        for align in alignbatch:
+            if is_flag(align, FLAGS['unmapped']):
+                continue
+            mapped += 1
+            for tag, getter in getters.items():
+                if getter(align) != MIN32INT:
+                    counts[tag] += 1
+    return ({tag: counts[tag] / mapped if mapped else 0.0
+             for tag in getters}, mapped)
+
+
+def _split_mates(templates) -> int:
+    # the number of paired templates missing the first or last segment
+    split = 0
+    for virtual_offset, alignbatch in templates:
+        flags = 0
+        for align in alignbatch:
+            flags |= get_flag(align)
+        if (flags & FLAGS['paired']
+                and (flags & (FLAGS['forward'] | FLAGS['reverse']))
+                    != FLAGS['forward'] | FLAGS['reverse']):
+            split += 1
+    return split
+
+
+def preflight_check(primary_file: Union[str, Path],
+                    secondary_file: Union[str, Path],
+                    samples: int = 32,
+                    max_window: int = 2**24,
+                    max_misses: int = 3,
+                    score_type: str = 'XS',
+                    ) -> PreflightReport:
+    """Check that two BAM files can be classified before reading them
+
+    Templates starting in BGZF blocks spread evenly through the primary file
+    are found in the secondary file near the proportional position to check
+    that the files hold the same templates in the same order. The @HD
+    sort and group orders, the number of templates and records (estimated
+    from the sampled blocks), whether mates are grouped and the score tags
+    needed by score_type are also checked. Files with no mapped alignments
+    in the sampled templates only give a warning.
+
+    Parameters
+    ----------
+    primary_file : str or Path
+        BGZF BAM file of primary species alignments
+    secondary_file : str or Path
+        BGZF BAM file of secondary species alignments
+    samples : int
+        the number of positions to sample in the primary file
+        [ Default : 32 ]
+    max_window : int
+        the furthest (in compressed bytes) from the expected position that a
+        template is searched for in the secondary file [ Default : 2**24 ]
+    max_misses : int
+        stop searching the secondary file after this many sampled templates
+        are not found, as each miss reads up to twice max_window
+        [ Default : 3 ]
+    score_type : str
+        the scores the run will use: 'XS' (AS and XS tags), 'ZS' (AS and ZS
+        tags) or 'cigar' (cigar string and NM tag) [ Default : 'XS' ]
+
+    Returns
+    -------
+    PreflightReport
+
+    Raises
+    ------
+    ValueError
+        if score_type is not 'XS', 'ZS' or 'cigar'
+    """
+    if score_type not in ('XS', 'ZS', 'cigar'):
+        raise ValueError(f"Unknown score type {score_type}")
+    start_time = time.time()
+    report = PreflightReport(primary_file, secondary_file)
+    primary = BamTemplateSampler(primary_file)
+    secondary = BamTemplateSampler(secondary_file)
+    names = ('primary', 'secondary')
+    samplers = (primary, secondary)
+    report.headers = tuple(get_header_fields(sampler.reader.raw_header)
+                           for sampler in samplers)
+    for name, header in zip(names, report.headers):
+        if header.get('SO') == 'coordinate':
+            report.problems.append(f"The {name} file is coordinate sorted. "
+                                   "Sort by read name (samtools sort -n) or "
+                                   "use the aligner output directly")
+        if header.get('GO') == 'reference':
+            report.problems.append(f"The {name} file is grouped by reference "
+                                   "(GO:reference). Alignments must be "
+                                   "grouped by read name")
+    if (report.headers[0].get('SO'), report.headers[0].get('SS')) != (
+            report.headers[1].get('SO'), report.headers[1].get('SS')):
+        report.warnings.append("The header sort orders differ. Both files "
+                               "must have templates in the same order")
+
+    sampled = [_sample_spread_templates(sampler, samples)
+               for sampler in samplers]
+    report.estimated_templates = tuple(estimate
+                                       for templates, estimate in sampled)
+    report.estimated_records = tuple(
+        estimate * sum(len(batch) for offset, batch in templates)
+        // max(1, len(templates))
+        for templates, estimate in sampled)
+    report.tags, report.mapped = zip(*[_tag_fractions(templates)
+                                       for templates, estimate in sampled])
+
+    primary_templates = sampled[0][0]
+    report.sampled = len(primary_templates)
+    previous = None
+    misses = 0
+    for virtual_offset, alignbatch in primary_templates:
+        if misses >= max_misses:
+            report.problems.append(f"Stopped after {misses} sampled "
+                                   "templates were not found in the "
+                                   "secondary file")
+            break
+        found = secondary.find_template(alignbatch.name,
+                                        (virtual_offset >> 16)
+                                        * secondary.size // primary.size,
+                                        max_window=max_window)
+        if found is None:
+            report.problems.append(f"{alignbatch.name[:-1].decode()} is not "
+                                   "in the secondary file near its position "
+                                   "in the primary file. The files must "
+                                   "contain the same reads in the same order")
+            misses += 1
+            continue
+        report.matched += 1
+        if previous is not None and found[0] <= previous[0]:
+            report.problems.append(f"{alignbatch.name[:-1].decode()} is "
+                                   "after "
+                                   f"{previous[1].name[:-1].decode()} in the "
+                                   "primary file but before it in the "
+                                   "secondary file. The files must be in the "
+                                   "same order")
+        previous = (found[0], alignbatch)
+
+    for name, header, (templates, estimate) in zip(names, report.headers,
+                                                   sampled):
+        paired = sum(1 for offset, batch in templates
+                     if is_flag(batch[0], FLAGS['paired']))
+        if paired and _split_mates(templates) * 2 > paired:
+            report.problems.append(f"Most sampled paired templates in the "
+                                   f"{name} file have only one mate. Reads "
+                                   "must be grouped by name (samtools "
+                                   "collate or sort -n)")
+        if header.get('SO') == 'queryname' and len(templates) > 1:
+            ordered = [batch.name for offset, batch in templates]
+            if (ordered != sorted(ordered)
+                    and ordered != sorted(ordered, key=natural_name_key)):
+                report.warnings.append(f"The {name} file header is "
+                                       "SO:queryname but the sampled names "
+                                       "are not sorted")
+
+    low, high = sorted(report.estimated_templates)
+    if high and low * 1.25 < high:
+        report.warnings.append("The estimated numbers of templates differ "
+                               f"({report.estimated_templates[0]} and "
+                               f"{report.estimated_templates[1]}). Check both "
+                               "files are from the same reads")
+    for name, tags, mapped in zip(names, report.tags, report.mapped):
+        if not mapped:
+            report.warnings.append(f"No sampled alignments in the {name} "
+                                   "file are mapped so the score tags were "
+                                   "not checked")
+        elif score_type == 'cigar':
+            if not tags['NM']:
+                report.problems.append(f"The {name} file has no readable NM "
+                                       "tags, which --cigar needs to score "
+                                       "alignments")
+        elif not tags['AS'] and tags['NM']:
+            report.problems.append(f"The {name} file has no readable AS tags."
+                                   " Use --cigar to score from the cigar "
+                                   "string and NM tag")
+        elif not tags['AS']:
+            report.problems.append(f"The {name} file has no readable AS or "
+                                   "NM tags. Check the aligner options")
+        elif (score_type == 'XS' and tags['ZS'] and not tags['XS']):
+            report.warnings.append(f"The {name} file has ZS but no XS tags "
+                                   "(HISAT2 style). Consider --zs")
+    primary.close()
+    secondary.close()
+    report.seconds = time.time() - start_time
+    return report
+
+
+def make_shards(primary_file: Union[str, Path],
+                secondary_file: Union[str, Path],
+                n_shards: int) -> List[dict]:
+    """Divide a pair of BAM files into template aligned ranges
+
+    Shard boundaries are placed at the first template starting after each
+    1/n_shards of the compressed primary file, and the same template is
+    found in the secondary file.
+
+    Parameters
+    ----------
+    primary_file : str or Path
+        name grouped BGZF BAM file of primary species alignments
+    secondary_file : str or Path
+        BGZF BAM file of secondary species alignments in the same order
+    n_shards : int
+        the number of shards requested. Fewer shards are returned for
+        files with too few BGZF blocks.
+
+    Returns
+    -------
+    List[Dict[str, int]]
+        primary_start, primary_end, secondary_start and secondary_end
+        virtual offsets of each shard. The end of the last shard is None.
+
+    Raises
+    ------
+    ValueError
+        if a boundary template is not in the secondary BAM
+    """
+    primary = BamTemplateSampler(primary_file)
+    secondary = BamTemplateSampler(secondary_file)
+    boundaries = [(primary.first_offset, secondary.first_offset)]
+    for shard in range(1, n_shards):
+        offset = primary.size * shard // n_shards
+        found = primary.template_at(offset)
+        if found is None or found[0] <= boundaries[-1][0]:
+            continue
+        primary_offset, alignbatch = found
+        found = secondary.find_template(alignbatch.name,
+                                        offset * secondary.size
+                                        // primary.size)
+        if found is None:
+            raise ValueError(f"{alignbatch.name} is not in {secondary_file}")
+        boundaries.append((primary_offset, found[0]))
+    primary.close()
+    secondary.close()
+    boundaries.append((None, None))
+    return [{'primary_start': start[0],
+             'primary_end': end[0],
+             'secondary_start': start[1],
+             'secondary_end': end[1]}
+            for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+
+def write_shard_manifest(primary_file: Union[str, Path],
+                         secondary_file: Union[str, Path],
+                         n_shards: int,
+                         manifest_file: Union[str, Path]) -> List[dict]:
+    """Write a JSON manifest of shards for running on separate nodes
+
+    Parameters
+    ----------
+    primary_file : str or Path
+        name grouped BGZF BAM file of primary species alignments
+    secondary_file : str or Path
+        BGZF BAM file of secondary species alignments in the same order
+    n_shards : int
+        the number of shards requested
+    manifest_file : str or Path
+        filename for the manifest
+
+    Returns
+    -------
+    List[Dict[str, int]]
+        the shards as returned by make_shards
+    """
+    shards = make_shards(primary_file, secondary_file, n_shards)
+    with open(manifest_file, 'w') as manifest:
+        json.dump({'version': __version__,
+                   'primary': str(primary_file),
+                   'secondary': str(secondary_file),
+                   'shards': shards}, manifest, indent=1)
+    return shards
+
+
+def read_shard_manifest(manifest_file: Union[str, Path],
+                        shard: int) -> dict:
+    """Get one shard from a manifest written by write_shard_manifest
+
+    Parameters
+    ----------
+    manifest_file : str or Path
+        filename of the manifest
+    shard : int
+        the index of the shard, from 0
+
+    Returns
+    -------
+    Dict[str, int]
+        primary_start, primary_end, secondary_start and secondary_end
+        virtual offsets of the shard
+    """
+    with open(manifest_file) as manifest:
+        shards = json.load(manifest)['shards']
+    if not 0 <= shard < len(shards):
+        raise ValueError(f"Shard {shard} is not in {manifest_file} "
+                         f"which has {len(shards)} shards")
+    return shards[shard]
+
+
+def write_counts(category_pair_counts: Counter,
+                 category_counts: dict,
+                 file: Union[str, Path]):
+    """Write template state and category counts as JSON for merging
+
+    Parameters
+    ----------
+    category_pair_counts : Counter
+        counts of (forward_state, reverse_state) as returned by xenomap
+    category_counts : Dict[str, int]
+        counts of categories as returned by xenomap
+    file : str or Path
+        filename for the counts
+    """
+    with open(file, 'w') as outfile:
+        json.dump({'category_pair_counts': [[*states, count] for states, count
+                                            in category_pair_counts.items()],
+                   'category_counts': category_counts}, outfile, indent=1)
+
+
+def read_counts(file: Union[str, Path]) -> Tuple[Counter, dict]:
+    """Read counts written by write_counts
+
+    Parameters
+    ----------
+    file : str or Path
+        filename of the counts
+
+    Returns
+    -------
+    Tuple[Counter, Dict[str, int]]
+        the category pair counts and category counts
+    """
+    with open(file) as infile:
+        counts = json.load(infile)
+    category_pair_counts = Counter({(forward, reverse): count
+                                    for forward, reverse, count
+                                    in counts['category_pair_counts']})
+    return category_pair_counts, counts['category_counts']
+
+
+# an empty BGZF block marking the end of file
+BGZF_EOF = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+            b"\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def iter_bgzf_blocks(handle: BinaryIO) -> Generator[bytes, None, None]:
+    """Iterate over the compressed BGZF blocks of a file without decompressing
+
+    Parameters
+    ----------
+    handle : BinaryIO
+        a BGZF file opened in binary mode
+
+    Yields
+    ------
+    bytes
+        each complete compressed block
+    """
+    while True:
+        header = handle.read(18)
+        if not header:
+            break
+        if header[:4] != BGZF_MAGIC or header[10:16] != BGZF_EXTRA:
+            raise ValueError(f"{getattr(handle, 'name', 'file')} is not "
+                             f"a BGZF file")
+        block_size = struct.unpack_from('<H', header, 16)[0] + 1
+        yield header + handle.read(block_size - 18)
+
+
+def compress_bgzf_block(data: bytes, compresslevel: int = 6,
+                        codec: Codec = None) -> bytes:
+    """Compress data of up to 64KiB into a single BGZF block
+
+    Parameters
+    ----------
+    data : bytes
+        the uncompressed data
+    compresslevel : int
+        zlib compression level [ Default : 6 ]
+    codec : Codec, optional
+        the deflate implementation [ Default : None (zlib) ]
+
+    Returns
+    -------
+    bytes
+        the compressed block
+
+    Raises
+    ------
+    ValueError
+        if the compressed block is larger than the 64KiB a BGZF block can
+        hold, as incompressible data of close to 64KiB can be
+    """
+    if codec is None:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    else:
+        compressed = codec.compress(data, compresslevel)
+    # 26 bytes of header and footer, the BSIZE field holds block size - 1
+    if len(compressed) + 26 > 65536:
+        raise ValueError(f"{len(data)} bytes compressed to "
+                         f"{len(compressed) + 26} bytes, more than the 65536 "
+                         f"bytes a BGZF block can hold")
+    return (BGZF_MAGIC + b"\x00\x00\x00\x00\x00\xff" + BGZF_EXTRA
+            + struct.pack('<H', len(compressed) + 25)
+            + compressed
+            + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def _bam_header_length(data: bytes) -> Union[int, None]:
+    # the length of the BAM header at the start of data or None if incomplete
+    if len(data) < 12:
+        return None
+    length = 8 + struct.unpack_from('<i', data, 4)[0]
+    if len(data) < length + 4:
+        return None
+    n_ref = struct.unpack_from('<i', data, length)[0]
+    length += 4
+    for i in range(n_ref):
+        if len(data) < length + 4:
+            return None
+        length += 8 + struct.unpack_from('<i', data, length)[0]
+    if len(data) < length:
+        return None
+    return length
+
+
+def concatenate_bgzf(infiles: List[Union[str, Path]],
+                     outfile: Union[str, Path],
+                     bam_header: bool = True):
+    """Concatenate BGZF files at the block level without recompression
+
+    End of file blocks are removed except at the end of the output. For BAM
+    files the header is kept from the first file only, and the block of
+    other files containing the end of the header is the only data that is
+    recompressed.
+
+    Parameters
+    ----------
+    infiles : List[str or Path]
+        BGZF files in order
+    outfile : str or Path
+        filename for the concatenated file
+    bam_header : bool
+        the files are BAM files with headers [ Default : True ]
+
+    Raises
+    ------
+    ValueError
+        if BAM files are coordinate sorted, as concatenation would not
+        preserve the sort order
+    """
+    with open(outfile, 'wb') as output:
+        for file_number, infile in enumerate(infiles):
+            with open(infile, 'rb') as handle:
+                # decompressed data read while looking for the header end
+                data = b''
+                in_header = bam_header
+                for block in iter_bgzf_blocks(handle):
+                    if struct.unpack_from('<I', block, len(block) - 4)[0] == 0:
+                        continue
+                    if not in_header:
+                        output.write(block)
+                        continue
+                    data += zlib.decompress(block[18:-8], -15)
+                    header_length = _bam_header_length(data)
+                    if header_length is None:
+                        if file_number == 0:
+                            output.write(block)
+                        continue
+                    in_header = False
+                    if re.search(b'SO:coordinate', data[:header_length]):
+                        raise ValueError(f"{infile} is coordinate sorted and "
+                                         "can not be concatenated")
+                    if file_number == 0:
+                        output.write(block)
+                    elif len(data) > header_length:
+                        output.write(compress_bgzf_block(data[header_length:]))
+        output.write(BGZF_EOF)
+
+
+def merge_shards(shard_basenames: List[str],
+                 basename: str) -> Tuple[Counter, dict]:
+    """Merge the outputs and counts of runs on separate shards
+
+    Each BAM or FASTQ output of the first shard (<shard>_<suffix>) is
+    concatenated with the matching outputs of the other shards in order to
+    <basename>_<suffix>, and the counts in <shard>_counts.json are summed.
+
+    Parameters
+    ----------
+    shard_basenames : List[str]
+        the basenames used for each shard run, in shard order
+    basename : str
+        basename for the merged outputs
+
+    Returns
+    -------
+    Tuple[Counter, Dict[str, int]]
+        the summed category pair counts and category counts
+
+    Raises
+    ------
+    ValueError
+        if a shard is missing an output present for the first shard, or an
+        output is coordinate sorted (see concatenate_bgzf). Both are checked
+        before any output is written.
+    """
+    first = shard_basenames[0]
+    suffixes = [Path(name).name[len(Path(first).name):]
+                for name in sorted(glob.glob(f"{glob.escape(first)}_*"))
+                if name.endswith(('.bam', '.fastq.gz'))]
+    for suffix in suffixes:
+        for shard in shard_basenames:
+            if not Path(f"{shard}{suffix}").exists():
+                raise ValueError(f"{shard}{suffix} is missing")
+        if suffix.endswith('.bam'):
+            with AlignbatchFileReader(gzip.open(f"{first}{suffix}")) as reader:
+                if reader.sort_order == 'coordinate':
+                    raise ValueError(f"{first}{suffix} is coordinate sorted "
+                                     f"and can not be merged. Shards can "
+                                     f"not be run with --sort")
+    for suffix in suffixes:
+        infiles = [f"{shard}{suffix}" for shard in shard_basenames]
+        concatenate_bgzf(infiles, f"{basename}{suffix}",
+                         bam_header=suffix.endswith('.bam'))
+    category_pair_counts = Counter()
+    category_counts = {}
+    for shard in shard_basenames:
+        shard_pair_counts, shard_counts = read_counts(f"{shard}_counts.json")
+        category_pair_counts.update(shard_pair_counts)
+        for category in shard_counts:
+            category_counts[category] = (category_counts.get(category, 0)
+                                         + shard_counts[category])
+    return category_pair_counts, category_counts
 
-    return category_pair_counts, category_counts, output_writer
 
 def output_summary(category_counts: Counter,
                    title = 'Read Count Category Summary\n',
-                   outfile = sys.stderr):
+                   outfile = sys.stderr,
+                   intervals = None):
     """Print a summary table based on a Counter
 
     Parameters
@@ -912,22 +7013,41 @@ def output_summary(category_counts: Counter,
         category_counts : Counter
         title : str
         outfile : TextIO
+        intervals : Dict[str, Tuple[float, float]], optional
+            confidence intervals of category proportions to add as a column
+            of estimates with error bars
     """
     print('-' * 80, file=outfile)
     print(file=outfile)
     print(title, file=outfile)
     print(file=outfile)
-    print('|       {0:45s}|     {1:10s}  |'.format('Category', 'Count'),
-          file=outfile)
-    print('|:', '-' * 50, ':|:', '-' * 15, ':|', sep='', file=outfile)
+    if intervals is None:
+        print('|       {0:45s}|     {1:10s}  |'.format('Category', 'Count'),
+              file=outfile)
+        print('|:', '-' * 50, ':|:', '-' * 15, ':|', sep='', file=outfile)
+    else:
+        print('|       {0:45s}|     {1:10s}  |  {2:22s}  |'.format(
+                    'Category', 'Count', 'Proportion [interval]'),
+              file=outfile)
+        print('|:', '-' * 50, ':|:', '-' * 15, ':|:', '-' * 24, ':|',
+              sep='', file=outfile)
+    total = sum(category_counts.values())
     for category in sorted(category_counts):
         if type(category) != str:
-            category_name = ' & '.join(category)
+            category_name = ' & '.join(map(str, category))
         else:
             category_name = category
-        print('|  {0:50s}|{1:15d}  |'.format(category_name,
-                                             category_counts[category]),
-              file=outfile)
+        if intervals is None:
+            print('|  {0:50s}|{1:15d}  |'.format(category_name,
+                                                 category_counts[category]),
+                  file=outfile)
+        else:
+            low, high = intervals[category]
+            proportion = category_counts[category] / total if total else 0.0
+            print('|  {0:50s}|{1:15d}  |  {2:.4f} [{3:.4f}-{4:.4f}]  |'.format(
+                        category_name, category_counts[category],
+                        proportion, low, high),
+                  file=outfile)
     print(file=outfile)
     pass
 